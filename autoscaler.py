@@ -0,0 +1,153 @@
+import os
+import threading
+import time
+from loguru import logger
+
+
+def cpu_times():
+    """(total, iowait) jiffies from /proc/stat, None where it isn't available"""
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    return sum(fields), fields[4] if len(fields) > 4 else 0
+
+
+def load_per_cpu():
+    """1 minute load average per CPU, None where it isn't available (eg: Windows)"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class Autoscaler:
+    """
+    Changes the number of decode slots while a run goes, hill climbing on throughput: every `interval`
+    seconds it compares the frames/s decoded with the previous window. The decode rate is what ffmpeg
+    reports through -progress, read every `sample_interval` seconds and averaged over the window, so it
+    follows the decoders as they run rather than jobs finishing. While jobs are queued and every
+    slot is busy it adds a slot, keeps it if frames/s rose by at least `min_gain`, and gives it back if
+    not (then waits `cooldown` windows before trying again). A slot is taken away whenever the host
+    looks saturated: load average per CPU over `max_load`, more than `max_iowait` percent of CPU
+    time waiting on I/O, or frames/s per busy slot down by more than `max_slot_drop` on the last window
+    without frames/s overall going up (the decoders are getting in each other's way). Slots stay within min_slots and max_slots, and every decision is logged.
+    """
+
+    def __init__(self, scheduler, rate, min_slots=1, max_slots=8, interval=60, max_load=1.0, max_iowait=30, min_gain=0.05,
+                 cooldown=5, sample_interval=5, max_slot_drop=0.3):
+        """
+        @param rate callable returning the frames/s being decoded right now, over every worker
+        @param max_slot_drop fraction frames/s per busy slot may fall by between windows, 0 = don't check
+        """
+        self.scheduler = scheduler
+        self.rate = rate
+        self.sample_interval = max(0.1, min(sample_interval, interval))
+        self.min_slots = max(1, min_slots)
+        self.max_slots = max(self.min_slots, max_slots)
+        self.interval = interval
+        self.max_load = max_load
+        self.max_iowait = max_iowait
+        self.min_gain = min_gain
+        self.max_slot_drop = max_slot_drop
+        self.cooldown = cooldown
+        self.cooling = 0  # windows left before another slot may be added
+        self.scheduler.slot_limit = self.max_slots
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.decisions = []
+        self.last_rate = None
+        self.last_slot_rate = None
+        self.last_added = False
+        self._rates = []
+        self._cpu = None
+
+    def start(self):
+        self._rates, self._cpu = [], cpu_times()
+        # Start inside the bounds
+        while self.scheduler.total_slots > self.max_slots and self.scheduler.remove_slot():
+            pass
+        while self.scheduler.total_slots < self.min_slots and self.scheduler.add_slot():
+            pass
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        last_step = time.time()
+        while not self.stop_event.wait(self.sample_interval):
+            try:
+                self._rates.append(self.rate())
+                if time.time() - last_step >= self.interval:
+                    last_step = time.time()
+                    self.step()
+            except Exception as e:
+                logger.error('Autoscaler error. `{}:{}`'.format(type(e).__name__, str(e)))
+
+    def sample(self):
+        """Mean decode frames/s over the readings since the last sample, load per CPU and iowait %"""
+        rates, self._rates = self._rates, []
+        rate = sum(rates) / len(rates) if rates else self.rate()
+        cpu = cpu_times()
+        iowait = None
+        if cpu is not None and self._cpu is not None and cpu[0] > self._cpu[0]:
+            iowait = 100.0 * (cpu[1] - self._cpu[1]) / (cpu[0] - self._cpu[0])
+        self._cpu = cpu
+        return rate, load_per_cpu(), iowait
+
+    def step(self):
+        """Take one sample and act on it, returns the decision"""
+        rate, load, iowait = self.sample()
+        slots = self.scheduler.total_slots
+        busy = self.scheduler.busy_slots()
+        waiting = self.scheduler.waiting
+        slot_rate = rate / busy if busy else None
+        action, reason = 'hold', 'steady'
+
+        if load is not None and load > self.max_load:
+            action, reason = 'remove', 'load {:.2f} per CPU over {}'.format(load, self.max_load)
+        elif iowait is not None and iowait > self.max_iowait:
+            action, reason = 'remove', 'iowait {:.0f}% over {}%'.format(iowait, self.max_iowait)
+        elif (self.max_slot_drop and slot_rate is not None and self.last_slot_rate and rate <= self.last_rate
+              and slot_rate < self.last_slot_rate * (1 - self.max_slot_drop)):
+            action, reason = 'remove', 'frames/s per slot down {:.0%} ({:.1f} -> {:.1f})'.format(
+                1 - slot_rate / self.last_slot_rate, self.last_slot_rate, slot_rate)
+        elif self.last_added and self.last_rate is not None and rate < self.last_rate * (1 + self.min_gain):
+            action, reason = 'remove', 'last slot added no throughput ({:.1f} -> {:.1f} frames/s)'.format(self.last_rate, rate)
+            self.cooling = self.cooldown
+        elif self.cooling:
+            self.cooling -= 1
+            reason = 'cooling down after a slot that didn\'t help'
+        elif waiting and busy >= slots:
+            action, reason = 'add', '{} jobs waiting with every slot busy'.format(waiting)
+        elif not waiting:
+            reason = 'no jobs waiting'
+
+        device = None
+        if action == 'remove':
+            device = self.scheduler.remove_slot() if slots > self.min_slots else None
+        elif action == 'add':
+            device = self.scheduler.add_slot() if slots < self.max_slots else None
+        if device is None and action != 'hold':
+            reason += ', at the {} bound'.format('lower' if action == 'remove' else 'upper')
+            action = 'hold'
+
+        decision = {
+            'time': time.time(), 'action': action, 'device': device, 'reason': reason,
+            'slots': self.scheduler.total_slots, 'frames_per_second': round(rate, 2),
+            'frames_per_second_per_slot': round(slot_rate, 2) if slot_rate is not None else None,
+            'load': round(load, 2) if load is not None else None,
+            'iowait': round(iowait, 1) if iowait is not None else None,
+        }
+        self.decisions.append(decision)
+        logger.info('Autoscaler: {} {} -> {} slots ({}), {:.1f} frames/s, load {}, iowait {}'.format(
+            action, slots, decision['slots'], reason, rate, decision['load'], decision['iowait']))
+        self.last_added = action == 'add'
+        self.last_rate = rate
+        self.last_slot_rate = slot_rate
+        return decision
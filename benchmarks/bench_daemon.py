@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Daemon mode against the fake Plex server and a fake notification source.
+
+Replays the notifications Plex sends while a batch of seasons is imported (created, matching,
+downloading, processed), with --gap seconds between messages. It then waits for every preview to be
+written and reports how many batches the debouncer made, the seconds from the last "processed"
+notification to the last preview, and the Plex API calls spent.
+
+With --missed N, the notifications for the last N episodes are lost as if the stream had dropped. Those
+episodes are updated on the fake server and the source reconnects, so only the catch up can find them.
+The run exits with 1 unless every episode gets a preview, each batch has every key at most once, and
+the watermark only moves on once the caught up episodes are done.
+
+    python3 benchmarks/bench_daemon.py --seasons 3 --episodes 12 --debounce 2
+    python3 benchmarks/bench_daemon.py --missed 5 --debounce 2
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_plex import Catalog, FakePlexServer  # noqa: E402
+from bench_e2e import make_clip, link_media, load_script, MEDIA_PREFIX  # noqa: E402
+from notifications import FakeNotificationSource, import_messages  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shows', type=int, default=1, help='shows being imported')
+    parser.add_argument('--seasons', type=int, default=2)
+    parser.add_argument('--episodes', type=int, default=10, help='episodes per season')
+    parser.add_argument('--gap', type=float, default=0.01, help='seconds between notifications')
+    parser.add_argument('--debounce', type=float, default=2, help='DEBOUNCE_SECONDS for the run')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every Plex request')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--clip', help='video every episode points at, a short synthetic clip is made if not given')
+    parser.add_argument('--clip-seconds', type=int, default=30)
+    parser.add_argument('--variants', default='sd=320x240', help='BIF_VARIANTS, eg: sd=320x240;hd=640x360@3')
+    parser.add_argument('--missed', type=int, default=0, help='episodes whose notifications are lost, found by the catch up after a reconnect')
+    args = parser.parse_args()
+
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        sys.exit('ffmpeg must be installed and available in PATH')
+
+    work = tempfile.mkdtemp(prefix='bench_daemon_')
+    cwd = os.getcwd()
+    try:
+        clip = os.path.abspath(args.clip) if args.clip else os.path.join(work, 'clip.mp4')
+        if not args.clip:
+            make_clip(ffmpeg, clip, args.clip_seconds)
+        catalog = Catalog(1, args.shows, args.seasons, args.episodes, MEDIA_PREFIX, duration=args.clip_seconds,
+                          size=os.path.getsize(clip))
+        # Older than the catch up's overlap, so it only finds the episodes touched below
+        catalog.updated_at -= 3600
+        media_root = os.path.join(work, 'media')
+        link_media(catalog, clip, media_root)
+        server = FakePlexServer(catalog, latency=args.latency / 1000).start()
+
+        os.chdir(work)
+        script = load_script(server, work, media_root, args.variants)
+        script.LEDGER_PATH = os.path.join(work, 'ledger.db')
+        script.DEBOUNCE_SECONDS = args.debounce
+        script.WATERMARK_PATH = os.path.join(work, 'watermarks.json')
+        os.makedirs(script.PLEX_LOCAL_MEDIA_PATH, exist_ok=True)
+        os.makedirs(script.TMP_FOLDER, exist_ok=True)
+
+        batches = []
+        process_media = script.process_media
+        ledger = script.JobLedger(script.LEDGER_PATH)
+
+        def count_batches(media, title, scheduler):
+            batches.append(list(media))
+            return process_media(media, title, scheduler)
+
+        script.process_media = count_batches
+
+        episodes = list(catalog.all_episode_keys())
+        missed = episodes[len(episodes) - args.missed:] if args.missed else []
+        source = FakeNotificationSource(import_messages(episodes[:len(episodes) - len(missed)]), interval=args.gap)
+        last_notification = []
+        emit = source.emit
+
+        def timed_emit(message):
+            emit(message)
+            last_notification[:] = [time.time()]
+
+        source.emit = timed_emit
+        stop = threading.Event()
+        scheduler = script.DecodeScheduler(script.make_backend('none'), gpu_slots=0, cpu_slots=args.workers)
+        started = time.time()
+        daemon = threading.Thread(target=script.daemon, args=(scheduler, source, stop), daemon=True)
+        daemon.start()
+
+        def read_watermark():
+            with open(script.WATERMARK_PATH) as f:
+                return json.load(f).get('1')
+
+        committed_early = False
+        if missed:
+            source.replayed.wait(args.timeout)
+            for key in missed:
+                catalog.touch(key)
+            before = read_watermark()
+            source.reconnect()
+            # The catch up has run but its batch is still being debounced, the watermark must not have moved yet
+            committed_early = read_watermark() != before
+        done = 0
+        while time.time() - started < args.timeout:
+            done = ledger.summary().get(script.DONE, {}).get('count', 0)
+            if done >= len(episodes):
+                break
+            time.sleep(0.2)
+        finished = time.time()
+        stop.set()
+        daemon.join()
+        server.shutdown()
+
+        problems = []
+        if done < len(episodes):
+            problems.append('{} of {} episodes have a preview'.format(done, len(episodes)))
+        if any(len(set(batch)) != len(batch) for batch in batches):
+            problems.append('a batch had the same key more than once')
+        caught = {key for batch in batches for key in batch}
+        lost = [key for key in missed if '/library/metadata/{}'.format(key) not in caught]
+        if lost:
+            problems.append('{} missed episodes were never caught up'.format(len(lost)))
+        if committed_early:
+            problems.append('the watermark moved on before the caught up episodes were processed')
+        elif missed and read_watermark()['updatedAt'] < max(catalog.touched.values()):
+            problems.append('the watermark never moved past the caught up episodes')
+
+        api = server.stats()
+        results = {
+            'episodes': len(episodes),
+            'notifications': len(source.messages),
+            'debounce_seconds': args.debounce,
+            'variants': args.variants,
+            'previews_written': done,
+            'batches': [len(batch) for batch in batches],
+            'missed': len(missed),
+            'seconds_after_last_notification': round(finished - last_notification[0], 2) if last_notification else None,
+            'total_seconds': round(finished - started, 2),
+            'api_calls': api['total_calls'],
+            'api_calls_by_route': api['calls'],
+            'problems': problems,
+        }
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+    if results['problems']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
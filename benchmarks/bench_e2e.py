@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+End to end load test of plex_generate_previews against the fake Plex server.
+
+Serves a fake library (benchmarks/fake_plex.py) whose episodes all map onto one synthetic clip, then
+runs the real run() (a full sweep) or process_item() for every episode with each worker count. For
+every run it reports wall time, items/s, API calls per item, seconds spent waiting on the API and
+seconds spent decoding, giving a scaling curve as the worker count grows.
+
+    python3 benchmarks/bench_e2e.py --shows 50 --seasons 2 --episodes 10 --latency 20 --workers 1,2,4,8
+    python3 benchmarks/bench_e2e.py --entry process_item --limit 200 --error-rate 0.01
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_plex import Catalog, FakePlexServer  # noqa: E402
+
+MEDIA_PREFIX = '/fake/media'
+
+
+def make_clip(ffmpeg, path, duration):
+    subprocess.run([
+        ffmpeg, '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=24',
+        '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '96', '-pix_fmt', 'yuv420p', path
+    ], check=True)
+
+
+def link_media(catalog, clip, media_root):
+    """A symlink to the clip for every episode, where the path mappings will look for it"""
+    for key in catalog.all_episode_keys():
+        _, s, h, n, e = catalog.parse_key(key)
+        path = media_root + catalog.file(s, h, n, e)[len(MEDIA_PREFIX):]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.lexists(path):
+            os.symlink(clip, path)
+
+
+def load_script(server, work, media_root, variants):
+    """Import plex_generate_previews configured for the fake server"""
+    os.environ.update({
+        'PLEX_URL': server.url,
+        'PLEX_TOKEN': 'fake',
+        'PLEX_LOCAL_MEDIA_PATH': os.path.join(work, 'plex'),
+        'TMP_FOLDER': os.path.join(work, 'tmp'),
+        'PLEX_VIDEOS_PATH_MAPPING': MEDIA_PREFIX,
+        'PLEX_VIDEOS_PATH_ARRAY': MEDIA_PREFIX,
+        'PLEX_LOCAL_VIDEOS_PATH_MAPPING': media_root,
+        'PLEX_LOCAL_VIDEOS_PATH_ARRAY': media_root,
+        'GPU_BACKEND': 'none',
+        'GPU_THREADS': '0',
+        'STORAGE_BACKENDS': '',
+        'PUBLISH_MIRRORS': '',
+        # Every episode is the same clip, the BIF store would turn all but the first into a copy
+        'BIF_STORE_PATH': '',
+        'EXTRACTION_MODE': 'full',
+        'BIF_VARIANTS': variants,
+    })
+    # The script treats its first argument as a path filter, don't let it see ours
+    sys.argv = sys.argv[:1]
+    return importlib.import_module('plex_generate_previews')
+
+
+def run_once(script, server, catalog, work, workers, entry, limit):
+    """One run with a fresh ledger and Plex bundle folder, so nothing is skipped"""
+    run_dir = tempfile.mkdtemp(dir=work)
+    script.LEDGER_PATH = os.path.join(run_dir, 'ledger.db')
+    script.PLEX_LOCAL_MEDIA_PATH = os.path.join(run_dir, 'plex')
+    script.CPU_THREADS = workers
+    script.GPU_THREADS = 0
+    script.runType = 'Full'
+    script._local = threading.local()
+    script._publisher = None
+    script._inventory = None
+    os.makedirs(script.TMP_FOLDER, exist_ok=True)
+
+    # Keep hold of the scheduler run() makes so its decode time can be read back
+    schedulers = []
+    make_scheduler = script.DecodeScheduler
+
+    def capture(*args, **kwargs):
+        schedulers.append(make_scheduler(*args, **kwargs))
+        return schedulers[-1]
+
+    script.DecodeScheduler = capture
+    server.reset_stats()
+    start = time.time()
+    error = None
+    try:
+        if entry == 'run':
+            script.run()
+        else:
+            for key in list(catalog.all_episode_keys())[:limit]:
+                script.process_item('/library/metadata/{}'.format(key))
+    except Exception as e:
+        # An API error the script didn't handle ends the run, that's a result too
+        error = '{}: {}'.format(type(e).__name__, str(e))
+    finally:
+        script.DecodeScheduler = make_scheduler
+    seconds = time.time() - start
+
+    summary = script.get_ledger().summary()
+    items = sum(status['count'] for status in summary.values())
+    api = server.stats()
+    decode_seconds = sum(device.busy_seconds for scheduler in schedulers for device in scheduler.devices.values())
+    bifs = sum(name.endswith('.bif') for _, _, names in os.walk(script.PLEX_LOCAL_MEDIA_PATH) for name in names)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return {
+        'workers': workers,
+        'wall_seconds': round(seconds, 2),
+        'items': items,
+        'items_per_second': round(items / seconds, 2) if seconds else None,
+        'outcomes': {name: status['count'] for name, status in summary.items()},
+        'api_calls': api['total_calls'],
+        'api_calls_per_item': round(api['total_calls'] / items, 2) if items else None,
+        'api_calls_by_route': api['calls'],
+        'api_errors': api['errors'],
+        'api_seconds': api['api_seconds'],
+        'decode_seconds': round(decode_seconds, 2),
+        'bifs_written': bifs,
+        'error': error,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sections', type=int, default=1)
+    parser.add_argument('--shows', type=int, default=20)
+    parser.add_argument('--seasons', type=int, default=2)
+    parser.add_argument('--episodes', type=int, default=10, help='episodes per season')
+    parser.add_argument('--previews', type=float, default=0.0, help='fraction of episodes that already have previews')
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every Plex request')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of Plex requests answered with a 500')
+    parser.add_argument('--workers', default='1,2,4', help='decode worker counts to try, comma separated')
+    parser.add_argument('--entry', choices=('run', 'process_item'), default='run')
+    parser.add_argument('--limit', type=int, default=100, help='items to push through process_item')
+    parser.add_argument('--clip', help='video every episode points at, a short synthetic clip is made if not given')
+    parser.add_argument('--clip-seconds', type=int, default=60)
+    parser.add_argument('--variants', default='sd=320x240', help='BIF_VARIANTS, eg: sd=320x240;hd=640x360@3')
+    parser.add_argument('--output', help='write the results JSON here as well as stdout')
+    args = parser.parse_args()
+
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        sys.exit('ffmpeg must be installed and available in PATH')
+
+    work = tempfile.mkdtemp(prefix='bench_e2e_')
+    cwd = os.getcwd()
+    try:
+        clip = os.path.abspath(args.clip) if args.clip else os.path.join(work, 'clip.mp4')
+        if not args.clip:
+            make_clip(ffmpeg, clip, args.clip_seconds)
+        catalog = Catalog(args.sections, args.shows, args.seasons, args.episodes, MEDIA_PREFIX,
+                          duration=args.clip_seconds, size=os.path.getsize(clip), previews=args.previews)
+        media_root = os.path.join(work, 'media')
+        link_media(catalog, clip, media_root)
+        server = FakePlexServer(catalog, latency=args.latency / 1000, error_rate=args.error_rate).start()
+
+        # Anything the script writes relative to the working directory stays in the scratch folder
+        os.chdir(work)
+        script = load_script(server, work, media_root, args.variants)
+        results = {
+            'episodes': catalog.episode_count(),
+            'latency_ms': args.latency,
+            'error_rate': args.error_rate,
+            'entry': args.entry,
+            'variants': args.variants,
+            'runs': [run_once(script, server, catalog, work, int(w), args.entry, args.limit) for w in args.workers.split(',')],
+        }
+        server.shutdown()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
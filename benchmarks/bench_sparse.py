@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Compare full decode against sparse (seek per frame) extraction: wall time and bytes read.
+
+The video is served over a local HTTP server that honours Range requests and counts every byte it
+sends, so ffmpeg reads it the way it would read a remote mount. --latency adds a delay to every
+request to mimic a slow remote (rclone).
+
+    python3 benchmarks/bench_sparse.py movie.mkv --latency 50
+    python3 benchmarks/bench_sparse.py --make-clip 1800 --latency 50
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import video_filter, full_decode_args, run_pipe, extract_sparse, PIPE_OUTPUT  # noqa: E402
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    """Serves a single file with Range support, adding up the bytes sent"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        size = os.path.getsize(server.path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+            else:
+                start = size - int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        with server.lock:
+            server.requests += 1
+        with open(server.path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(1 << 16, remaining))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    # ffmpeg dropped the connection to seek elsewhere
+                    break
+                remaining -= len(chunk)
+                with server.lock:
+                    server.bytes_sent += len(chunk)
+
+
+def serve(path, latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CountingHandler)
+    server.path = path
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.bytes_sent = 0
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_clip(ffmpeg, path, duration, gop):
+    """Synthetic 1080p test clip with a keyframe every `gop` seconds"""
+    subprocess.run([
+        ffmpeg, '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=24',
+        '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast', '-b:v', '8M',
+        '-g', str(int(gop * 24)), path
+    ], check=True)
+
+
+def probe_duration(ffprobe, path):
+    out = subprocess.run([ffprobe, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+                         check=True, stdout=subprocess.PIPE).stdout
+    return float(out.strip())
+
+
+def measure(server, run):
+    server.bytes_sent = 0
+    server.requests = 0
+    start = time.time()
+    frames = run()
+    return {
+        'seconds': round(time.time() - start, 2),
+        'bytes_read': server.bytes_sent,
+        'requests': server.requests,
+        'frames': len(frames),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video', nargs='?', help='video file to benchmark')
+    parser.add_argument('--make-clip', type=int, metavar='SECONDS', help='generate a synthetic clip of this length instead')
+    parser.add_argument('--gop', type=float, default=4, help='keyframe spacing of the synthetic clip (seconds)')
+    parser.add_argument('--interval', type=int, default=5, help='seconds between preview frames')
+    parser.add_argument('--quality', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='seeks in flight at once in sparse mode')
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every HTTP request')
+    args = parser.parse_args()
+
+    ffmpeg, ffprobe = shutil.which('ffmpeg'), shutil.which('ffprobe')
+    if not ffmpeg or not ffprobe:
+        sys.exit('ffmpeg and ffprobe must be installed and available in PATH')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        video = args.video
+        if args.make_clip:
+            video = os.path.join(tmp, 'clip.mp4')
+            make_clip(ffmpeg, video, args.make_clip, args.gop)
+        if not video:
+            parser.error('give a video or --make-clip')
+
+        server = serve(video, args.latency / 1000)
+        url = 'http://127.0.0.1:{}/{}'.format(server.server_address[1], os.path.basename(video))
+        duration = probe_duration(ffprobe, video)
+
+        full_args = full_decode_args(ffmpeg, url, video_filter(args.interval), args.quality, PIPE_OUTPUT)
+        results = {
+            'file': video,
+            'file_size': os.path.getsize(video),
+            'duration': duration,
+            'latency_ms': args.latency,
+            'full': measure(server, lambda: run_pipe(full_args)[0]),
+            'sparse': measure(server, lambda: extract_sparse(ffmpeg, url, duration, args.interval,
+                                                             video_filter(args.interval, fps=False), args.quality,
+                                                             threads=args.threads)),
+        }
+        server.shutdown()
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
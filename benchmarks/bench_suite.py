@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Preview generation benchmark on synthetic media.
+
+Builds test clips with ffmpeg's lavfi sources (H.264/HEVC/AV1, SDR and HDR10-tagged 10 bit, short and
+long), then runs frame extraction + BIF assembly for every clip, mode and worker count, writing
+frames/s, wall time, peak RSS and bytes written as JSON. Results can be saved as a baseline and later
+runs compared against it, exiting non-zero on a regression. With --jpeg-optimize every case is run a
+second time with the JPEG optimizer (needs Pillow), reporting bytes saved and seconds spent re-encoding.
+The segmented mode is a full decode run as --segments ffmpegs at once, each on its own part of the clip.
+Its frames are first checked against a full decode of each clip, a mismatch also exits non-zero.
+
+    python3 benchmarks/bench_suite.py --quick --output results.json --save-baseline baseline.json
+    python3 benchmarks/bench_suite.py --baseline baseline.json
+    python3 benchmarks/bench_suite.py --quick --jpeg-optimize --jpeg-frame-kb 6
+    python3 benchmarks/bench_suite.py --quick --modes full,segmented --workers 1 --segments 4
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bif_writer import BifBuilder  # noqa: E402
+from extraction import video_filter, full_decode_args, run_pipe, extract_sparse, extract_segmented, PIPE_OUTPUT, FULL, SPARSE  # noqa: E402
+from jpeg_optimizer import JpegOptimizer  # noqa: E402
+
+# codec -> encoders to try, in order
+ENCODERS = {
+    'h264': ['libx264'],
+    'hevc': ['libx265'],
+    'av1': ['libsvtav1', 'libaom-av1'],
+}
+ENCODER_ARGS = {
+    'libx264': ['-preset', 'ultrafast'],
+    'libx265': ['-preset', 'ultrafast'],
+    'libsvtav1': ['-preset', '12'],
+    'libaom-av1': ['-cpu-used', '8', '-row-mt', '1'],
+}
+HDR_ARGS = ['-pix_fmt', 'yuv420p10le', '-color_primaries', 'bt2020', '-color_trc', 'smpte2084', '-colorspace', 'bt2020nc']
+SDR_ARGS = ['-pix_fmt', 'yuv420p']
+DURATIONS = {'short': 120, 'long': 7200}
+SEGMENTED = 'segmented'
+
+# Regressions are only reported past this much change
+DEFAULT_TOLERANCE = 0.15
+
+
+def available_encoders(ffmpeg):
+    out = subprocess.run([ffmpeg, '-hide_banner', '-encoders'], stdout=subprocess.PIPE, check=True).stdout.decode()
+    return {line.split()[1] for line in out.splitlines()[1:] if len(line.split()) > 1}
+
+
+def make_clip(ffmpeg, path, encoder, hdr, duration, size, gop):
+    """Synthetic clip from testsrc2, tagged as HDR10 when hdr is set"""
+    if os.path.isfile(path):
+        return path
+    tmp = path + '.part' + os.path.splitext(path)[1]
+    subprocess.run([
+        ffmpeg, '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc2=size={}:rate=24'.format(size),
+        '-t', str(duration), '-c:v', encoder, *ENCODER_ARGS.get(encoder, []), '-g', str(int(gop * 24)),
+        *(HDR_ARGS if hdr else SDR_ARGS), tmp
+    ], check=True)
+    os.rename(tmp, path)
+    return path
+
+
+def peak_rss_mb():
+    """Highest resident set of this process or any ffmpeg it waited on (ru_maxrss is KB on Linux)"""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / 1024, 1)
+
+
+def run_case(ffmpeg, clip, hdr, duration, mode, workers, jobs, interval, quality, out_dir, optimize=None, segments=4):
+    """
+    Extract and build a BIF for `jobs` copies of the clip, `workers` at a time. Runs in a fresh process
+    so the peak RSS is this case's alone.
+    @param optimize JpegOptimizer arguments to shrink the frames with before the BIF is built, None to leave them
+    @param segments parts each extraction is cut into in segmented mode
+    """
+    optimizer = JpegOptimizer(**optimize) if optimize else None
+    optimized = []
+
+    def one(index):
+        if mode == SPARSE:
+            frames = extract_sparse(ffmpeg, clip, duration, interval, video_filter(interval, hdr, fps=False), quality)
+        elif mode == SEGMENTED:
+            frames = extract_segmented(ffmpeg, clip, duration, interval, video_filter(interval, hdr, segment=True), quality, segments)
+        else:
+            frames, returncode, err = run_pipe(full_decode_args(ffmpeg, clip, video_filter(interval, hdr), quality, PIPE_OUTPUT))
+            if returncode != 0:
+                raise RuntimeError(err.decode('utf-8', 'ignore')[-500:])
+        if optimizer is not None:
+            frames, stats = optimizer.optimize(frames, quality)
+            optimized.append(stats)
+        bif = BifBuilder(interval)
+        for frame in frames:
+            bif.add_frame(frame)
+        bif.write(os.path.join(out_dir, 'index-{}.bif'.format(index)))
+        return len(frames), bif.size
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        done = list(pool.map(one, range(jobs)))
+    seconds = time.time() - start
+    frames = sum(f for f, _ in done)
+    case = {
+        'wall_seconds': round(seconds, 2),
+        'frames': frames,
+        'frames_per_second': round(frames / seconds, 2),
+        'peak_rss_mb': peak_rss_mb(),
+        'bytes_written': sum(size for _, size in done),
+    }
+    if optimizer is not None:
+        bytes_in = sum(stats['bytes_in'] for stats in optimized)
+        bytes_out = sum(stats['bytes_out'] for stats in optimized)
+        case.update({
+            'jpeg_bytes_in': bytes_in,
+            'jpeg_bytes_saved': bytes_in - bytes_out,
+            'jpeg_saved_ratio': round(1 - bytes_out / bytes_in, 3) if bytes_in else None,
+            # Summed over jobs, so with several workers it can be more than the wall time
+            'jpeg_seconds': round(sum(stats['seconds'] for stats in optimized), 2),
+        })
+    return case
+
+
+def check_segmented(ffmpeg, clip, hdr, duration, interval, quality, segments):
+    """
+    Extract the clip with a full decode and as segments, the segmented frames should be the same JPEGs in
+    the same order. Frames are compared byte for byte, both runs decode the same keyframes the same way.
+    """
+    full, returncode, err = run_pipe(full_decode_args(ffmpeg, clip, video_filter(interval, hdr), quality, PIPE_OUTPUT))
+    if returncode != 0:
+        raise RuntimeError(err.decode('utf-8', 'ignore')[-500:])
+    segmented = extract_segmented(ffmpeg, clip, duration, interval, video_filter(interval, hdr, segment=True), quality, segments)
+    misplaced = [i for i, (a, b) in enumerate(zip(full, segmented)) if a != b]
+    return {
+        'frames_full': len(full),
+        'frames_segmented': len(segmented),
+        'frames_misplaced': len(misplaced),
+        'first_misplaced': misplaced[0] if misplaced else None,
+        'ok': len(full) == len(segmented) and not misplaced,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    @return list of regression messages: slower frames/s, more memory, or different output size
+    """
+    previous = {case['name']: case for case in baseline.get('cases', [])}
+    regressions = []
+    for case in results['cases']:
+        old = previous.get(case['name'])
+        if old is None:
+            continue
+        if case['frames_per_second'] < old['frames_per_second'] * (1 - tolerance):
+            regressions.append('{}: {} frames/s, was {}'.format(case['name'], case['frames_per_second'], old['frames_per_second']))
+        if case['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions.append('{}: peak RSS {}MB, was {}MB'.format(case['name'], case['peak_rss_mb'], old['peak_rss_mb']))
+        if case['frames'] != old['frames']:
+            regressions.append('{}: {} frames, was {}'.format(case['name'], case['frames'], old['frames']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--codecs', default='h264,hevc,av1')
+    parser.add_argument('--dynamic', default='sdr,hdr', help='sdr, hdr or both')
+    parser.add_argument('--durations', default='short,long', help='short ({short}s), long ({long}s) or both'.format(**DURATIONS))
+    parser.add_argument('--modes', default='{},{}'.format(FULL, SPARSE), help='{}, {} or {}'.format(FULL, SPARSE, SEGMENTED))
+    parser.add_argument('--segments', type=int, default=4, help='parts each clip is decoded as in {} mode'.format(SEGMENTED))
+    parser.add_argument('--workers', default='1,4', help='concurrent extractions to try, comma separated')
+    parser.add_argument('--jobs', type=int, default=4, help='extractions per case')
+    parser.add_argument('--size', default='1280x720', help='clip resolution')
+    parser.add_argument('--gop', type=float, default=4, help='keyframe spacing in seconds')
+    parser.add_argument('--interval', type=int, default=5)
+    parser.add_argument('--quality', type=int, default=2)
+    parser.add_argument('--quick', action='store_true', help='short clips, h264 only')
+    parser.add_argument('--jpeg-optimize', action='store_true', help='also run every case with the JPEG optimizer')
+    parser.add_argument('--jpeg-frame-kb', type=float, default=0, help='JPEG optimizer budget per frame (0 = no cap)')
+    parser.add_argument('--jpeg-bif-kb', type=float, default=0, help='JPEG optimizer budget per BIF (0 = no cap)')
+    parser.add_argument('--jpeg-min-quality', type=int, default=30)
+    parser.add_argument('--jpeg-progressive', action='store_true')
+    parser.add_argument('--jpeg-threads', type=int, default=4)
+    parser.add_argument('--clips', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clips'),
+                        help='where generated clips are kept between runs')
+    parser.add_argument('--output', help='write the results JSON here as well as stdout')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--save-baseline', help='write these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        sys.exit('ffmpeg must be installed and available in PATH')
+    if args.quick:
+        args.codecs, args.durations = 'h264', 'short'
+
+    encoders = available_encoders(ffmpeg)
+    os.makedirs(args.clips, exist_ok=True)
+    out_dir = os.path.join(args.clips, 'out')
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'save_baseline')},
+        'cases': [],
+        'checks': [],
+    }
+    workers = [int(w) for w in args.workers.split(',')]
+    optimize = [None]
+    if args.jpeg_optimize:
+        optimize.append({'frame_budget': int(args.jpeg_frame_kb * 1024), 'bif_budget': int(args.jpeg_bif_kb * 1024),
+                         'min_quality': args.jpeg_min_quality, 'progressive': args.jpeg_progressive, 'workers': args.jpeg_threads})
+    matrix = itertools.product(args.codecs.split(','), args.dynamic.split(','), args.durations.split(','))
+    spawn = multiprocessing.get_context('spawn')
+    try:
+        for codec, dynamic, length in matrix:
+            encoder = next((e for e in ENCODERS[codec] if e in encoders), None)
+            if encoder is None:
+                print('Skipping {}, ffmpeg has none of {}'.format(codec, ', '.join(ENCODERS[codec])), file=sys.stderr)
+                continue
+            hdr = dynamic == 'hdr'
+            duration = DURATIONS[length]
+            clip = make_clip(ffmpeg, os.path.join(args.clips, '{}-{}-{}-{}.mkv'.format(codec, dynamic, length, args.size)),
+                             encoder, hdr, duration, args.size, args.gop)
+            if SEGMENTED in args.modes.split(','):
+                print('Checking {} frames match a full decode'.format(SEGMENTED), file=sys.stderr)
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as isolated:
+                    check = isolated.submit(check_segmented, ffmpeg, clip, hdr, duration, args.interval, args.quality,
+                                            args.segments).result()
+                results['checks'].append({'name': '{}-{}-{}-{}'.format(codec, dynamic, length, SEGMENTED), **check})
+            for mode, worker_count, optimizer in itertools.product(args.modes.split(','), workers, optimize):
+                name = '{}-{}-{}-{}-w{}{}'.format(codec, dynamic, length, mode, worker_count, '-jpeg' if optimizer else '')
+                print('Running {}'.format(name), file=sys.stderr)
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as isolated:
+                    case = isolated.submit(run_case, ffmpeg, clip, hdr, duration, mode, worker_count, args.jobs,
+                                           args.interval, args.quality, out_dir, optimizer, args.segments).result()
+                results['cases'].append({'name': name, 'codec': codec, 'dynamic': dynamic, 'duration': duration,
+                                         'mode': mode, 'workers': worker_count, 'jobs': args.jobs, 'jpeg_optimize': bool(optimizer), **case})
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    for check in results['checks']:
+        if not check['ok']:
+            print('MISMATCH {}: {} frames segmented, {} full, {} misplaced'.format(
+                check['name'], check['frames_segmented'], check['frames_full'], check['frames_misplaced']), file=sys.stderr)
+            failed = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression), file=sys.stderr)
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a Plex server, enough of the API for plexapi and plex_generate_previews:
+the server root, /library/sections, section listings (search by libtype, paged), season children,
+/library/metadata/{ids} and /library/metadata/{ids}/tree (comma separated ids), and /library/onDeck.
+
+Every show section holds `shows` x `seasons` x `episodes` episodes whose MediaParts point at
+`media_prefix`/Show N/Season N/... so the path mappings can send them to synthetic clips. Each request
+can be delayed (latency) or failed with a 500 (error_rate), and every call is counted per route.
+
+    python3 benchmarks/fake_plex.py --shows 500 --seasons 5 --episodes 20 --latency 20 --port 32400
+"""
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import quoteattr
+
+EPISODE_DURATION = 120  # seconds
+EPISODE_SIZE = 150 * 1024 * 1024
+
+
+def _attrs(attrs):
+    return ' '.join('{}={}'.format(k, quoteattr(str(v))) for k, v in attrs.items() if v is not None)
+
+
+class Catalog:
+    """The fake library, every item is worked out from its ratingKey so 50k episodes cost nothing to hold"""
+
+    def __init__(self, sections=1, shows=10, seasons=2, episodes=10, media_prefix='/fake/media',
+                 duration=EPISODE_DURATION, size=EPISODE_SIZE, previews=0.0, seed=0):
+        if shows >= 100000 or seasons > 9 or episodes > 99:
+            raise ValueError('At most 99999 shows, 9 seasons a show and 99 episodes a season')
+        self.sections = sections
+        self.shows = shows
+        self.seasons = seasons
+        self.episodes = episodes
+        self.media_prefix = media_prefix.rstrip('/')
+        self.duration = duration
+        self.size = size
+        self.updated_at = int(time.time())
+        self._section_keys = {}
+        self.touched = {}  # episode key -> updatedAt, for items changed after startup
+        # Episodes that already have preview thumbnails
+        rng = random.Random(seed)
+        self.has_previews = {key for key in self.all_episode_keys() if rng.random() < previews}
+
+    # ratingKeys: section s, show h, season n, episode e, all counted from 1
+    def show_key(self, s, h):
+        return (s * 100000 + h) * 1000
+
+    def season_key(self, s, h, n):
+        return self.show_key(s, h) + n * 100
+
+    def episode_key(self, s, h, n, e):
+        return self.season_key(s, h, n) + e
+
+    def parse_key(self, key):
+        """ratingKey -> (kind, s, h, n, e) or None if there's no such item"""
+        key = int(key)
+        s, rest = divmod(key, 100000 * 1000)
+        h, rest = divmod(rest, 1000)
+        n, e = divmod(rest, 100)
+        if not (1 <= s <= self.sections and 1 <= h <= self.shows and 0 <= n <= self.seasons and 0 <= e <= self.episodes):
+            return None
+        if n == 0:
+            return ('show', s, h, 0, 0) if e == 0 else None
+        if e == 0:
+            return 'season', s, h, n, 0
+        return 'episode', s, h, n, e
+
+    def all_episode_keys(self, section=None):
+        for s in ([section] if section else range(1, self.sections + 1)):
+            for h in range(1, self.shows + 1):
+                for n in range(1, self.seasons + 1):
+                    for e in range(1, self.episodes + 1):
+                        yield self.episode_key(s, h, n, e)
+
+    def stamp(self, key, field):
+        if field == 'updatedAt':
+            return self.touched.get(key, self.updated_at)
+        return self.updated_at
+
+    def touch(self, key):
+        """Mark an episode as updated now, so it shows up in updatedAt>> queries"""
+        self.touched[key] = int(time.time())
+
+    def section_episode_keys(self, section):
+        """Every episode key in a section, built once since plexapi pages through the listing"""
+        if section not in self._section_keys:
+            self._section_keys[section] = list(self.all_episode_keys(section))
+        return self._section_keys[section]
+
+    def episode_count(self):
+        return self.sections * self.shows * self.seasons * self.episodes
+
+    def file(self, s, h, n, e):
+        return '{}/Section {}/Show {}/Season {:02d}/Show {} - S{:02d}E{:02d}.mkv'.format(self.media_prefix, s, h, n, h, n, e)
+
+    def part_hash(self, key):
+        return hashlib.sha1(str(key).encode()).hexdigest()
+
+    def section_xml(self, s):
+        return '<Directory {} />'.format(_attrs({
+            'key': s, 'type': 'show', 'title': 'TV {}'.format(s), 'agent': 'tv.plex.agents.series',
+            'scanner': 'Plex TV Series', 'language': 'en-US', 'uuid': 'fake-section-{}'.format(s),
+            'updatedAt': self.updated_at, 'createdAt': self.updated_at,
+        }))
+
+    def show_xml(self, s, h):
+        key = self.show_key(s, h)
+        return '<Directory {} />'.format(_attrs({
+            'ratingKey': key, 'key': '/library/metadata/{}/children'.format(key), 'type': 'show',
+            'title': 'Show {}'.format(h), 'guid': 'plex://show/fake{}'.format(key), 'librarySectionID': s,
+            'leafCount': self.seasons * self.episodes, 'childCount': self.seasons, 'addedAt': self.updated_at,
+        }))
+
+    def season_xml(self, s, h, n):
+        key = self.season_key(s, h, n)
+        return '<Directory {} />'.format(_attrs({
+            'ratingKey': key, 'key': '/library/metadata/{}/children'.format(key), 'type': 'season',
+            'title': 'Season {}'.format(n), 'index': n, 'parentRatingKey': self.show_key(s, h),
+            'parentKey': '/library/metadata/{}'.format(self.show_key(s, h)), 'parentTitle': 'Show {}'.format(h),
+            'guid': 'plex://season/fake{}'.format(key), 'librarySectionID': s, 'leafCount': self.episodes,
+            'addedAt': self.updated_at,
+        }))
+
+    def episode_xml(self, s, h, n, e):
+        key = self.episode_key(s, h, n, e)
+        part = _attrs({'id': key, 'key': '/library/parts/{}/file.mkv'.format(key), 'file': self.file(s, h, n, e),
+                       'size': self.size, 'duration': self.duration * 1000, 'container': 'mkv',
+                       'indexes': 'sd' if key in self.has_previews else None})
+        return '<Video {}><Media {}><Part {} /></Media></Video>'.format(_attrs({
+            'ratingKey': key, 'key': '/library/metadata/{}'.format(key), 'type': 'episode',
+            'title': 'Episode {}'.format(e), 'index': e, 'parentIndex': n,
+            'parentRatingKey': self.season_key(s, h, n), 'parentKey': '/library/metadata/{}'.format(self.season_key(s, h, n)),
+            'grandparentRatingKey': self.show_key(s, h), 'grandparentKey': '/library/metadata/{}'.format(self.show_key(s, h)),
+            'grandparentTitle': 'Show {}'.format(h), 'guid': 'plex://episode/fake{}'.format(key), 'librarySectionID': s,
+            'duration': self.duration * 1000, 'addedAt': self.updated_at, 'updatedAt': self.stamp(key, 'updatedAt'),
+            'hasPreviewThumbnails': int(key in self.has_previews),
+        }), _attrs({'id': key, 'duration': self.duration * 1000, 'videoCodec': 'h264', 'container': 'mkv'}), part)
+
+    def item_xml(self, key):
+        parsed = self.parse_key(key)
+        if parsed is None:
+            return None
+        kind, s, h, n, e = parsed
+        if kind == 'show':
+            return self.show_xml(s, h)
+        if kind == 'season':
+            return self.season_xml(s, h, n)
+        return self.episode_xml(s, h, n, e)
+
+    def children_xml(self, key):
+        parsed = self.parse_key(key)
+        if parsed is None or parsed[0] == 'episode':
+            return None
+        kind, s, h, n, _ = parsed
+        if kind == 'show':
+            return [self.season_xml(s, h, i) for i in range(1, self.seasons + 1)]
+        return [self.episode_xml(s, h, n, i) for i in range(1, self.episodes + 1)]
+
+    def tree_xml(self, key):
+        """What /library/metadata/{key}/tree returns for one item, MediaParts carry the bundle hash"""
+        parsed = self.parse_key(key)
+        if parsed is None:
+            return None
+        kind, s, h, n, e = parsed
+        keys = [int(key)] if kind == 'episode' else [
+            k for k in self.all_episode_keys(s) if (kind == 'show' and k // 1000 == int(key) // 1000)
+            or (kind == 'season' and k // 100 == int(key) // 100)]
+        items = []
+        for k in keys:
+            _, s, h, n, e = self.parse_key(k)
+            part = _attrs({'id': k, 'hash': self.part_hash(k), 'file': self.file(s, h, n, e), 'size': self.size,
+                           'duration': self.duration * 1000, 'updatedAt': self.updated_at})
+            items.append('<MetadataItem {}><MediaItem {}><MediaPart {} /></MediaItem></MetadataItem>'.format(
+                _attrs({'id': k, 'metadataType': 4, 'title': 'Episode {}'.format(e)}), _attrs({'id': k}), part))
+        if kind == 'episode':
+            return items[0]
+        return '<MetadataItem {}>{}</MetadataItem>'.format(_attrs({'id': key, 'title': kind}), ''.join(items))
+
+
+class FakePlexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        start = time.time()
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        route, status, body = self.route(url.path, params)
+        if status == 200 and server.error_rate and server.rng.random() < server.error_rate:
+            status, body = 500, '<html><body>Internal Server Error</body></html>'
+        time.sleep(server.latency)
+        payload = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml;charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        server.record(route, status, time.time() - start)
+
+    def container(self, items, params, render=None, **attrs):
+        """
+        Wrap items in a MediaContainer, honouring plexapi's X-Plex-Container-Start/Size paging
+        @param render turns each item on the page into XML, so a big listing only renders the page asked for
+        """
+        total = len(items)
+        page_start = int(params.get('X-Plex-Container-Start') or self.headers.get('X-Plex-Container-Start') or 0)
+        page_size = params.get('X-Plex-Container-Size') or self.headers.get('X-Plex-Container-Size')
+        if page_size is not None:
+            items = items[page_start:page_start + int(page_size)]
+        if render is not None:
+            items = [render(item) for item in items]
+        attrs.update({'size': len(items), 'totalSize': total, 'offset': page_start})
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<MediaContainer {}>{}</MediaContainer>'.format(_attrs(attrs), ''.join(items))
+
+    def route(self, path, params):
+        """@return (route name for the stats, status, body)"""
+        catalog = self.server.catalog
+        path = path.rstrip('/') or '/'
+        if path in ('/', '/identity'):
+            return 'root', 200, self.container([], params, machineIdentifier='fake-plex', friendlyName='Fake Plex',
+                                                version='1.40.0.0000-fake', platform='Linux', myPlex=0)
+        if path == '/library':
+            return 'library', 200, self.container(['<Directory key="sections" title="Library Sections" />',
+                                                   '<Directory key="onDeck" title="On Deck" />'], params,
+                                                  identifier='com.plexapp.plugins.library', title1='Plex Library')
+        if path == '/library/sections':
+            return 'sections', 200, self.container([catalog.section_xml(s) for s in range(1, catalog.sections + 1)], params)
+        if path == '/library/onDeck':
+            # The first episode of the first few shows, as if someone were part way through each
+            keys = [catalog.episode_key(1, h, 1, 1) for h in range(1, min(catalog.shows, 20) + 1)]
+            return 'onDeck', 200, self.container([catalog.item_xml(key) for key in keys], params)
+
+        match = re.match(r'^/library/sections/(\d+)/(all|search)$', path)
+        if match:
+            s = int(match.group(1))
+            if not 1 <= s <= catalog.sections:
+                return 'section', 404, ''
+            libtype = params.get('type', '2')
+            if libtype == '4':
+                keys = catalog.section_episode_keys(s)
+                # addedAt>>=T / updatedAt>>=T, as used for "changed since" polling
+                for field in ('addedAt', 'updatedAt'):
+                    if field + '>>' in params:
+                        since = int(params[field + '>>'])
+                        keys = [key for key in keys if catalog.stamp(key, field) > since]
+            elif libtype == '3':
+                keys = [catalog.season_key(s, h, n) for h in range(1, catalog.shows + 1) for n in range(1, catalog.seasons + 1)]
+            else:
+                keys = [catalog.show_key(s, h) for h in range(1, catalog.shows + 1)]
+            return 'section', 200, self.container(keys, params, render=catalog.item_xml, librarySectionID=s)
+
+        match = re.match(r'^/library/metadata/([\d,]+)(/children|/tree)?$', path)
+        if match:
+            keys = [k for k in match.group(1).split(',') if k]
+            if match.group(2) == '/children':
+                children = catalog.children_xml(keys[0])
+                if children is None:
+                    return 'children', 404, ''
+                return 'children', 200, self.container(children, params)
+            if match.group(2) == '/tree':
+                items = [item for item in (catalog.tree_xml(key) for key in keys) if item is not None]
+                if not items:
+                    return 'tree', 404, ''
+                return 'tree', 200, self.container(items, params)
+            items = [item for item in (catalog.item_xml(key) for key in keys) if item is not None]
+            if not items:
+                return 'metadata', 404, ''
+            return 'metadata', 200, self.container(items, params)
+        return 'other', 404, ''
+
+
+class FakePlexServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__((host, port), FakePlexHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.errors = 0
+            self.busy_seconds = 0.0
+
+    def record(self, route, status, seconds):
+        with self.lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+            self.errors += status >= 500
+            self.busy_seconds += seconds
+
+    def stats(self):
+        """Calls per route, 5xx responses, and seconds spent answering (latency included)"""
+        with self.lock:
+            return {'calls': dict(self.calls), 'total_calls': sum(self.calls.values()), 'errors': self.errors,
+                    'api_seconds': round(self.busy_seconds, 2)}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sections', type=int, default=1)
+    parser.add_argument('--shows', type=int, default=10)
+    parser.add_argument('--seasons', type=int, default=2)
+    parser.add_argument('--episodes', type=int, default=10, help='episodes per season')
+    parser.add_argument('--previews', type=float, default=0.0, help='fraction of episodes that already have previews')
+    parser.add_argument('--media-prefix', default='/fake/media', help='where Plex "sees" the media files')
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every request')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with a 500')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=32400)
+    args = parser.parse_args()
+
+    catalog = Catalog(args.sections, args.shows, args.seasons, args.episodes, args.media_prefix, previews=args.previews)
+    server = FakePlexServer(catalog, args.host, args.port, args.latency / 1000, args.error_rate)
+    print('Fake Plex with {} episodes on {}'.format(catalog.episode_count(), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(server.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import filecmp
+import itertools
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+
+def atomic_copy(src, dest, link=False):
+    """
+    Copy src to dest through a temporary name in the same folder, so dest is never seen half written
+    @param link try a hard link first, falling back to a copy when src is on another filesystem
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = '{}.tmp-{}-{}'.format(dest, os.getpid(), threading.get_ident())
+    try:
+        if link:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                link = False
+        if not link:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def gather(count, on_done):
+    """on_done callback for `count` publishes, calls on_done once with the errors of all of them"""
+    lock = threading.Lock()
+    left = [count]
+    errors = []
+
+    def done(publish_errors):
+        with lock:
+            errors.extend(publish_errors)
+            left[0] -= 1
+            if left[0]:
+                return
+        on_done(errors)
+    return done
+
+
+class BifPublisher:
+    """
+    Write-behind publishing of finished BIFs. publish() writes the BIF to a local staging folder and
+    returns straight away, a small thread pool then copies it to every target root (the Plex bundle
+    store and any mirror servers) under a temporary name and renames it into place, so a crash never
+    leaves a truncated index-sd.bif behind that looks finished. Targets that already hold an identical
+    file are skipped. A copy that fails is put back in the queue after `retry_delay` seconds, up to
+    `retries` times, without holding up a worker meanwhile.
+    """
+
+    def __init__(self, targets, stage_dir, workers=2, retries=3, retry_delay=30):
+        self.targets = [t for t in targets if t]
+        self.stage_dir = stage_dir
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.cond = threading.Condition()
+        self.pending = 0  # BIFs not finished with every target yet
+        self.ids = itertools.count()
+        self.copied = 0
+        self.skipped = 0
+        self.retried = 0
+
+    def publish(self, relpath, bif, on_done=None):
+        """
+        Stage a BIF and queue it for every target
+        @param relpath where the BIF goes under each target root, eg: 'a/bcdef.bundle/Contents/Indexes/index-sd.bif'
+        @param bif BifBuilder holding the frames, or the path of a finished .bif to link/copy out (left in place)
+        @param on_done called (on a publisher thread) with the list of errors, empty if every target has the file
+        """
+        if isinstance(bif, str):
+            staged, keep = bif, True
+        else:
+            os.makedirs(self.stage_dir, exist_ok=True)
+            staged, keep = os.path.join(self.stage_dir, '{}-{}'.format(next(self.ids), relpath.replace('/', '_').replace('\\', '_'))), False
+            bif.write(staged)
+        item = {'relpath': relpath, 'staged': staged, 'keep': keep, 'left': len(self.targets), 'errors': [], 'on_done': on_done}
+        with self.cond:
+            self.pending += 1
+        if not self.targets:
+            self._finish(item)
+        for root in self.targets:
+            self.pool.submit(self._copy, item, root, 0)
+
+    def _copy(self, item, root, attempt):
+        dest = os.path.join(root, item['relpath'])
+        outcome = 'skipped'
+        try:
+            if not (os.path.isfile(dest) and filecmp.cmp(item['staged'], dest, shallow=False)):
+                atomic_copy(item['staged'], dest, link=item['keep'])
+                outcome = 'copied'
+        except Exception as e:
+            if attempt < self.retries:
+                logger.warning('Error publishing {}, retrying in {} seconds. `{}:{}`'.format(dest, self.retry_delay, type(e).__name__, str(e)))
+                with self.cond:
+                    self.retried += 1
+                timer = threading.Timer(self.retry_delay, self.pool.submit, args=(self._copy, item, root, attempt + 1))
+                timer.daemon = True
+                timer.start()
+                return
+            logger.error('Error publishing {}, giving up. `{}:{}`'.format(dest, type(e).__name__, str(e)))
+            item['errors'].append('{}: {}'.format(dest, str(e)))
+            outcome = None
+
+        with self.cond:
+            if outcome:
+                setattr(self, outcome, getattr(self, outcome) + 1)
+            item['left'] -= 1
+            if item['left'] > 0:
+                return
+        self._finish(item)
+
+    def _finish(self, item):
+        if not item['keep']:
+            try:
+                os.remove(item['staged'])
+            except OSError:
+                pass
+        try:
+            if item['on_done']:
+                item['on_done'](item['errors'])
+        except Exception as e:
+            logger.error('Error recording publish of {}. `{}:{}`'.format(item['relpath'], type(e).__name__, str(e)))
+        finally:
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
+
+    def drain(self):
+        """Wait until every BIF published so far is on every target (or has run out of retries)"""
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+
+    def close(self):
+        self.drain()
+        self.pool.shutdown()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Integrity check of every BIF in a Plex bundle store, writing the broken ones out as a repair list
+(JSON lines). plex_generate_previews.py runs the same check with runType = "Repair" and regenerates them.
+
+    python3 bif_scanner.py "/path/to/Plex Media Server/Media/localhost" --output repair.jsonl
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bif_writer import BIF_MAGIC, BIF_VERSION, BIF_HEADER_SIZE
+
+CHUNK_SIZE = 64  # BIFs checked per task
+
+
+def check_bif(path):
+    """
+    Check a BIF's header and index without reading the frames: magic, version, frame count, offset
+    table and that the file is as long as the index says. Only the header and index pages are mapped in.
+    @return None if it looks whole, otherwise what's wrong with it
+    """
+    try:
+        size = os.path.getsize(path)
+        if size < BIF_HEADER_SIZE + 8:
+            return 'truncated header, {} bytes'.format(size)
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:8] != bytes(BIF_MAGIC):
+                return 'bad magic'
+            version, count = struct.unpack_from('<II', m, 8)
+            if version != BIF_VERSION:
+                return 'unknown version {}'.format(version)
+            if count == 0:
+                return 'no frames'
+            index_end = BIF_HEADER_SIZE + 8 * (count + 1)
+            if index_end > size:
+                return 'truncated index, {} frames need {} bytes, file is {}'.format(count, index_end, size)
+            index = struct.unpack_from('<{}I'.format(2 * (count + 1)), m, BIF_HEADER_SIZE)
+    except (OSError, ValueError) as e:
+        return '{}: {}'.format(type(e).__name__, str(e))
+
+    offsets = index[1::2]
+    if index[-2] != 0xffffffff:
+        return 'index not terminated'
+    if offsets[0] != index_end:
+        return 'first frame at {}, expected {}'.format(offsets[0], index_end)
+    if any(following < offset for offset, following in zip(offsets, offsets[1:])):
+        return 'frame offsets out of order'
+    if offsets[-1] != size:
+        return 'payload truncated, index ends at {}, file is {}'.format(offsets[-1], size)
+    return None
+
+
+def bundle_hash(bundle_path):
+    """'.../a/bcdef.bundle' -> 'abcdef'"""
+    prefix, name = os.path.split(os.path.normpath(bundle_path))
+    return os.path.basename(prefix) + name[:-len('.bundle')]
+
+
+def bundle_root(root):
+    """Accept the Media folder as well as Media/localhost"""
+    if os.path.isdir(os.path.join(root, 'localhost')):
+        return os.path.join(root, 'localhost')
+    return root
+
+
+def list_prefixes(root):
+    """The hash prefix folders (0-f) of a bundle store"""
+    with os.scandir(root) as entries:
+        return [entry.path for entry in entries if entry.is_dir() and not entry.name.endswith('.bundle')]
+
+
+def list_bundles(prefix):
+    """Paths of the bundles in one prefix folder"""
+    with os.scandir(prefix) as entries:
+        return [entry.path for entry in entries if entry.name.endswith('.bundle')]
+
+
+def list_indexes(bundle_path):
+    """Names of the files in a bundle's Contents/Indexes, None if it has no Indexes folder"""
+    try:
+        with os.scandir(os.path.join(bundle_path, 'Contents', 'Indexes')) as indexes:
+            return [index.name for index in indexes]
+    except OSError:
+        return None
+
+
+class BifScanner:
+    """
+    Walks root/<prefix>/<hash>.bundle/Contents/Indexes/*.bif with os.scandir, listing the prefix
+    folders in parallel and checking the BIFs in chunks on the same thread pool, so on a network share
+    many requests are in flight at once.
+    """
+
+    def __init__(self, root, workers=32):
+        self.root = bundle_root(root)
+        self.workers = max(1, workers)
+
+    def _list_prefix(self, prefix):
+        """Every BIF under one prefix folder, and how many bundles it has"""
+        try:
+            bundles = list_bundles(prefix)
+        except OSError:
+            return [], 0
+        bifs = []
+        for bundle in bundles:
+            names = list_indexes(bundle) or []
+            indexes = os.path.join(bundle, 'Contents', 'Indexes')
+            bifs += [(bundle, os.path.join(indexes, name)) for name in names if name.endswith('.bif')]
+        return bifs, len(bundles)
+
+    @staticmethod
+    def _check_chunk(chunk):
+        results = []
+        for bundle_path, path in chunk:
+            problem = check_bif(path)
+            if problem:
+                results.append({'bundle_hash': bundle_hash(bundle_path), 'path': path, 'problem': problem})
+        return len(chunk), results
+
+    def scan(self):
+        """
+        @return dict of bundles and bifs seen, seconds taken, and the broken BIFs as
+        [{'bundle_hash', 'path', 'problem'}]
+        """
+        start = time.time()
+        prefixes = list_prefixes(self.root)
+
+        report = {'bundles': 0, 'bifs': 0, 'broken': []}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            checks = []
+            for bifs, bundles in pool.map(self._list_prefix, prefixes):
+                report['bundles'] += bundles
+                for i in range(0, len(bifs), CHUNK_SIZE):
+                    checks.append(pool.submit(self._check_chunk, bifs[i:i + CHUNK_SIZE]))
+            for check in checks:
+                count, broken = check.result()
+                report['bifs'] += count
+                report['broken'] += broken
+        report['seconds'] = round(time.time() - start, 2)
+        return report
+
+
+def write_repair_list(path, broken):
+    with open(path, 'w') as f:
+        for entry in broken:
+            f.write(json.dumps(entry) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', help='the Plex Media (or Media/localhost) folder')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--output', help='write the repair list here')
+    args = parser.parse_args()
+
+    report = BifScanner(args.root, workers=args.workers).scan()
+    if args.output:
+        write_repair_list(args.output, report['broken'])
+    for entry in report['broken']:
+        print('{}: {}'.format(entry['path'], entry['problem']))
+    print('{} BIFs in {} bundles checked in {}s ({:.0f}/s), {} broken'.format(
+        report['bifs'], report['bundles'], report['seconds'], report['bifs'] / max(report['seconds'], 1e-6), len(report['broken'])))
+
+
+if __name__ == '__main__':
+    main()
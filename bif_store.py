@@ -0,0 +1,75 @@
+import hashlib
+import os
+import threading
+
+FINGERPRINT_VERSION = 1
+
+
+def fingerprint(path, size=None, salt='', samples=8, chunk_size=1 << 16):
+    """
+    Cheap identity for a media file that doesn't depend on which server or bundle it's in: the size plus
+    a hash of `samples` chunks spread evenly through the file (first and last included), so a multi GB
+    file is recognised from half a MB of reads
+    @param size file size if already known (eg: from Plex), saves a stat
+    @param salt settings the BIF depends on (eg: interval and quality), so changing them misses the store
+    @return hex digest
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    digest = hashlib.sha1('{}:{}:{}'.format(FINGERPRINT_VERSION, size, salt).encode())
+    with open(path, 'rb') as f:
+        if size <= samples * chunk_size:
+            digest.update(f.read())
+        else:
+            step = (size - chunk_size) // (samples - 1)
+            for i in range(samples):
+                f.seek(i * step)
+                digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+class BifStore:
+    """
+    Local store of every BIF generated, keyed by the fingerprint of the media file it was made from.
+    When a library is rebuilt, or a second server has the same file under a different bundle hash,
+    the preview is linked or copied out of here instead of decoding the file again.
+    Files are written under a temporary name and renamed into place, so a stored BIF is always whole.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.bif')
+
+    def get(self, key):
+        """Path of the stored BIF for a fingerprint, or None"""
+        path = self.path(key)
+        found = os.path.isfile(path)
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path if found else None
+
+    def put(self, key, bif):
+        """
+        Store a BIF
+        @param bif BifBuilder holding the frames
+        @return path of the stored file
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.tmp-{}-{}'.format(path, os.getpid(), threading.get_ident())
+        try:
+            bif.write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return path
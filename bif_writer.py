@@ -0,0 +1,124 @@
+import struct
+
+BIF_MAGIC = [0x89, 0x42, 0x49, 0x46, 0x0d, 0x0a, 0x1a, 0x0a]
+BIF_VERSION = 0
+BIF_HEADER_SIZE = 64
+
+JPEG_SOI = b'\xff\xd8'
+
+
+def jpeg_length(buf):
+    """
+    Work out where the JPEG at the start of buf ends by walking its marker segments
+    @param buf bytes/bytearray starting with a JPEG SOI marker
+    @return length of the JPEG in bytes, or 0 if buf does not hold the whole image yet
+    """
+    if len(buf) < 2:
+        return 0
+    if buf[0:2] != JPEG_SOI:
+        raise ValueError('Expected a JPEG SOI marker, stream is not MJPEG')
+
+    pos = 2
+    size = len(buf)
+    while pos + 2 <= size:
+        if buf[pos] != 0xFF:
+            raise ValueError('Corrupt JPEG, expected a marker at offset {}'.format(pos))
+        marker = buf[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0xD9:  # EOI
+            return pos + 2
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # Markers without a length
+            pos += 2
+            continue
+        if pos + 4 > size:
+            return 0
+        pos += 2 + struct.unpack_from('>H', buf, pos + 2)[0]
+
+        if marker == 0xDA:  # SOS, skip the entropy coded data up to the next real marker
+            while True:
+                pos = buf.find(b'\xff', pos)
+                if pos == -1 or pos + 1 >= size:
+                    return 0
+                following = buf[pos + 1]
+                if following == 0x00 or 0xD0 <= following <= 0xD7:  # Stuffed byte or restart marker
+                    pos += 2
+                elif following == 0xFF:
+                    pos += 1
+                else:
+                    break
+    return 0
+
+
+def split_mjpeg(stream, chunk_size=1 << 16):
+    """
+    Split a concatenated MJPEG stream (ffmpeg `-f image2pipe -c:v mjpeg`) into individual JPEGs
+    @param stream file like object to read from, eg: the stdout of ffmpeg
+    @param chunk_size number of bytes to read at a time
+    """
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+        while True:
+            length = jpeg_length(buffer)
+            if not length:
+                break
+            yield bytes(buffer[:length])
+            del buffer[:length]
+
+    if buffer:
+        raise ValueError('MJPEG stream ended with {} bytes of an incomplete frame'.format(len(buffer)))
+
+
+class BifBuilder:
+    """
+    Collects JPEG frames in memory, recording their offsets as they arrive, so the index and
+    payload of the .bif can be written out in a single pass
+    """
+
+    def __init__(self, frame_interval):
+        self.frame_interval = frame_interval
+        self.frames = []
+        self.offsets = []
+        self.payload_size = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add_frame(self, data):
+        self.offsets.append(self.payload_size)
+        self.frames.append(data)
+        self.payload_size += len(data)
+
+    def feed(self, stream):
+        """Add every frame found in an MJPEG stream"""
+        for frame in split_mjpeg(stream):
+            self.add_frame(frame)
+
+    @property
+    def size(self):
+        return BIF_HEADER_SIZE + 8 + (8 * len(self.frames)) + self.payload_size
+
+    def header(self):
+        """The fixed 64 byte header followed by the index table"""
+        header = bytes(BIF_MAGIC)
+        header += struct.pack("<I", BIF_VERSION)
+        header += struct.pack("<I", len(self.frames))
+        header += struct.pack("<I", int(1000 * self.frame_interval))
+        header += bytes(BIF_HEADER_SIZE - len(header))
+
+        payload_start = BIF_HEADER_SIZE + 8 + (8 * len(self.frames))
+        index = []
+        for timestamp, offset in enumerate(self.offsets):
+            index.extend((timestamp, payload_start + offset))
+        index.extend((0xffffffff, payload_start + self.payload_size))
+        return header + struct.pack('<{}I'.format(len(index)), *index)
+
+    def write(self, bif_filename):
+        with open(bif_filename, 'wb') as f:
+            f.write(self.header())
+            f.writelines(self.frames)
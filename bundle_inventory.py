@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bif_scanner import bundle_root, bundle_hash, list_prefixes, list_bundles, list_indexes
+
+NO_INDEXES = 0  # Bundle without a Contents/Indexes folder
+INDEXES = 1  # Indexes folder, but no preview in it
+PREVIEW = 2
+
+CHUNK_SIZE = 64  # Bundles checked per task
+
+
+class BundleInventory:
+    """
+    Which bundles in a Plex bundle store already have a preview, listed with os.scandir up front so the
+    per item check is a dict lookup instead of a stat on the share. The prefix folders are listed in
+    parallel and the bundles' Indexes folders checked in chunks on the same thread pool.
+    refresh() is incremental: a prefix folder is only listed again when its mtime moved (a bundle was
+    added or removed), and only bundles without a preview are looked at again. A preview removed from a
+    bundle that had one isn't noticed, call discard() for those.
+    """
+
+    def __init__(self, root, workers=16, index_name='index-sd.bif'):
+        self.root = bundle_root(root)
+        self.workers = max(1, workers)
+        self.index_name = index_name
+        self.lock = threading.Lock()
+        self.state = {}  # bundle hash -> NO_INDEXES, INDEXES or PREVIEW
+        self.prefixes = {}  # prefix folder -> (mtime, bundle hashes in it)
+
+    def __getstate__(self):
+        # Handed to pool workers as it stands, they only read it
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def has_preview(self, bundle_hash):
+        """@return True/False, None if the bundle wasn't there at the last refresh"""
+        state = self.state.get(bundle_hash)
+        return None if state is None else state == PREVIEW
+
+    def has_indexes(self, bundle_hash):
+        """@return True/False, None if the bundle wasn't there at the last refresh"""
+        state = self.state.get(bundle_hash)
+        return None if state is None else state != NO_INDEXES
+
+    def add(self, bundle_hash):
+        """Record a preview written since the last refresh"""
+        with self.lock:
+            self.state[bundle_hash] = PREVIEW
+
+    def discard(self, bundle_hash):
+        """Record a preview removed (eg: moved aside for repair)"""
+        with self.lock:
+            if bundle_hash in self.state:
+                self.state[bundle_hash] = INDEXES
+
+    def _list_prefix(self, prefix):
+        """
+        @return (prefix, mtime, {hash: bundle path} in it, whether it was listed), mtime None if it's gone
+        """
+        try:
+            mtime = os.stat(prefix).st_mtime
+        except OSError:
+            return prefix, None, {}, False
+        known = self.prefixes.get(prefix)
+        if known is not None and known[0] == mtime:
+            name = os.path.basename(prefix)
+            return prefix, mtime, {h: os.path.join(prefix, h[len(name):] + '.bundle') for h in known[1]}, False
+        try:
+            bundles = list_bundles(prefix)
+        except OSError:
+            return prefix, None, {}, False
+        return prefix, mtime, {bundle_hash(path): path for path in bundles}, True
+
+    def _check_chunk(self, chunk):
+        results = {}
+        for key, path in chunk:
+            names = list_indexes(path)
+            if names is None:
+                results[key] = NO_INDEXES
+            else:
+                results[key] = PREVIEW if self.index_name in names else INDEXES
+        return results
+
+    def refresh(self):
+        """
+        List what changed since the last refresh, the first one lists everything
+        @return dict of bundles, previews, prefix folders listed, bundles checked and seconds taken
+        """
+        start = time.time()
+        try:
+            prefixes = list_prefixes(self.root)
+        except OSError:
+            prefixes = []
+        listed = 0
+        updates = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            found = {}
+            checks = []
+            for prefix, mtime, bundles, relisted in pool.map(self._list_prefix, prefixes):
+                if mtime is None:
+                    continue
+                listed += relisted
+                found[prefix] = (mtime, set(bundles))
+                todo = [(key, path) for key, path in bundles.items() if self.state.get(key) != PREVIEW]
+                for i in range(0, len(todo), CHUNK_SIZE):
+                    checks.append(pool.submit(self._check_chunk, todo[i:i + CHUNK_SIZE]))
+            for check in checks:
+                updates.update(check.result())
+
+        with self.lock:
+            for prefix, (mtime, bundles) in list(self.prefixes.items()):
+                gone = bundles - found[prefix][1] if prefix in found else bundles
+                for key in gone:
+                    self.state.pop(key, None)
+            for key, state in updates.items():
+                # A preview published while the refresh ran stays recorded
+                self.state[key] = max(state, self.state.get(key, NO_INDEXES))
+            self.prefixes = found
+            previews = sum(1 for state in self.state.values() if state == PREVIEW)
+        return {'bundles': len(self.state), 'previews': previews, 'listed': listed, 'checked': len(updates),
+                'seconds': round(time.time() - start, 2)}
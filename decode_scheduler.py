@@ -0,0 +1,187 @@
+import threading
+import time
+
+CPU = 'cpu'
+
+
+class NvidiaBackend:
+    """Looks up the NVIDIA GPUs once with gpustat, instead of polling it before every job"""
+
+    def devices(self):
+        try:
+            import gpustat
+            return ['cuda:{}'.format(gpu.index) for gpu in gpustat.core.new_query()]
+        except Exception:
+            # No driver / no GPU
+            return []
+
+
+class FakeGpuBackend:
+    """Pretends to have `count` GPUs, for testing the scheduler and pipeline without one"""
+
+    def __init__(self, count=1):
+        self.count = count
+
+    def devices(self):
+        return ['cuda:{}'.format(i) for i in range(self.count)]
+
+
+class NoGpuBackend:
+    def devices(self):
+        return []
+
+
+def make_backend(name):
+    """
+    Build a device backend from its config name
+    @param name 'nvidia', 'none', or 'fake:N' for N pretend GPUs
+    """
+    name = (name or 'nvidia').lower()
+    if name == 'nvidia':
+        return NvidiaBackend()
+    if name == 'none':
+        return NoGpuBackend()
+    if name.startswith('fake'):
+        _, _, count = name.partition(':')
+        return FakeGpuBackend(int(count or 1))
+    raise ValueError('Unknown GPU backend {}'.format(name))
+
+
+def device_index(device):
+    """'cuda:1' -> '1'"""
+    return device.partition(':')[2]
+
+
+class _Device:
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = slots
+        self.initial_slots = slots
+        self.busy = 0
+        self.jobs = 0
+        self.busy_seconds = 0.0
+        self.started = {}
+
+
+class DecodeScheduler:
+    """
+    Owns the decode slot tokens for every device. A job is given a device when it is dispatched and
+    hands the slot back when its decode finishes, so workers never race each other over a GPU.
+    GPU slots are preferred, CPU slots are used once every GPU slot is busy.
+    """
+
+    def __init__(self, backend, gpu_slots, cpu_slots):
+        self.lock = threading.Lock()
+        self.created = time.time()
+        self.waiting = 0
+        self.devices = {}
+        self.slot_limit = None  # Most slots add_slot() may take the scheduler to, sizes the worker pool
+
+        gpus = backend.devices() if gpu_slots > 0 else []
+        if gpus:
+            # Spread the GPU slots over every card found
+            for i, gpu in enumerate(gpus):
+                slots = gpu_slots // len(gpus) + (1 if i < gpu_slots % len(gpus) else 0)
+                if slots:
+                    self.devices[gpu] = _Device(gpu, slots)
+        else:
+            # No GPU, so every worker decodes on the CPU
+            cpu_slots += gpu_slots
+        if cpu_slots > 0 or not self.devices:
+            self.devices[CPU] = _Device(CPU, max(1, cpu_slots))
+
+    @property
+    def total_slots(self):
+        return sum(device.slots for device in self.devices.values())
+
+    @property
+    def pool_size(self):
+        """Worker processes needed to run every slot the scheduler may ever hand out"""
+        return max(self.total_slots, self.slot_limit or 0)
+
+    def busy_slots(self):
+        with self.lock:
+            return sum(device.busy for device in self.devices.values())
+
+    def add_slot(self):
+        """
+        One more slot, on the device furthest below its starting share so the GPU/CPU mix is kept
+        @return the device that got it, None if slot_limit is reached
+        """
+        with self.lock:
+            if self.slot_limit and self.total_slots >= self.slot_limit:
+                return None
+            device = min(self.devices.values(), key=lambda d: d.slots / d.initial_slots)
+            device.slots += 1
+            return device.name
+
+    def remove_slot(self):
+        """
+        One slot less, from the device furthest above its starting share. A busy slot finishes its job first.
+        @return the device that lost it, None if only one slot is left
+        """
+        with self.lock:
+            if self.total_slots <= 1:
+                return None
+            device = max((d for d in self.devices.values() if d.slots > 0), key=lambda d: d.slots / d.initial_slots)
+            device.slots -= 1
+            return device.name
+
+    def set_waiting(self, count):
+        """Number of jobs queued up waiting for a slot, reported by the pipeline"""
+        self.waiting = count
+
+    def try_acquire(self):
+        """
+        Take a slot if one is free
+        @return the device name ('cuda:N' or 'cpu') and a token to hand back to release(), or (None, None)
+        """
+        with self.lock:
+            for device in self.devices.values():
+                if device.busy < device.slots:
+                    device.busy += 1
+                    device.jobs += 1
+                    token = object()
+                    device.started[token] = time.time()
+                    return device.name, token
+        return None, None
+
+    def try_acquire_more(self, device_name, count):
+        """
+        Take up to `count` more free slots on a device, for a job that can use several at once
+        @return list of tokens to hand back to release(), one per slot taken
+        """
+        tokens = []
+        with self.lock:
+            device = self.devices[device_name]
+            while len(tokens) < count and device.busy < device.slots:
+                device.busy += 1
+                token = object()
+                device.started[token] = time.time()
+                tokens.append(token)
+        return tokens
+
+    def release(self, device_name, token):
+        with self.lock:
+            device = self.devices[device_name]
+            device.busy -= 1
+            device.busy_seconds += time.time() - device.started.pop(token)
+
+    def stats(self):
+        """
+        Jobs queued for a slot (any device takes the next one), plus per device slots, busy slots,
+        jobs dispatched and utilisation (0-1) since the scheduler was created
+        """
+        now = time.time()
+        elapsed = max(now - self.created, 1e-6)
+        with self.lock:
+            devices = {}
+            for device in self.devices.values():
+                busy_seconds = device.busy_seconds + sum(now - started for started in device.started.values())
+                devices[device.name] = {
+                    'slots': device.slots,
+                    'busy': device.busy,
+                    'jobs': device.jobs,
+                    'utilisation': round(busy_seconds / (elapsed * device.slots), 3),
+                }
+        return {'queue_depth': self.waiting, 'devices': devices}
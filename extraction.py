@@ -0,0 +1,447 @@
+import math
+import os
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bif_writer import split_mjpeg
+from decode_scheduler import CPU, device_index
+
+
+
+def scale_filter(width, height):
+    return "scale=w={}:h={}:force_original_aspect_ratio=decrease".format(width, height)
+
+
+def pipe_output(fd=1):
+    """Output args for MJPEG on a pipe, stdout or one from open_pipes()"""
+    return ["-f", "image2pipe", "-c:v", "mjpeg", "pipe:{}".format(fd)]
+
+
+SCALE_FILTER = scale_filter(320, 240)
+TONEMAP_FILTER = "zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p"
+PIPE_OUTPUT = pipe_output(1)
+# Outputs past stdout are extra pipes handed to ffmpeg with pass_fds, which Windows doesn't have
+MULTI_PIPE = os.name != 'nt'
+# Machine readable progress on stderr (key=value lines, a block every half second) instead of the stats line
+PROGRESS_ARGS = ["-progress", "pipe:2", "-nostats"]
+
+FULL = 'full'
+SPARSE = 'sparse'
+AUTO = 'auto'
+
+
+def parse_variants(spec, quality):
+    """
+    'sd=320x240;hd=640x360@3' -> [{'name': 'sd', 'width': 320, 'height': 240, 'quality': quality}, ...]
+    Each variant is written as index-<name>.bif, a quality after @ overrides the default
+    """
+    variants = []
+    for entry in filter(None, (part.strip() for part in spec.split(';'))):
+        name, _, size = entry.partition('=')
+        size, _, variant_quality = size.partition('@')
+        width, _, height = size.lower().partition('x')
+        variants.append({'name': name.strip(), 'width': int(width), 'height': int(height),
+                         'quality': int(variant_quality) if variant_quality else quality})
+    if not variants:
+        raise ValueError('No preview variants in {!r}'.format(spec))
+    return variants
+
+
+def video_filter(interval, hdr=False, fps=True, scale=SCALE_FILTER, segment=False):
+    """
+    The -vf chain for the preview frames
+    @param fps include the fps filter that picks one frame per interval (not wanted when seeking to each frame)
+    @param scale the scale filter, None to leave it off
+    @param segment the input is a segment cut with segment_args, so the frames start at 0 (the keyframe the seek
+    landed on, at or before it, fills the first one)
+    """
+    filters = []
+    if fps:
+        filters.append("fps=fps={}:round=up{}".format(round(1 / interval, 6), ':start_time=0' if segment else ''))
+    if hdr:
+        filters.append(TONEMAP_FILTER)
+    if scale:
+        filters.append(scale)
+    return ','.join(filters)
+
+
+def split_filter(interval, variants, hdr=False, fps=True, segment=False):
+    """
+    -filter_complex graph that picks and tone maps the frames once, then splits them into a scaled copy
+    per variant, labelled [v0], [v1]... in the order of variants
+    """
+    head = video_filter(interval, hdr, fps, scale=None, segment=segment)
+    splits = ''.join('[s{}]'.format(i) for i in range(len(variants)))
+    graph = ['[0:v]{}split={}{}'.format(head + ',' if head else '', len(variants), splits)]
+    for i, variant in enumerate(variants):
+        graph.append('[s{0}]{1}[v{0}]'.format(i, scale_filter(variant['width'], variant['height'])))
+    return ';'.join(graph)
+
+
+def hwaccel_args(device):
+    if device is None or device == CPU:
+        return []
+    return ["-hwaccel", "cuda", "-hwaccel_device", device_index(device)]
+
+
+def plan_segments(duration, interval, count):
+    """
+    Cut a video into `count` segments for decoding in parallel, each starting on a frame timestamp so the
+    frames line up with a full decode
+    @return list of (start seconds, length seconds, frames), empty when it isn't worth splitting
+    """
+    frames = len(frame_timestamps(duration, interval))
+    per_segment = math.ceil(frames / max(1, count))
+    if count < 2 or per_segment < 2:
+        return []
+    return [(first * interval, per_segment * interval, min(per_segment, frames - first))
+            for first in range(0, frames, per_segment)]
+
+
+def segment_args(segment):
+    """Input args that start reading one (start, length, frames) segment at the keyframe at or before start"""
+    if segment is None:
+        return []
+    return ["-noaccurate_seek", "-ss", "{:.3f}".format(segment[0])]
+
+
+def segment_limit(segment):
+    """
+    Output args that end a segment after its frames. Counting frames rather than reading for its length
+    (-t) keeps the last one right whatever the keyframe spacing, -t runs from the keyframe the seek landed on.
+    """
+    if segment is None:
+        return []
+    return ["-frames:v", str(segment[2])]
+
+
+def fit_segment(frames, count, last=False):
+    """
+    A segment's frames trimmed or padded (repeating the last) to the count plan_segments gave it, so the
+    segments stitch into one correctly timed run. The last segment is only trimmed, it ends where the
+    video does like a full decode (which has no frame for a timestamp past the last keyframe).
+    """
+    if not frames or last:
+        return frames[:count]
+    return frames[:count] + [frames[-1]] * (count - len(frames))
+
+
+def full_decode_args(ffmpeg, video_file, vf, quality, output, device=None, progress=False, segment=None):
+    """
+    ffmpeg args that decode the whole video, keeping one keyframe per interval
+    @param progress have ffmpeg report its progress as key=value blocks on stderr, see run_pipe
+    @param segment (start, length, frames) from plan_segments to decode just that part, with video_filter(segment=True)
+    """
+    return [
+        ffmpeg, "-loglevel", "info", *(PROGRESS_ARGS if progress else []),
+        "-skip_frame:v", "nokey", *hwaccel_args(device), "-threads:0", "1", *segment_args(segment), "-i",
+        video_file, "-an", "-sn", "-dn", "-q:v", str(quality),
+        "-vf",
+        vf, *segment_limit(segment), *output
+    ]
+
+
+def split_decode_args(ffmpeg, video_file, graph, outputs, device=None, progress=False, segment=None):
+    """
+    ffmpeg args that decode the whole video once and encode every output of a split_filter graph
+    @param outputs (quality, output args) for each label of the graph, in order
+    """
+    return [
+        ffmpeg, "-loglevel", "info", *(PROGRESS_ARGS if progress else []),
+        "-skip_frame:v", "nokey", *hwaccel_args(device), "-threads:0", "1", *segment_args(segment), "-i",
+        video_file, "-filter_complex", graph,
+        *[arg for i, (quality, output) in enumerate(outputs)
+          for arg in ("-map", "[v{}]".format(i), "-q:v", str(quality), *segment_limit(segment), *output)]
+    ]
+
+
+def seek_args(ffmpeg, video_file, timestamp, vf, quality, device=None):
+    """ffmpeg args that seek straight to the keyframe at/before timestamp and output just that frame"""
+    return [
+        ffmpeg, "-loglevel", "error", "-skip_frame:v", "nokey", *hwaccel_args(device), "-threads:0", "1",
+        "-noaccurate_seek", "-ss", "{:.3f}".format(timestamp), "-i", video_file,
+        "-frames:v", "1", "-an", "-sn", "-dn", "-q:v", str(quality),
+        "-vf", vf, *PIPE_OUTPUT
+    ]
+
+
+def split_seek_args(ffmpeg, video_file, timestamp, graph, outputs, device=None):
+    """seek_args for a split_filter graph (built with fps=False), one frame to each of outputs"""
+    return [
+        ffmpeg, "-loglevel", "error", "-skip_frame:v", "nokey", *hwaccel_args(device), "-threads:0", "1",
+        "-noaccurate_seek", "-ss", "{:.3f}".format(timestamp), "-i", video_file, "-filter_complex", graph,
+        *[arg for i, (quality, output) in enumerate(outputs) for arg in ("-map", "[v{}]".format(i), "-frames:v", "1", "-q:v", str(quality), *output)]
+    ]
+
+
+_PROGRESS_LINE = re.compile(r'^([a-z0-9_]+)=\s*(.*)$')
+
+
+def read_progress(stream, on_progress, keep):
+    """
+    Read ffmpeg's stderr line by line while it runs `-progress pipe:2`, handing every finished block of
+    key=value pairs to on_progress as a dict and appending every line (progress or not) to keep
+    """
+    block = {}
+    for raw in iter(stream.readline, b''):
+        keep.append(raw)
+        match = _PROGRESS_LINE.match(raw.decode('utf-8', 'ignore').strip())
+        if not match:
+            continue
+        key, value = match.groups()
+        block[key] = value
+        if key == 'progress':
+            try:
+                on_progress(block)
+            except Exception:
+                pass
+            block = {}
+
+
+def open_pipes(count):
+    """(read fd, write fd) for `count` extra outputs, ffmpeg writes to one with pipe_output(write fd)"""
+    pipes = []
+    for _ in range(count):
+        pipes.append(os.pipe())
+    return pipes
+
+
+def run_pipes(args, pipes=(), on_progress=None):
+    """
+    Run ffmpeg with MJPEG on stdout and on each of the extra pipes from open_pipes()
+    @param on_progress called with each `-progress` block (dict of ffmpeg's keys) as ffmpeg runs
+    @return (list of frames for stdout then each pipe, returncode, stderr bytes)
+    """
+    try:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                **({'pass_fds': [write for _, write in pipes]} if pipes else {}))
+    finally:
+        for _, write in pipes:
+            os.close(write)
+    streams = [proc.stdout] + [os.fdopen(read, 'rb') for read, _ in pipes]
+    outputs = [[] for _ in streams]
+    # Drain stderr and the extra pipes on threads, so ffmpeg never blocks on one while we read another
+    stderr = []
+    if on_progress is None:
+        readers = [lambda: stderr.append(proc.stderr.read())]
+    else:
+        readers = [lambda: read_progress(proc.stderr, on_progress, stderr)]
+    readers += [lambda i=i: outputs[i].extend(split_mjpeg(streams[i])) for i in range(1, len(streams))]
+    threads = [threading.Thread(target=reader, daemon=True) for reader in readers]
+    for thread in threads:
+        thread.start()
+    try:
+        outputs[0].extend(split_mjpeg(proc.stdout))
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        for thread in threads:
+            thread.join()
+        for stream in streams[1:]:
+            stream.close()
+    return outputs, proc.returncode, b''.join(stderr)
+
+
+def run_pipe(args, on_progress=None):
+    """
+    Run ffmpeg with MJPEG on stdout (a run writing images to a folder just yields no frames)
+    @return (frames, returncode, stderr bytes)
+    """
+    outputs, returncode, err = run_pipes(args, on_progress=on_progress)
+    return outputs[0], returncode, err
+
+
+def frame_timestamps(duration, interval):
+    """The same timestamps the fps filter (round=up) would pick, one every interval seconds"""
+    return [i * interval for i in range(max(1, math.ceil(duration / interval)))]
+
+
+def split_outputs(variants, folders=None):
+    """
+    Where each output of a split_filter graph goes, the first to stdout and the rest to extra pipes
+    @param folders write JPEGs to one folder per variant instead
+    @return (outputs for split_decode_args, pipes for run_pipes)
+    """
+    if folders is not None:
+        return [(variant['quality'], ['{}/img-%06d.jpg'.format(folder)]) for variant, folder in zip(variants, folders)], []
+    pipes = open_pipes(len(variants) - 1)
+    targets = [PIPE_OUTPUT] + [pipe_output(write) for _, write in pipes]
+    return [(variant['quality'], target) for variant, target in zip(variants, targets)], pipes
+
+
+def _extract_sparse(video_file, duration, interval, grab, outputs, threads, on_progress):
+    """
+    Seek to every timestamp, `threads` at a time
+    @param grab timestamp -> (one frame or None per output, returncode, stderr bytes)
+    @return list of frames per output
+    """
+    timestamps = frame_timestamps(duration, interval)
+    start = time.time()
+    done = [0]
+    lock = threading.Lock()
+
+    def seek(timestamp):
+        frames, returncode, err = grab(timestamp)
+        # A seek that failed would shift every later frame in the BIF, fail the whole file instead
+        if returncode != 0:
+            raise RuntimeError('No frame could be extracted from {} at {:.0f}s (ffmpeg exited with {}): {}'.format(
+                video_file, timestamp, returncode, err.decode('utf-8', 'ignore')[-300:]))
+        if on_progress is not None:
+            with lock:
+                done[0] += 1
+                elapsed = max(time.time() - start, 1e-6)
+                on_progress({'frame': done[0], 'fps': round(done[0] / elapsed, 2),
+                             'speed': '{:.2f}x'.format(done[0] * interval / elapsed),
+                             'progress': 'end' if done[0] == len(timestamps) else 'continue'})
+        return frames
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        grabbed = list(pool.map(seek, timestamps))
+
+    streams = []
+    for i in range(outputs):
+        frames = []
+        for frame in (seek_frames[i] for seek_frames in grabbed):
+            # A seek that came back empty (eg: past the last keyframe) repeats the previous frame so the
+            # BIF timestamps stay lined up
+            if frame is None:
+                if not frames:
+                    raise RuntimeError('No frames could be extracted from {}'.format(video_file))
+                frame = frames[-1]
+            frames.append(frame)
+        if not frames:
+            raise RuntimeError('No frames could be extracted from {}'.format(video_file))
+        streams.append(frames)
+    return streams
+
+
+def extract_sparse(ffmpeg, video_file, duration, interval, vf, quality, device=None, threads=4, on_progress=None):
+    """
+    Fetch one keyframe per interval by seeking to each timestamp instead of decoding the whole stream,
+    so only the data around those keyframes is read. Seeks run `threads` at a time since on a remote
+    mount they are bound by latency rather than CPU.
+    @param vf filter chain without the fps filter, see video_filter(fps=False)
+    @param on_progress called after every seek with a dict shaped like ffmpeg's -progress blocks
+    @return list of JPEG frames, one per timestamp
+    """
+    def grab(timestamp):
+        frames, returncode, err = run_pipe(seek_args(ffmpeg, video_file, timestamp, vf, quality, device))
+        return [frames[0] if frames else None], returncode, err
+
+    return _extract_sparse(video_file, duration, interval, grab, 1, threads, on_progress)[0]
+
+
+def extract_sparse_split(ffmpeg, video_file, duration, interval, variants, hdr=False, device=None, threads=4, on_progress=None):
+    """
+    extract_sparse for several variants, every keyframe fetched is decoded once and scaled for each
+    @return list of JPEG frames per variant
+    """
+    graph = split_filter(interval, variants, hdr, fps=False)
+
+    def grab(timestamp):
+        outputs, pipes = split_outputs(variants)
+        streams, returncode, err = run_pipes(split_seek_args(ffmpeg, video_file, timestamp, graph, outputs, device), pipes)
+        return [frames[0] if frames else None for frames in streams], returncode, err
+
+    return _extract_sparse(video_file, duration, interval, grab, len(variants), threads, on_progress)
+
+
+def _sum_progress(blocks):
+    """One -progress style dict for segments decoding at once, their frames, fps and speed added up"""
+    total = {'frame': 0, 'fps': 0.0, 'speed': 0.0}
+    for block in blocks:
+        for key in total:
+            try:
+                total[key] += float(str(block.get(key, 0)).rstrip('x'))
+            except ValueError:
+                pass
+    return {'frame': int(total['frame']), 'fps': round(total['fps'], 2), 'speed': '{:.2f}x'.format(total['speed']),
+            'progress': 'end' if all(block.get('progress') == 'end' for block in blocks) else 'continue'}
+
+
+def _extract_segmented(video_file, duration, interval, count, run_segment, outputs, on_progress):
+    """
+    Decode the segments from plan_segments all at once, then stitch their frames back into one run
+    @param run_segment (segment, on_progress) -> (list of frames per output, returncode, stderr bytes)
+    @return list of frames per output
+    """
+    segments = plan_segments(duration, interval, count) or [None]
+    blocks = [{} for _ in segments]
+    lock = threading.Lock()
+
+    def decode(i):
+        progress = None
+        if on_progress is not None:
+            def progress(block):
+                with lock:
+                    blocks[i] = block
+                    on_progress(_sum_progress(blocks))
+        streams, returncode, err = run_segment(segments[i], progress)
+        # A part that failed part way would be padded out with its last frame, fail the whole file instead
+        if returncode != 0 or not all(streams):
+            raise RuntimeError('No frames could be extracted from {} at {:.0f}s (ffmpeg exited with {}): {}'.format(
+                video_file, segments[i][0] if segments[i] else 0, returncode, err.decode('utf-8', 'ignore')[-300:]))
+        return streams
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+        decoded = list(pool.map(decode, range(len(segments))))
+
+    streams = []
+    for i in range(outputs):
+        frames = []
+        for n, (segment, segment_streams) in enumerate(zip(segments, decoded)):
+            frames += segment_streams[i] if segment is None else fit_segment(segment_streams[i], segment[2], last=n == len(segments) - 1)
+        streams.append(frames)
+    return streams
+
+
+def extract_segmented(ffmpeg, video_file, duration, interval, vf, quality, segments, device=None, on_progress=None):
+    """
+    Decode a long video as `segments` parts at once, an ffmpeg each, so one file can use more than a core.
+    Every part starts on a frame timestamp, the frames come out the same as a full decode's.
+    @param vf filter chain from video_filter(segment=True)
+    @param on_progress called with the segments' -progress blocks added up
+    @return list of JPEG frames, one per timestamp
+    """
+    def run_segment(segment, progress):
+        frames, returncode, err = run_pipe(full_decode_args(ffmpeg, video_file, vf, quality, PIPE_OUTPUT, device,
+                                                            progress=progress is not None, segment=segment), progress)
+        return [frames], returncode, err
+
+    return _extract_segmented(video_file, duration, interval, segments, run_segment, 1, on_progress)[0]
+
+
+def extract_segmented_split(ffmpeg, video_file, duration, interval, variants, segments, hdr=False, device=None, on_progress=None):
+    """
+    extract_segmented for several variants, each part split and scaled for every variant
+    @return list of JPEG frames per variant
+    """
+    graph = split_filter(interval, variants, hdr, segment=True)
+
+    def run_segment(segment, progress):
+        outputs, pipes = split_outputs(variants)
+        return run_pipes(split_decode_args(ffmpeg, video_file, graph, outputs, device, progress=progress is not None,
+                                           segment=segment), pipes, progress)
+
+    return _extract_segmented(video_file, duration, interval, segments, run_segment, len(variants), on_progress)
+
+
+def choose_mode(mode, backend=None, size=None, duration=None, sparse_backends=(), min_size=0, min_bitrate=0):
+    """
+    Pick the extraction engine for a file
+    @param mode 'full', 'sparse' or 'auto'
+    @param size file size in bytes, duration in seconds (as reported by Plex)
+    In auto mode sparse extraction is used for big, high bitrate files on slow backends (eg: rclone),
+    where reading the whole file costs far more than a seek per frame.
+    """
+    if mode != AUTO:
+        return mode
+    if backend not in sparse_backends or not size or not duration:
+        return FULL
+    bitrate = size * 8 / duration
+    if size >= min_size and bitrate >= min_bitrate:
+        return SPARSE
+    return FULL
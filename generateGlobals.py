@@ -27,17 +27,34 @@ PLEX_VIDEOS_PATH_ARRAY = os.environ.get('PLEX_VIDEOS_PATH_ARRAY', ['/zfs/zpool1/
                                         '/zfs/zpool6/media_root/Union','/rclone/Crypts/Crypt-Mum/Union', '/rclone/Crypts/Crypt-Dad/Union',
                                         '/rclone/Crypts/Crypt-OD/Union','/rclone/Crypts/Crypt-OD2/Union', '/rclone/Crypts/Crypt-S59S1/Union',
                                         '/rclone/Crypts/Crypt-SS59/Union']) ### Sean Added for using backends instead of Union ###
+PATH_CACHE_TTL = int(os.environ.get('PATH_CACHE_TTL', 3600))  # Seconds to remember which local path served a folder
+PATH_MISS_TTL = int(os.environ.get('PATH_MISS_TTL', 300))  # Seconds to remember a file could not be found locally
 GPU_THREADS = int(os.environ.get('GPU_THREADS', 2))  # Number of GPU threads for preview generation
 CPU_THREADS = int(os.environ.get('CPU_THREADS', 0))  # Number of CPU threads for preview generation
+LEDGER_PATH = os.environ.get('LEDGER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plex_generate_previews.db'))  # Local job ledger used to resume where the last run stopped
+LEDGER_MAX_ATTEMPTS = int(os.environ.get('LEDGER_MAX_ATTEMPTS', 3))  # Stop retrying a file after this many failures (until the file changes)
+WATERMARK_PATH = os.environ.get('WATERMARK_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plex_generate_previews_watermarks.json'))  # Newest addedAt/updatedAt seen per section
+FULL_SWEEP_HOURS = float(os.environ.get('FULL_SWEEP_HOURS', 24))  # Hours between full library sweeps, passes in between only fetch what changed
+POLL_INTERVAL = int(os.environ.get('POLL_INTERVAL', 60))  # Seconds to wait between passes when looping
+BUNDLE_INVENTORY = int(os.environ.get('BUNDLE_INVENTORY', 1)) == 1  # List which bundles have a preview once per pass (only what changed after the first) instead of checking every file on the share
+SCAN_THREADS = int(os.environ.get('SCAN_THREADS', 32))  # Threads listing PLEX_LOCAL_MEDIA_PATH for the bundle inventory
 
 
-SHIELD_URL = 'https://192.168.10.3:32400/'
+SHIELD_URL = os.environ.get('SHIELD_URL', 'https://192.168.10.3:32400/')
 PLEX_TOKEN = 'WPz3dw8jK36NNbAKvcoY'
 requests.packages.urllib3.disable_warnings()
 sess = requests.Session()
 sess.verify = False
-WMPlex = PlexServer(PLEX_URL, PLEX_TOKEN, session=sess)
-shieldPlex = PlexServer(SHIELD_URL, PLEX_TOKEN, session=sess)
+_servers = {}
+
+
+def get_server(url):
+    """Connect on first use rather than on import, so importing this doesn't need both servers up"""
+    if url not in _servers:
+        _servers[url] = PlexServer(url, PLEX_TOKEN, session=sess)
+    return _servers[url]
+
+
 manualList = []
 guidVars = {"episode" : "plex://episode/5d9c133202391c001f5ff718", 
             "season" : "plex://season/602e690cea35e0002c23e7f6",
@@ -49,9 +66,15 @@ guidVars = {"episode" : "plex://episode/5d9c133202391c001f5ff718",
 ###-- SET RUN TYPE HERE --###
 runType = "Other"
 # runType = "Full"
+# runType = "Currently Playing"
+# runType = "Selection"
+# runType = "Daemon"
+# runType = "Repair"
 
 def fetch_result_list():
     """Fetch unwatched items from WMPlex based on shieldPlex shows"""
+    WMPlex = get_server(PLEX_URL)
+    shieldPlex = get_server(SHIELD_URL)
     mediaItems = shieldPlex.library.search(libtype='show')
     n=0
     for item in mediaItems:
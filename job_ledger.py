@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    bundle_hash TEXT PRIMARY KEY,
+    rating_key TEXT,
+    media_file TEXT,
+    file_size INTEGER,
+    file_mtime INTEGER,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL,
+    duration REAL,
+    output_size INTEGER,
+    error TEXT
+)
+"""
+
+RUNNING = 'running'
+DONE = 'done'
+EXISTING = 'existing'  # A preview we did not make ourselves was already in the bundle
+FAILED = 'failed'
+INTERRUPTED = 'interrupted'
+CORRUPT = 'corrupt'  # The BIF in the bundle was found broken, it gets made again
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class JobLedger:
+    """
+    Local record of every preview job, keyed by the MediaPart bundle hash and the file size + mtime
+    Plex reports for it, so a restart can skip finished work without probing the bundle share.
+    Each process opens its own connection, sqlite takes care of the locking between pool workers.
+    """
+
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get(self, bundle_hash):
+        cur = self.db.execute('SELECT status, attempts, file_size, file_mtime FROM jobs WHERE bundle_hash = ?', (bundle_hash,))
+        return cur.fetchone()
+
+    def should_skip(self, bundle_hash, file_size=None, file_mtime=None):
+        """True if the job is finished (and the file has not changed since), or has failed too many times"""
+        row = self.get(bundle_hash)
+        if row is None:
+            return False
+        status, attempts, old_size, old_mtime = row
+        unchanged = _int_or_none(file_size) == old_size and _int_or_none(file_mtime) == old_mtime
+        if status in (DONE, EXISTING):
+            return unchanged
+        if status == FAILED:
+            return unchanged and attempts >= self.max_attempts
+        return False
+
+    def claim(self, bundle_hash, rating_key, media_file, file_size=None, file_mtime=None):
+        """
+        Mark a job as running
+        @return False if another worker is already running it
+        """
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.get(bundle_hash)
+            if row is not None and row[0] == RUNNING:
+                self.db.execute('ROLLBACK')
+                return False
+            self.db.execute(
+                'INSERT INTO jobs (bundle_hash, rating_key, media_file, file_size, file_mtime, status, attempts, started_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, 1, ?) '
+                'ON CONFLICT(bundle_hash) DO UPDATE SET rating_key = excluded.rating_key, media_file = excluded.media_file, '
+                'file_size = excluded.file_size, file_mtime = excluded.file_mtime, status = excluded.status, '
+                'attempts = CASE WHEN jobs.file_size IS excluded.file_size AND jobs.file_mtime IS excluded.file_mtime '
+                'THEN jobs.attempts + 1 ELSE 1 END, '
+                'started_at = excluded.started_at, finished_at = NULL, duration = NULL, output_size = NULL, error = NULL',
+                (bundle_hash, str(rating_key), media_file, _int_or_none(file_size), _int_or_none(file_mtime), RUNNING, now))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return True
+
+    def finish(self, bundle_hash, status, output_size=None, error=None):
+        now = time.time()
+        self.db.execute(
+            'UPDATE jobs SET status = ?, finished_at = ?, duration = ? - started_at, output_size = ?, error = ? WHERE bundle_hash = ?',
+            (status, now, now, output_size, error, bundle_hash))
+
+    def record_existing(self, bundle_hash, rating_key, media_file, file_size=None, file_mtime=None, output_size=None):
+        """Remember a preview that was already in the bundle so we never have to look for it again"""
+        self.db.execute(
+            'INSERT OR REPLACE INTO jobs (bundle_hash, rating_key, media_file, file_size, file_mtime, status, attempts, finished_at, output_size) '
+            'VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)',
+            (bundle_hash, str(rating_key), media_file, _int_or_none(file_size), _int_or_none(file_mtime), EXISTING, time.time(), output_size))
+
+    def mark_corrupt(self, bundle_hash, error=None):
+        """
+        Flag a finished job whose BIF turned out to be broken, so it isn't skipped any more
+        @return the rating key recorded for it, None if the ledger has never seen the bundle
+        """
+        cur = self.db.execute('SELECT rating_key FROM jobs WHERE bundle_hash = ?', (bundle_hash,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE jobs SET status = ?, attempts = 0, error = ? WHERE bundle_hash = ?', (CORRUPT, error, bundle_hash))
+        return row[0]
+
+    def reset_running(self):
+        """Jobs still marked running at startup were cut off by a crash or restart, let them be retried"""
+        cur = self.db.execute('UPDATE jobs SET status = ? WHERE status = ?', (INTERRUPTED, RUNNING))
+        return cur.rowcount
+
+    def summary(self):
+        cur = self.db.execute('SELECT status, COUNT(*), SUM(duration), SUM(output_size) FROM jobs GROUP BY status')
+        return {status: {'count': count, 'duration': duration or 0, 'output_size': output_size or 0}
+                for status, count, duration, output_size in cur.fetchall()}
@@ -0,0 +1,101 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bif_writer import BIF_HEADER_SIZE
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def pillow_quality(qscale):
+    """ffmpeg's -q:v (2 best - 31 worst) to the Pillow/libjpeg quality giving about the same size frames (93 - 6)"""
+    return max(5, min(95, 99 - 3 * qscale))
+
+
+def encode(image, quality, progressive=False):
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality, optimize=True, progressive=progressive)
+    return out.getvalue()
+
+
+def fit_frame(frame, budget, quality, min_quality=30, progressive=False):
+    """
+    Re-encode a JPEG with optimised Huffman tables, binary searching the quality between min_quality and
+    quality for the best one that fits in budget bytes
+    @param budget 0 = no budget, just re-encode at quality
+    @return the smaller of the original and the re-encode when both fit, the re-encode at min_quality when nothing does
+    """
+    image = Image.open(io.BytesIO(frame))
+    image.load()
+    data = best = encode(image, quality, progressive)
+    if budget and len(best) > budget:
+        best = None
+        low, high = min_quality, quality - 1
+        while low <= high:
+            middle = (low + high) // 2
+            data = encode(image, middle, progressive)
+            if len(data) <= budget:
+                best, low = data, middle + 1
+            else:
+                high = middle - 1
+        if best is None:
+            # Nothing fits, the last try was the lowest quality allowed
+            best = data
+    if len(frame) <= len(best) and (not budget or len(frame) <= budget):
+        return frame
+    return best
+
+
+class JpegOptimizer:
+    """
+    Shrinks the frames of a BIF before it's published: each JPEG is re-encoded with optimised Huffman
+    tables (optionally progressive) starting from the quality it was extracted at, and dropped in
+    quality only as far as it takes to fit the per frame budget, or its share of the per BIF budget.
+    Frames are spread over a thread pool shared by every job, Pillow lets go of the GIL while it codes.
+    Totals of bytes in and out and seconds spent are kept, so the saving can be weighed against the time.
+    """
+
+    def __init__(self, frame_budget=0, bif_budget=0, min_quality=30, progressive=False, workers=4):
+        """
+        @param frame_budget most bytes per frame, 0 = no cap
+        @param bif_budget most bytes per BIF, split evenly between its frames, 0 = no cap
+        """
+        if Image is None:
+            raise RuntimeError('JPEG optimisation needs Pillow')
+        self.frame_budget = frame_budget
+        self.bif_budget = bif_budget
+        self.min_quality = min_quality
+        self.progressive = progressive
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def budget(self, frames):
+        """Bytes each of `frames` frames may take"""
+        budget = self.frame_budget
+        if self.bif_budget and frames:
+            share = max(1, (self.bif_budget - BIF_HEADER_SIZE - 8 * (frames + 1)) // frames)
+            budget = min(budget, share) if budget else share
+        return budget
+
+    def optimize(self, frames, qscale):
+        """
+        @param qscale the -q:v the frames were extracted at
+        @return (frames, stats) stats being bytes in and out and seconds taken
+        """
+        start = time.time()
+        budget = self.budget(len(frames))
+        quality = pillow_quality(qscale)
+        optimized = list(self.pool.map(lambda frame: fit_frame(frame, budget, quality, self.min_quality, self.progressive), frames))
+        stats = {'bytes_in': sum(len(frame) for frame in frames), 'bytes_out': sum(len(frame) for frame in optimized),
+                 'seconds': time.time() - start}
+        with self.lock:
+            self.bytes_in += stats['bytes_in']
+            self.bytes_out += stats['bytes_out']
+            self.seconds += stats['seconds']
+        return optimized, stats
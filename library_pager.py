@@ -0,0 +1,72 @@
+import time
+from urllib.parse import urlencode
+from plexapi.exceptions import NotFound
+from loguru import logger
+
+
+def has_previews(element):
+    """Same test as plexapi's Episode.hasPreviewThumbnails, on the raw XML so no objects are built"""
+    return any(part.attrib.get('indexes') == 'sd' for part in element.iter('Part'))
+
+
+class SectionPager:
+    """
+    Streams the keys of a section's items that have no preview thumbnails yet, one page at a time
+    (X-Plex-Container-Start/Size) straight from the XML, so the first key is out after a single small
+    request and memory stays flat however big the library is. `server_filter` is extra query string
+    for the listing (eg: a filter the server understands), items that already have previews are
+    dropped here as well either way. A page that fails is retried before giving up.
+    """
+
+    def __init__(self, plex, section_key, libtype=4, page_size=500, server_filter='', retries=3):
+        self.plex = plex
+        self.section_key = section_key
+        self.libtype = libtype
+        self.page_size = page_size
+        self.server_filter = server_filter.lstrip('&?')
+        self.retries = retries
+        self.on_skip = None  # called with each key dropped for already having previews
+        self.skipped = 0
+        self.total = None
+
+    def _page(self, start, size):
+        query = urlencode({'type': self.libtype, 'X-Plex-Container-Start': start, 'X-Plex-Container-Size': size})
+        if self.server_filter:
+            query += '&' + self.server_filter
+        path = '/library/sections/{}/all?{}'.format(self.section_key, query)
+        for attempt in range(self.retries + 1):
+            try:
+                return self.plex.query(path)
+            except NotFound:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning('Error listing section {} from {}, retrying. `{}:{}`'.format(self.section_key, start, type(e).__name__, str(e)))
+                time.sleep(2 ** attempt)
+
+    def __len__(self):
+        """Items in the (server filtered) listing, asked for with an empty page if not known yet"""
+        if self.total is None:
+            self.total = int(self._page(0, 0).attrib.get('totalSize', 0))
+        return self.total
+
+    def __iter__(self):
+        start = 0
+        while True:
+            data = self._page(start, self.page_size)
+            self.total = int(data.attrib.get('totalSize', self.total or 0))
+            items = list(data)
+            for element in items:
+                key = element.attrib.get('key')
+                if key is None:
+                    continue
+                if has_previews(element):
+                    self.skipped += 1
+                    if self.on_skip:
+                        self.on_skip(key)
+                    continue
+                yield key
+            start += len(items)
+            if not items or start >= self.total:
+                return
@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import subprocess
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    file_size INTEGER,
+    file_mtime INTEGER,
+    probed_at REAL,
+    info TEXT NOT NULL
+)
+"""
+
+HDR_TRANSFERS = {'smpte2084': 'HDR10', 'arib-std-b67': 'HLG'}
+DOVI_TAGS = ('dvh1', 'dvhe', 'dav1', 'dva1', 'dvav')
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_probe(data):
+    """
+    Boil ffprobe's JSON down to what the preview jobs need
+    @return dict of codec, width, height, duration, hdr_format ('Dolby Vision', 'HDR10', 'HLG' or None),
+            hdr and dovi
+    """
+    stream = next((s for s in data.get('streams', []) if s.get('codec_type', 'video') == 'video'), {})
+    dovi = stream.get('codec_tag_string', '') in DOVI_TAGS or any(
+        side_data.get('side_data_type', '').startswith('DOVI') for side_data in stream.get('side_data_list', []))
+    hdr_format = 'Dolby Vision' if dovi else HDR_TRANSFERS.get(stream.get('color_transfer'))
+
+    return {
+        'codec': stream.get('codec_name'),
+        'width': _int_or_none(stream.get('width')),
+        'height': _int_or_none(stream.get('height')),
+        'duration': _float_or_none(data.get('format', {}).get('duration')) or _float_or_none(stream.get('duration')),
+        'hdr_format': hdr_format,
+        'hdr': hdr_format is not None,
+        'dovi': dovi,
+    }
+
+
+class MediaProbe:
+    """
+    Reads codec, resolution, duration and HDR/Dolby Vision flags with a single ffprobe call that only reads
+    the container and stream headers (no packets are read, nothing is decoded) and keeps the result in sqlite keyed by path + size + mtime, so a re-run never probes the
+    same unchanged file twice. Shares the job ledger database, one connection per thread/process.
+    """
+
+    def __init__(self, path, ffprobe='ffprobe', timeout=30):
+        self.ffprobe = ffprobe
+        self.timeout = timeout
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.db.close()
+
+    def cached(self, key, file_size, file_mtime):
+        row = self.db.execute('SELECT file_size, file_mtime, info FROM probes WHERE path = ?', (key,)).fetchone()
+        if row is not None and row[0] == file_size and row[1] == file_mtime:
+            return json.loads(row[2])
+        return None
+
+    def run_ffprobe(self, video_file):
+        args = [
+            self.ffprobe, '-v', 'error', '-print_format', 'json', '-select_streams', 'v:0',
+            '-show_format', '-show_streams', video_file
+        ]
+        out = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=self.timeout, check=True).stdout
+        return json.loads(out or b'{}')
+
+    def probe(self, video_file, file_size=None, file_mtime=None, key=None):
+        """
+        @param video_file local path to probe
+        @param file_size, file_mtime as Plex reports them, stat'ed from video_file if not given
+        @param key what to cache the result under (eg: the path Plex reports), defaults to video_file
+        """
+        key = key or video_file
+        file_size, file_mtime = _int_or_none(file_size), _int_or_none(file_mtime)
+        if file_size is None or file_mtime is None:
+            st = os.stat(video_file)
+            file_size, file_mtime = st.st_size, int(st.st_mtime)
+
+        info = self.cached(key, file_size, file_mtime)
+        if info is not None:
+            self.hits += 1
+            return info
+
+        self.misses += 1
+        info = parse_probe(self.run_ffprobe(video_file))
+        self.db.execute('INSERT OR REPLACE INTO probes (path, file_size, file_mtime, probed_at, info) VALUES (?, ?, ?, ?, ?)',
+                        (key, file_size, file_mtime, time.time(), json.dumps(info)))
+        return info
@@ -0,0 +1,132 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from loguru import logger
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    """
+    Counters and gauges kept in this process, rendered in the Prometheus text format. Collectors are
+    called on every render for values that are cheaper to read when asked for (eg: queue depths).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}  # name -> (type, help)
+        self.values = {}  # name -> {labels tuple: value}
+        self.collectors = []
+
+    def describe(self, name, kind, help_text):
+        self.kinds[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def remove(self, name, **labels):
+        with self.lock:
+            self.values.get(name, {}).pop(tuple(sorted(labels.items())), None)
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.values.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def series(self, name):
+        """Every labelled value of a metric, as a list of (labels dict, value)"""
+        with self.lock:
+            return [(dict(labels), value) for labels, value in self.values.get(name, {}).items()]
+
+    def collector(self, collect):
+        """@param collect called on every render, yields (name, labels dict, value)"""
+        self.collectors.append(collect)
+
+    def render(self):
+        with self.lock:
+            samples = {name: dict(series) for name, series in self.values.items()}
+        for collect in self.collectors:
+            try:
+                for name, labels, value in collect():
+                    samples.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+            except Exception as e:
+                logger.debug('Metrics collector failed `{}:{}`'.format(type(e).__name__, str(e)))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = self.kinds.get(name, (GAUGE, ''))
+            if help_text:
+                lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(samples[name].items()):
+                lines.append('{}{} {}'.format(name, _labels(dict(labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics, port, host='0.0.0.0'):
+    """Serve metrics.render() at /metrics from a daemon thread, returns the server"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _number(value):
+    try:
+        return float(str(value).rstrip('x'))
+    except ValueError:
+        return 0.0
+
+
+def follow_progress(progress_queue, metrics):
+    """
+    Turn the progress reports decode workers put on progress_queue into per worker gauges, on a daemon thread
+    Reports are dicts of ffmpeg -progress keys (frame, fps, speed, progress) plus worker and device.
+    A worker's series are dropped when its job ends, so workers that come and go don't pile up
+    """
+    def run():
+        while True:
+            report = progress_queue.get()
+            labels = {'worker': report.get('worker', ''), 'device': report.get('device', '')}
+            if report.get('progress') == 'end':
+                for name in ('preview_worker_fps', 'preview_worker_speed', 'preview_worker_frames', 'preview_worker_updated_seconds'):
+                    metrics.remove(name, **labels)
+                continue
+            metrics.set('preview_worker_fps', _number(report.get('fps', 0)), **labels)
+            metrics.set('preview_worker_speed', _number(report.get('speed', 0)), **labels)
+            metrics.set('preview_worker_frames', int(_number(report.get('frame', 0))), **labels)
+            metrics.set('preview_worker_updated_seconds', time.time(), **labels)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+
+LIBRARY = 'com.plexapp.plugins.library'
+PROCESSED = 5  # timeline state once Plex has finished with an item, see plexapi.alert.AlertListener
+EPISODE = 4
+
+
+def ready_keys(data, types=(EPISODE,)):
+    """
+    The items a notification says are ready for a preview: timeline entries for the library that reached
+    the processed state, and ended activities that name a metadata item (eg: media analysis)
+    @param data a NotificationContainer as plexapi's AlertListener hands it over
+    @return list of item keys, '/library/metadata/<id>'
+    """
+    keys = []
+    kind = data.get('type')
+    if kind == 'timeline':
+        for entry in data.get('TimelineEntry', []):
+            if entry.get('identifier') != LIBRARY or int(entry.get('type', 0)) not in types:
+                continue
+            if int(entry.get('state', -1)) == PROCESSED and not entry.get('mediaState') and not entry.get('metadataState'):
+                keys.append('/library/metadata/{}'.format(entry['itemID']))
+    elif kind == 'activity':
+        for notification in data.get('ActivityNotification', []):
+            context = notification.get('Activity', {}).get('Context', {})
+            if notification.get('event') == 'ended' and str(context.get('key', '')).startswith('/library/metadata/'):
+                keys.append(context['key'])
+    return keys
+
+
+class Debouncer:
+    """
+    Collects keys and hands them to flush() as one batch once none have arrived for `delay` seconds
+    (or `max_delay` after the first, so a long import still makes progress). A season landing in the
+    library becomes a single batch instead of one run per episode. Repeats of a key are coalesced.
+    """
+
+    def __init__(self, flush, delay=30, max_delay=300):
+        self.flush = flush
+        self.delay = delay
+        self.max_delay = max_delay
+        self.keys = OrderedDict()
+        self.first = None
+        self.last = None
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, key):
+        with self.cond:
+            now = time.monotonic()
+            if not self.keys:
+                self.first = now
+            self.keys[key] = None
+            self.last = now
+            self.cond.notify()
+
+    def _due(self):
+        """Seconds until the pending batch should go, None if there's nothing pending"""
+        if not self.keys:
+            return None
+        now = time.monotonic()
+        return max(0, min(self.last + self.delay, self.first + self.max_delay) - now)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopped and (self._due() is None or self._due() > 0):
+                    self.cond.wait(self._due())
+                if self.stopped:
+                    return
+                batch = list(self.keys)
+                self.keys.clear()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                logger.error('Error queueing notified items. `{}:{}`'.format(type(e).__name__, str(e)))
+
+    def stop(self, flush_pending=True):
+        with self.cond:
+            self.stopped = True
+            batch = list(self.keys)
+            self.keys.clear()
+            self.cond.notify()
+        self.thread.join()
+        if flush_pending and batch:
+            self.flush(batch)
+
+
+class PlexNotificationSource:
+    """
+    Plex's /:/websockets/notifications stream through plexapi's AlertListener (needs websocket-client).
+    The listener thread ends when the connection drops, so it's restarted after `reconnect_delay`
+    seconds, with on_connect called every time so the caller can catch up on anything missed meanwhile.
+    """
+
+    def __init__(self, plex, reconnect_delay=30, on_connect=None):
+        self.plex = plex
+        self.reconnect_delay = reconnect_delay
+        self.on_connect = on_connect
+        self.stop_event = threading.Event()
+        self.listener = None
+        self.thread = None
+
+    def start(self, callback):
+        self.thread = threading.Thread(target=self._run, args=(callback,), daemon=True)
+        self.thread.start()
+
+    def _run(self, callback):
+        while not self.stop_event.is_set():
+            try:
+                self.listener = self.plex.startAlertListener(callback)
+                if self.on_connect:
+                    self.on_connect()
+                while self.listener.is_alive() and not self.stop_event.is_set():
+                    self.stop_event.wait(1)
+            except Exception as e:
+                logger.error('Plex notification stream failed. `{}:{}`'.format(type(e).__name__, str(e)))
+            if not self.stop_event.is_set():
+                logger.warning('Lost the Plex notification stream, reconnecting in {} seconds'.format(self.reconnect_delay))
+                self.stop_event.wait(self.reconnect_delay)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.listener is not None and self.listener.is_alive():
+            try:
+                self.listener.stop()
+            except Exception:
+                pass
+
+
+class FakeNotificationSource:
+    """
+    Stand-in for the Plex stream: replays NotificationContainers from a list (or a file of JSON lines),
+    `interval` seconds apart, and anything passed to emit(). on_connect is called on start and on every
+    reconnect(), like PlexNotificationSource does when its stream comes back.
+    """
+
+    def __init__(self, messages=(), interval=0.0, on_connect=None):
+        if isinstance(messages, str):
+            with open(messages) as f:
+                messages = [json.loads(line) for line in f if line.strip()]
+        self.messages = list(messages)
+        self.interval = interval
+        self.on_connect = on_connect
+        self.callback = None
+        self.stop_event = threading.Event()
+        self.replayed = threading.Event()
+
+    def start(self, callback):
+        self.callback = callback
+        if self.on_connect:
+            self.on_connect()
+        threading.Thread(target=self._replay, daemon=True).start()
+
+    def reconnect(self):
+        """As if the stream dropped and came back, anything changed meanwhile is only found by on_connect"""
+        if self.on_connect and not self.stop_event.is_set():
+            self.on_connect()
+
+    def _replay(self):
+        for message in self.messages:
+            if self.stop_event.wait(self.interval):
+                return
+            self.emit(message)
+        self.replayed.set()
+
+    def emit(self, message):
+        if self.callback and not self.stop_event.is_set():
+            self.callback(message.get('NotificationContainer', message))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def timeline_message(item_id, state=PROCESSED, section_id=1, item_type=EPISODE, **extra):
+    """A timeline NotificationContainer like the ones Plex sends while it imports an item"""
+    entry = {'identifier': LIBRARY, 'sectionID': str(section_id), 'itemID': str(item_id), 'type': item_type,
+             'state': state, 'updatedAt': int(time.time())}
+    entry.update(extra)
+    return {'type': 'timeline', 'size': 1, 'TimelineEntry': [entry]}
+
+
+def import_messages(item_ids, section_id=1):
+    """The notifications for a batch of items being imported: created, matched, downloaded, processed"""
+    messages = []
+    for state in (0, 2, 3, 4):
+        messages += [timeline_message(item_id, state, section_id, metadataState='processing') for item_id in item_ids]
+    messages += [timeline_message(item_id, PROCESSED, section_id) for item_id in item_ids]
+    return messages
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+
+def as_list(value):
+    """Path arrays can come from the environment as a ; separated string"""
+    if isinstance(value, str):
+        return [v for v in value.split(';') if v]
+    return [v for v in value if v]
+
+
+class PathResolver:
+    """
+    Turns the path Plex reports for a file into a path this machine can read.
+
+    Server prefixes are kept in a trie so the longest one matching a file is found in one walk, and
+    every directory remembers which local root last served it. Most lookups therefore cost a single
+    stat against the most likely root, falling back to the other roots only on a miss. Files that
+    can't be found anywhere are remembered for a while (negative cache) so they aren't searched for
+    over and over. Nothing global is changed, so it's safe to share between resolver threads.
+    """
+
+    def __init__(self, server_prefixes, local_roots, ttl=3600, negative_ttl=300, isfile=os.path.isfile):
+        self.local_roots = [root.rstrip('/\\') for root in as_list(local_roots)]
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.isfile = isfile
+        self.lock = threading.Lock()
+        self.trie = {}
+        for prefix in as_list(server_prefixes):
+            node = self.trie
+            for part in self._split(prefix):
+                node = node.setdefault(part, {})
+            node[None] = prefix.rstrip('/')
+        self.dir_roots = {}  # server directory -> (local root, expires)
+        self.prefix_roots = {}  # server prefix -> local roots, most recently successful first
+        self.missing = {}  # server path -> expires
+        self.lookups = 0
+        self.stat_calls = 0
+
+    @staticmethod
+    def _split(path):
+        return [part for part in path.replace('\\', '/').split('/') if part]
+
+    def match_prefix(self, server_path):
+        """The longest configured server prefix that server_path starts with, or None"""
+        node = self.trie
+        best = node.get(None)
+        for part in self._split(server_path):
+            node = node.get(part)
+            if node is None:
+                break
+            best = node.get(None, best)
+        return best
+
+    def _exists(self, path):
+        self.stat_calls += 1
+        return self.isfile(path)
+
+    def candidates(self, server_path, prefix):
+        """(local root, local path) for every root the file might be under, most likely first"""
+        rest = server_path[len(prefix):]
+        directory = os.path.dirname(server_path)
+        with self.lock:
+            roots = list(self.prefix_roots.get(prefix, ()))
+            roots += [root for root in self.local_roots if root not in roots]
+            cached = self.dir_roots.get(directory)
+            if cached and cached[1] > time.time():
+                roots.remove(cached[0])
+                roots.insert(0, cached[0])
+        return [(root, root + rest) for root in roots]
+
+    def resolve(self, server_path):
+        """
+        @return the local path of the file, or None if no local root has it
+        """
+        now = time.time()
+        with self.lock:
+            self.lookups += 1
+            if self.missing.get(server_path, 0) > now:
+                return None
+
+        prefix = self.match_prefix(server_path)
+        if prefix is None or not self.local_roots:
+            # Nothing to map, the file should be where Plex says it is
+            return server_path if self._exists(server_path) else None
+
+        for root, local_path in self.candidates(server_path, prefix):
+            if self._exists(local_path):
+                with self.lock:
+                    self.dir_roots[os.path.dirname(server_path)] = (root, now + self.ttl)
+                    roots = self.prefix_roots.setdefault(prefix, [])
+                    if root in roots:
+                        roots.remove(root)
+                    roots.insert(0, root)
+                return local_path
+
+        with self.lock:
+            self.missing[server_path] = now + self.negative_ttl
+        return None
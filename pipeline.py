@@ -0,0 +1,185 @@
+import queue
+import threading
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from loguru import logger
+from storage_backends import BackendQueues, DEFAULT_BACKEND
+
+_END = object()
+
+
+class PreviewPipeline:
+    """
+    Staged preview pipeline:
+        resolve (threads) -> bounded queue -> decode (process pool) -> publish (threads)
+
+    resolve(keys) turns a batch of ratingKeys into {key: [ready to run jobs]}, decode(job, device) runs in
+    a worker process on the device the scheduler handed out, and publish(job, result) runs back in this
+    process once the decode is done (result is None if the decode raised).
+    Keys are pulled from the iterable lazily and every stage is bounded, so memory stays flat no
+    matter how many keys are fed in, while the decode workers never wait on Plex or the network.
+    Jobs are dicts, an optional 'backend' entry names the storage the file is read from so decodes
+    can be interleaved across backends and capped per backend.
+    A job that can use more than one decode slot or backend read at once says so with 'slots' and 'reads'
+    (default 1, reads default to slots). It gets whatever of them is free when it's dispatched, at least
+    one of each, and they are written back into the job so decode() knows how wide it may go.
+    reserve(job), if given, is called before a job is dispatched and returns a token, or None to hold
+    the job (and everything queued behind it) back until an earlier job is published and its token
+    handed to release(token). publish may return a Future instead of None when the job's output is still
+    staged once it returns (eg: in a write-behind publisher), the token is then kept until that Future is done.
+    initializer(*initargs) is run in every decode worker process as it starts.
+    """
+
+    def __init__(self, resolve, decode, publish, scheduler, resolve_workers=4, publish_workers=2, queue_size=None, batch_size=1, storage=None,
+                 reserve=None, release=None, initializer=None, initargs=()):
+        self.resolve = resolve
+        self.decode = decode
+        self.publish = publish
+        self.scheduler = scheduler
+        self.resolve_workers = max(1, resolve_workers)
+        self.publish_workers = max(1, publish_workers)
+        self.queue_size = queue_size or scheduler.pool_size * 2
+        self.batch_size = max(1, batch_size)
+        self.storage = storage
+        self.reserve = reserve
+        self.release = release
+        self.initializer = initializer
+        self.initargs = initargs
+        self.backlog = {}  # backend -> (jobs waiting, jobs decoding)
+
+    def _feed(self, keys, ready):
+        """Resolve keys on a thread pool, blocking whenever the ready queue is full"""
+        in_flight = threading.BoundedSemaphore(self.resolve_workers * 2)
+
+        def resolve(batch):
+            try:
+                resolved = self.resolve(batch)
+            except Exception as e:
+                logger.error('Error resolving items {}. `{}:{}`'.format(', '.join(map(str, batch)), type(e).__name__, str(e)))
+                resolved = {}
+            finally:
+                in_flight.release()
+            for key in batch:
+                ready.put((key, list(resolved.get(key) or [])))
+
+        try:
+            keys = iter(keys)
+            with ThreadPoolExecutor(max_workers=self.resolve_workers) as resolvers:
+                while True:
+                    batch = list(islice(keys, self.batch_size))
+                    if not batch:
+                        break
+                    in_flight.acquire()
+                    resolvers.submit(resolve, batch)
+        except Exception as e:
+            logger.error('Error fetching items to process. `{}:{}`'.format(type(e).__name__, str(e)))
+        finally:
+            ready.put(_END)
+
+    def run(self, keys, on_key_done=None):
+        """
+        Push every key through the pipeline and wait for the last publish to finish
+        @param keys iterable of ratingKeys, consumed lazily
+        @param on_key_done called with each key once all of its jobs are published (or it had none)
+        """
+        ready = queue.Queue(maxsize=self.queue_size)
+        feeder = threading.Thread(target=self._feed, args=(keys, ready), daemon=True)
+        feeder.start()
+
+        pending = BackendQueues(self.storage)  # Jobs taken off the queue, waiting for a decode slot
+        remaining = {}  # key -> jobs not published yet
+        decoding = {}  # future -> (key, job, device, tokens, backend, reads, reservation)
+        publishing = {}  # future -> (key, reservation)
+        flushing = {}  # future returned by publish -> reservation
+        feeding = True
+
+        def key_done(key):
+            remaining[key] -= 1
+            if remaining[key] <= 0:
+                del remaining[key]
+                if on_key_done:
+                    on_key_done(key)
+
+        with ProcessPoolExecutor(max_workers=self.scheduler.pool_size, initializer=self.initializer, initargs=self.initargs) as decoders, \
+                ThreadPoolExecutor(max_workers=self.publish_workers) as publishers:
+            while feeding or pending or decoding or publishing or flushing:
+                # Keep every decode slot busy, but hold back if publishing has fallen behind
+                while len(publishing) < self.publish_workers * 2:
+                    backend = pending.next_backend()
+                    if backend is not None:
+                        reservation = None
+                        if self.reserve:
+                            reservation = self.reserve(pending.peek(backend)[1])
+                            if reservation is None:
+                                break
+                        device, token = self.scheduler.try_acquire()
+                        if device is None:
+                            if reservation is not None:
+                                self.release(reservation)
+                            break
+                        key, job = pending.peek(backend)
+                        slots = job.get('slots', 1)
+                        wanted = job.get('reads', slots)
+                        reads = 1 + pending.room(backend, wanted - 1)
+                        tokens = [token] + self.scheduler.try_acquire_more(device, min(slots, reads) - 1)
+                        if wanted <= slots:
+                            # Every read runs in a slot of its own
+                            reads = len(tokens)
+                        if slots > 1 or reads > 1:
+                            job = dict(job, slots=len(tokens), reads=reads)
+                        pending.pop(backend, reads)
+                        decoding[decoders.submit(self.decode, job, device)] = (key, job, device, tokens, backend, reads, reservation)
+                        continue
+
+                    # Nothing we can start yet, pull in more work so a backend with room gets a turn
+                    if not feeding or len(pending) >= self.queue_size:
+                        break
+                    try:
+                        item = ready.get(timeout=0.1) if (decoding or publishing or flushing) else ready.get()
+                    except queue.Empty:
+                        break
+                    if item is _END:
+                        feeding = False
+                        break
+                    key, jobs = item
+                    remaining[key] = remaining.get(key, 0) + max(1, len(jobs))
+                    if not jobs:
+                        key_done(key)
+                    for job in jobs:
+                        pending.push(job.get('backend', DEFAULT_BACKEND), (key, job))
+                self.scheduler.set_waiting(len(pending) + ready.qsize())
+                self.backlog = pending.depths()
+
+                if not (decoding or publishing or flushing):
+                    continue
+                done, _ = wait(list(decoding) + list(publishing) + list(flushing), timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in flushing:
+                        # The staged copies are gone, let the next job have the room
+                        self.release(flushing.pop(future))
+                    elif future in decoding:
+                        key, job, device, tokens, backend, reads, reservation = decoding.pop(future)
+                        for token in tokens:
+                            self.scheduler.release(device, token)
+                        pending.done(backend, reads)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            logger.error('Error decoding {}. `{}:{}`'.format(key, type(e).__name__, str(e)))
+                            result = None
+                        publishing[publishers.submit(self.publish, job, result)] = (key, reservation)
+                    else:
+                        key, reservation = publishing.pop(future)
+                        staged = None
+                        try:
+                            staged = future.result()
+                        except Exception as e:
+                            logger.error('Error publishing {}. `{}:{}`'.format(key, type(e).__name__, str(e)))
+                        if reservation is not None and staged is not None:
+                            flushing[staged] = reservation
+                        elif reservation is not None:
+                            # The frames are written out and freed, let the next job have the room
+                            self.release(reservation)
+                        key_done(key)
+
+        feeder.join()
@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 import sys
 import re
-import subprocess
 import shutil
 import glob
 import os
-import struct
 import urllib3
-import array
 import time
-from concurrent.futures import ProcessPoolExecutor
-from pathlib import Path
+import threading
+import queue
+import multiprocessing
+from concurrent.futures import Future
 from plexapi.video import Episode
+from plexapi.exceptions import NotFound
 from generateGlobals import *
+from bif_writer import BifBuilder
+from bif_publisher import BifPublisher, gather
+from bif_store import BifStore, fingerprint
+from staging import StagingBudget
+from jpeg_optimizer import JpegOptimizer
+from metrics import Metrics, COUNTER, GAUGE, serve_metrics, follow_progress
+from autoscaler import Autoscaler
+from job_ledger import JobLedger, DONE, FAILED
+from bif_scanner import BifScanner, write_repair_list
+from bundle_inventory import BundleInventory
+from pipeline import PreviewPipeline
+from decode_scheduler import DecodeScheduler, make_backend, CPU
+from storage_backends import StorageBackends
+from path_resolver import PathResolver, as_list
+from media_probe import MediaProbe
+from notifications import ready_keys, Debouncer, PlexNotificationSource
+from watermarks import SectionWatermarks
+from library_pager import SectionPager
+from extraction import (video_filter, scale_filter, split_filter, full_decode_args, split_decode_args, split_outputs, run_pipes,
+                        extract_sparse, extract_sparse_split, extract_segmented, extract_segmented_split, parse_variants, choose_mode,
+                        PIPE_OUTPUT, MULTI_PIPE, FULL, SPARSE)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -21,6 +42,14 @@ PLEX_URL = os.environ.get('PLEX_URL', 'https://192.168.0.59:32400/')  # Plex ser
 PLEX_TOKEN = os.environ.get('PLEX_TOKEN', 'WPz3dw8jK36NNbAKvcoY')  # Plex Authentication Token WPz3dw8jK36NNbAKvcoY  ### fxFNLRwxuHdMdusJ6rof
 PLEX_BIF_FRAME_INTERVAL = int(os.environ.get('PLEX_BIF_FRAME_INTERVAL', 5))  # Interval between preview images
 THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 2))  # Preview image quality (2-6)
+# Preview sizes made from the one decode, each written as index-NAME.bif: NAME=WIDTHxHEIGHT@quality separated by ; (quality defaults to THUMBNAIL_QUALITY)
+BIF_VARIANTS = os.environ.get('BIF_VARIANTS', 'sd=320x240')  # eg: sd=320x240;hd=640x360@3
+JPEG_OPTIMIZE = int(os.environ.get('JPEG_OPTIMIZE', 0)) == 1  # Re-encode the frames (needs Pillow) before the BIF is built, lowering the quality only where a budget below needs it
+JPEG_FRAME_BUDGET_KB = float(os.environ.get('JPEG_FRAME_BUDGET_KB', 0))  # Most KB per frame when JPEG_OPTIMIZE is on (0 = no cap)
+JPEG_BIF_BUDGET_KB = float(os.environ.get('JPEG_BIF_BUDGET_KB', 0))  # Most KB per BIF when JPEG_OPTIMIZE is on, shared evenly between its frames (0 = no cap)
+JPEG_MIN_QUALITY = int(os.environ.get('JPEG_MIN_QUALITY', 30))  # Lowest JPEG quality (1-95) a budget may take a frame down to
+JPEG_PROGRESSIVE = int(os.environ.get('JPEG_PROGRESSIVE', 0)) == 1  # Write progressive JPEGs, a little smaller (check your clients show them)
+JPEG_THREADS = int(os.environ.get('JPEG_THREADS', 4))  # Threads re-encoding frames, shared by every job
 PLEX_LOCAL_MEDIA_PATH = os.environ.get('PLEX_LOCAL_MEDIA_PATH', 'O:/')  # Local Plex media path
 TMP_FOLDER = os.environ.get('TMP_FOLDER', 'G:/Temp/vpt')  # Temporary folder for preview generation
 PLEX_TIMEOUT = int(os.environ.get('PLEX_TIMEOUT', 60))  # Timeout for Plex API requests (seconds)
@@ -30,27 +59,68 @@ PLEX_TIMEOUT = int(os.environ.get('PLEX_TIMEOUT', 60))  # Timeout for Plex API r
 PLEX_LOCAL_VIDEOS_PATH_MAPPING = os.environ.get('PLEX_LOCAL_VIDEOS_PATH_MAPPING', 'Y:')  # Local video path (Usually ending in "/Union/" for the script ###Change this to where the videos are relative to the encoder, or if merged use the local path to make it faaast  U:/
 PLEX_LOCAL_VIDEOS_PATH_ARRAY = os.environ.get('PLEX_LOCAL_VIDEOS_PATH_ARRAY', ['G:/LinuxShare/Union', 'P:/Union', 'K:/Union', 'L:/Union','W:/Union', 'Y:']) ### Sean Added for using backends instead of Union ###
 PLEX_VIDEOS_PATH_MAPPING = os.environ.get('PLEX_VIDEOS_PATH_MAPPING', '/mnt/Union')  # Plex server video path    the normal path for above  ^'//192.168.0.27/Union/' ^
+PATH_CACHE_TTL = int(os.environ.get('PATH_CACHE_TTL', 3600))  # Seconds to remember which local path served a folder
+PATH_MISS_TTL = int(os.environ.get('PATH_MISS_TTL', 300))  # Seconds to remember a file could not be found locally
 
 GPU_THREADS = int(os.environ.get('GPU_THREADS', 4))  # Number of GPU threads for preview generation
 CPU_THREADS = int(os.environ.get('CPU_THREADS', 0))  # Number of CPU threads for preview generation
+AUTOSCALE = int(os.environ.get('AUTOSCALE', 0)) == 1  # Add/remove decode slots during the run, following throughput and host load
+AUTOSCALE_MIN_SLOTS = int(os.environ.get('AUTOSCALE_MIN_SLOTS', 1))  # Fewest decode slots the autoscaler goes down to
+AUTOSCALE_MAX_SLOTS = int(os.environ.get('AUTOSCALE_MAX_SLOTS', 0))  # Most decode slots the autoscaler goes up to (0 = twice GPU_THREADS + CPU_THREADS)
+AUTOSCALE_INTERVAL = int(os.environ.get('AUTOSCALE_INTERVAL', 60))  # Seconds between autoscaler decisions
+AUTOSCALE_MAX_LOAD = float(os.environ.get('AUTOSCALE_MAX_LOAD', 1.0))  # Load average per CPU above which a slot is removed
+AUTOSCALE_MAX_IOWAIT = float(os.environ.get('AUTOSCALE_MAX_IOWAIT', 30))  # % of CPU time in I/O wait above which a slot is removed
+AUTOSCALE_MIN_GAIN = float(os.environ.get('AUTOSCALE_MIN_GAIN', 0.05))  # Frames/s gain (0.05 = 5%) an added slot has to bring to be kept
+AUTOSCALE_MAX_SLOT_DROP = float(os.environ.get('AUTOSCALE_MAX_SLOT_DROP', 0.3))  # Fall in frames/s per busy slot (0.3 = 30%) between decisions at which a slot is removed, 0 = off
+GPU_BACKEND = os.environ.get('GPU_BACKEND', 'nvidia')  # How GPUs are found: nvidia, none, or fake:N to test with N pretend GPUs
+STREAM_FRAMES = int(os.environ.get('STREAM_FRAMES', 1)) == 1  # Pipe frames from ffmpeg straight into the BIF instead of writing JPEGs to TMP_FOLDER
+STAGING_TMP_MB = int(os.environ.get('STAGING_TMP_MB', 0))  # Most MB of JPEGs in flight in TMP_FOLDER (0 = as much as the filesystem has free)
+STAGING_DISK_FOLDER = os.environ.get('STAGING_DISK_FOLDER', '')  # Disk folder for the JPEGs of jobs that don't fit in TMP_FOLDER, emptied at start and exit like TMP_FOLDER ('' = hold them until TMP_FOLDER has room)
+STAGING_DISK_MB = int(os.environ.get('STAGING_DISK_MB', 0))  # Most MB of JPEGs in flight in STAGING_DISK_FOLDER (0 = as much as the filesystem has free)
+STAGING_MEMORY_MB = int(os.environ.get('STAGING_MEMORY_MB', 2048))  # Most MB of streamed frames held in memory across jobs in flight (0 = no cap)
+STAGING_MIN_FREE_MB = int(os.environ.get('STAGING_MIN_FREE_MB', 256))  # Free space a staging folder's filesystem must keep on top of a job
+STAGING_FRAME_KB = int(os.environ.get('STAGING_FRAME_KB', 24))  # Estimated size of one 320x240 preview JPEG (scaled by area for other sizes), used to work out each job's footprint from its duration
+LEDGER_PATH = os.environ.get('LEDGER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plex_generate_previews.db'))  # Local job ledger used to resume where the last run stopped
+LEDGER_MAX_ATTEMPTS = int(os.environ.get('LEDGER_MAX_ATTEMPTS', 3))  # Stop retrying a file after this many failures (until the file changes)
+PROBE_TIMEOUT = int(os.environ.get('PROBE_TIMEOUT', 30))  # Seconds before giving up on ffprobe for a file
+RESOLVE_THREADS = int(os.environ.get('RESOLVE_THREADS', 4))  # Threads resolving Plex metadata, paths and HDR info ahead of the ffmpeg workers
+PUBLISH_THREADS = int(os.environ.get('PUBLISH_THREADS', 2))  # Threads writing finished BIFs
+# Other bundle stores every BIF is copied to as well as PLEX_LOCAL_MEDIA_PATH (eg: another Plex server's Media/localhost folder), separated by ;
+PUBLISH_MIRRORS = os.environ.get('PUBLISH_MIRRORS', '\\\\192.168.10.3\\internal\\Android\\data\\com.plexapp.mediaserver.smb\\Plex Media Server\\Media\\localhost\\')
+PUBLISH_COPY_THREADS = int(os.environ.get('PUBLISH_COPY_THREADS', 2))  # Threads copying staged BIFs out to PLEX_LOCAL_MEDIA_PATH and the mirrors
+PUBLISH_RETRIES = int(os.environ.get('PUBLISH_RETRIES', 3))  # Times a failed copy to a target is retried
+PUBLISH_RETRY_SECONDS = int(os.environ.get('PUBLISH_RETRY_SECONDS', 30))  # Wait before retrying a failed copy
+SCAN_THREADS = int(os.environ.get('SCAN_THREADS', 32))  # Threads listing PLEX_LOCAL_MEDIA_PATH for the bundle inventory, and checking its BIFs in Repair
+BUNDLE_INVENTORY = int(os.environ.get('BUNDLE_INVENTORY', 1)) == 1  # List which bundles have a preview once (then only what changed between batches) instead of checking every file on the share
+REPAIR_LIST_PATH = os.environ.get('REPAIR_LIST_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plex_generate_previews_repair.jsonl'))  # Repair: where the broken BIFs found are listed
+BIF_STORE_PATH = os.environ.get('BIF_STORE_PATH', '')  # Folder keeping every BIF made, keyed by a fingerprint of the video, so a new bundle hash for the same file is linked rather than decoded again. Nothing is ever removed from it ('' = off)
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 0))  # Resolved jobs allowed to wait for a decode slot (0 = twice the number of workers)
+RESOLVE_BATCH_SIZE = int(os.environ.get('RESOLVE_BATCH_SIZE', 100))  # Number of items to fetch MediaPart info for in a single Plex request
+# Storage each file is read from, matched on the path Plex reports: NAME=prefix@max concurrent decodes, separated by ;
+STORAGE_BACKENDS = os.environ.get('STORAGE_BACKENDS', 'RCLONE=/rclone@4;ZPOOL1=/zfs/zpool1@2;ZPOOL2=/zfs/zpool2@2;ZPOOL3=/zfs/zpool3@2;'
+                                  'ZPOOL4=/zfs/zpool4@2;ZPOOL5=/zfs/zpool5@2;ZPOOL6=/zfs/zpool6@2')
+STORAGE_DEFAULT_LIMIT = int(os.environ.get('STORAGE_DEFAULT_LIMIT', 0))  # Max concurrent decodes for files matching none of STORAGE_BACKENDS (0 = no limit)
+DEBOUNCE_SECONDS = float(os.environ.get('DEBOUNCE_SECONDS', 30))  # Daemon: wait this long after the last notification before starting a batch
+DEBOUNCE_MAX_SECONDS = float(os.environ.get('DEBOUNCE_MAX_SECONDS', 300))  # Daemon: never hold a batch back longer than this
+SECTION_PAGE_SIZE = int(os.environ.get('SECTION_PAGE_SIZE', 500))  # Items asked for per request when listing a library section
+SECTION_FILTER = os.environ.get('SECTION_FILTER', '')  # Extra query string for section listings, to have the server drop items already done
+RECONNECT_SECONDS = int(os.environ.get('RECONNECT_SECONDS', 30))  # Daemon: wait before reconnecting to the notification stream
+EXTRACTION_MODE = os.environ.get('EXTRACTION_MODE', 'auto')  # full decodes every file, sparse seeks to each keyframe, auto picks sparse for big files on SPARSE_BACKENDS
+SPARSE_BACKENDS = as_list(os.environ.get('SPARSE_BACKENDS', 'RCLONE'))  # Storage backends (names from STORAGE_BACKENDS) slow enough that seeking beats reading the whole file
+SPARSE_MIN_SIZE_MB = int(os.environ.get('SPARSE_MIN_SIZE_MB', 2048))  # Smallest file auto mode will extract sparsely
+SPARSE_MIN_BITRATE = float(os.environ.get('SPARSE_MIN_BITRATE', 4))  # Lowest bitrate (Mbit/s) auto mode will extract sparsely
+SPARSE_THREADS = int(os.environ.get('SPARSE_THREADS', 4))  # Most seeks in flight at once per file in sparse mode, each counts against its STORAGE_BACKENDS limit
+SEGMENT_MIN_MINUTES = int(os.environ.get('SEGMENT_MIN_MINUTES', 0))  # Full decode files at least this long as SEGMENT_COUNT parts at once (0 = off)
+SEGMENT_COUNT = int(os.environ.get('SEGMENT_COUNT', 4))  # Most parts (an ffmpeg and a decode slot each) a long file is cut into
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # Serve Prometheus metrics (live ffmpeg progress, queue depths, failures...) on this port at /metrics (0 = off)
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')  # Address the metrics endpoint listens on
+
+PREVIEW_VARIANTS = parse_variants(BIF_VARIANTS, THUMBNAIL_QUALITY)
+DEFAULT_VARIANTS = 'sd=320x240'
 
 # Set the timeout envvar for https://github.com/pkkid/python-plexapi
 os.environ["PLEXAPI_PLEXAPI_TIMEOUT"] = str(PLEX_TIMEOUT)
 
-if not shutil.which("mediainfo"):
-    print('MediaInfo not found.  MediaInfo must be installed and available in PATH.')
-    sys.exit(1)
-try:
-    from pymediainfo import MediaInfo
-except ImportError:
-    print('Dependencies Missing!  Please run "pip3 install pymediainfo".')
-    sys.exit(1)
-try:
-    import gpustat
-except ImportError:
-    print('Dependencies Missing!  Please run "pip3 install gpustat".')
-    sys.exit(1)
-
 try:
     import requests
 except ImportError:
@@ -81,11 +151,23 @@ except ImportError:
     print('Dependencies Missing!  Please run "pip3 install rich".')
     sys.exit(1)
 
+if JPEG_OPTIMIZE:
+    try:
+        import PIL
+    except ImportError:
+        print('Dependencies Missing!  Please run "pip3 install pillow".')
+        sys.exit(1)
+
 FFMPEG_PATH = shutil.which("ffmpeg")
 if not FFMPEG_PATH:
     print('FFmpeg not found.  FFmpeg must be installed and available in PATH.')
     sys.exit(1)
 
+FFPROBE_PATH = shutil.which("ffprobe")
+if not FFPROBE_PATH:
+    print('FFprobe not found.  FFprobe (part of FFmpeg) must be installed and available in PATH.')
+    sys.exit(1)
+
 # Logging setup
 console = Console()
 logger.remove()
@@ -100,52 +182,84 @@ logger.add(
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-def generate_images(video_file_param, output_folder):
-    video_file = video_file_param.replace(PLEX_VIDEOS_PATH_MAPPING, PLEX_LOCAL_VIDEOS_PATH_MAPPING)
-    ogFile = Path(video_file_param.replace(PLEX_VIDEOS_PATH_MAPPING, ""))
-    
-    logfile=Path("G:/VPT-Processing/"+ogFile.stem+".txt")
-    logfile.parent.mkdir(exist_ok=True, parents=True)
-    with open(logfile, 'w') as file:
-        file.write("Processing")
-    media_info = MediaInfo.parse(video_file)
-    vf_parameters = "fps=fps={}:round=up,scale=w=320:h=240:force_original_aspect_ratio=decrease".format(
-        round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
-
-    # Check if we have a HDR Format. Note: Sometimes it can be returned as "None" (string) hence the check for None type or "None" (String)
-    if media_info.video_tracks:
-        if media_info.video_tracks[0].hdr_format != "None" and media_info.video_tracks[0].hdr_format is not None:
-            vf_parameters = "fps=fps={}:round=up,zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p,scale=w=320:h=240:force_original_aspect_ratio=decrease".format(round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
-
-    args = [
-        FFMPEG_PATH, "-loglevel", "info", "-skip_frame:v", "nokey", "-threads:0", "1", "-i",
-        video_file, "-an", "-sn", "-dn", "-q:v", str(THUMBNAIL_QUALITY),
-        "-vf",
-        vf_parameters, '{}/img-%06d.jpg'.format(output_folder)
-    ]
+def is_hdr(video_file):
+    return get_probe().probe(video_file)['hdr']
+
 
+def generate_images(video_file, output_folder=None, hdr=None, device=None, mode=FULL, duration=None, on_progress=None, segments=1,
+                    threads=SPARSE_THREADS):
+    """
+    Extract the preview frames for a video with ffmpeg, a set for each of PREVIEW_VARIANTS from a single
+    decode (the frames are split and scaled once per variant, so each extra size only costs the encode)
+    @param video_file local path to the video
+    @param output_folder Directory to write the images to (a folder per variant in it), if None the frames are streamed from ffmpeg
+    @param hdr Whether the video needs tone mapping, probed if None
+    @param device Decode device handed out by the DecodeScheduler, eg: 'cuda:0' or 'cpu' (None = cpu)
+    @param mode 'full' decodes the whole stream, 'sparse' seeks to the keyframe at each interval (needs duration, always streams)
+    @param duration length of the video in seconds
+    @param on_progress called with ffmpeg's progress reports (dicts of -progress keys) while it runs
+    @param segments full decode the video as this many parts at once (needs duration, always streams), 1 for one ffmpeg
+    @param threads seeks in flight at once in sparse mode
+    @return dict of variant name -> list of JPEGs, None when writing to output_folder
+    Raises RuntimeError when ffmpeg fails or gives no frames, so a partial preview is never published
+    """
+    if hdr is None:
+        hdr = is_hdr(video_file)
     start = time.time()
-    hw = False
+    hw = device is not None and device != CPU
+    names = [variant['name'] for variant in PREVIEW_VARIANTS]
+    single = PREVIEW_VARIANTS[0] if len(PREVIEW_VARIANTS) == 1 else None
 
-    gpu_stats_query = gpustat.core.new_query()
-    gpu = gpu_stats_query[0] if gpu_stats_query else None
-    if gpu:
-        gpu_ffmpeg = [c for c in gpu.processes if c["command"].lower().startswith("ffmpeg")]
-        if len(gpu_ffmpeg) < GPU_THREADS or CPU_THREADS == 0:
-            hw = True
-            args.insert(5, "-hwaccel")
-            args.insert(6, "cuda")
+    if mode == SPARSE:
+        if single:
+            streams = [extract_sparse(FFMPEG_PATH, video_file, duration, PLEX_BIF_FRAME_INTERVAL,
+                                      video_filter(PLEX_BIF_FRAME_INTERVAL, hdr, fps=False, scale=scale_filter(single['width'], single['height'])),
+                                      single['quality'], device=device, threads=threads, on_progress=on_progress)]
+        else:
+            streams = extract_sparse_split(FFMPEG_PATH, video_file, duration, PLEX_BIF_FRAME_INTERVAL, PREVIEW_VARIANTS, hdr,
+                                           device=device, threads=threads, on_progress=on_progress)
+        seconds = round(time.time() - start, 1)
+        logger.info('Generated Video Preview for {} in {} HW={} TIME={}seconds MODE=sparse FRAMES={} '.format(os.path.basename(video_file), str(video_file)[:2], hw, seconds, len(streams[0])))
+        return dict(zip(names, streams))
 
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if segments > 1 and output_folder is None:
+        if single:
+            streams = [extract_segmented(FFMPEG_PATH, video_file, duration, PLEX_BIF_FRAME_INTERVAL,
+                                         video_filter(PLEX_BIF_FRAME_INTERVAL, hdr, scale=scale_filter(single['width'], single['height']), segment=True),
+                                         single['quality'], segments, device=device, on_progress=on_progress)]
+        else:
+            streams = extract_segmented_split(FFMPEG_PATH, video_file, duration, PLEX_BIF_FRAME_INTERVAL, PREVIEW_VARIANTS, segments,
+                                              hdr, device=device, on_progress=on_progress)
+        seconds = round(time.time() - start, 1)
+        logger.info('Generated Video Preview for {} in {} HW={} TIME={}seconds MODE=segmented SEGMENTS={} FRAMES={} '.format(os.path.basename(video_file), str(video_file)[:2], hw, seconds, segments, len(streams[0])))
+        return dict(zip(names, streams))
 
-    # Allow time for it to start
-    time.sleep(1)
+    folders = None
+    if output_folder is not None:
+        folders = [os.path.join(output_folder, name) for name in names]
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+    if single:
+        vf_parameters = video_filter(PLEX_BIF_FRAME_INTERVAL, hdr, scale=scale_filter(single['width'], single['height']))
+        output = PIPE_OUTPUT if folders is None else ['{}/img-%06d.jpg'.format(folders[0])]
+        args = full_decode_args(FFMPEG_PATH, video_file, vf_parameters, single['quality'], output, device,
+                                progress=on_progress is not None)
+        pipes = []
+    else:
+        outputs, pipes = split_outputs(PREVIEW_VARIANTS, folders)
+        args = split_decode_args(FFMPEG_PATH, video_file, split_filter(PLEX_BIF_FRAME_INTERVAL, PREVIEW_VARIANTS, hdr),
+                                 outputs, device, progress=on_progress is not None)
 
-    out, err = proc.communicate()
-    if proc.returncode != 0:
+    streams, returncode, err = run_pipes(args, pipes, on_progress)
+    if returncode != 0:
         err_lines = err.decode('utf-8', 'ignore').split('\n')[-5:]
         logger.error(err_lines)
-        logger.error('Problem trying to ffmpeg images for {}'.format(video_file))
+        # Whatever came out before it failed is a partial preview, don't let it be published as a whole one
+        raise RuntimeError('ffmpeg exited with {}'.format(returncode))
+    if folders is not None:
+        streams = [glob.glob('{}/img*.jpg'.format(folder)) for folder in folders]
+    if not all(streams):
+        raise RuntimeError('No frames could be extracted from {}'.format(video_file))
 
     # Speed
     end = time.time()
@@ -155,91 +269,294 @@ def generate_images(video_file_param, output_folder):
         speed = speed[-1]
 
     # Optimize and Rename Images
-    for image in glob.glob('{}/img*.jpg'.format(output_folder)):
-        frame_no = int(os.path.basename(image).strip('-img').strip('.jpg')) - 1
-        frame_second = frame_no * PLEX_BIF_FRAME_INTERVAL
-        os.rename(image, os.path.join(output_folder, '{:010d}.jpg'.format(frame_second)))
+    for folder in folders or []:
+        for image in glob.glob('{}/img*.jpg'.format(folder)):
+            frame_no = int(os.path.basename(image).strip('-img').strip('.jpg')) - 1
+            frame_second = frame_no * PLEX_BIF_FRAME_INTERVAL
+            os.rename(image, os.path.join(folder, '{:010d}.jpg'.format(frame_second)))
 
     logger.info('Generated Video Preview for {} in {} HW={} TIME={}seconds SPEED={}x '.format(os.path.basename(video_file), str(video_file)[:2], hw, seconds, speed))
-    logfile.unlink()
+    return None if folders is not None else dict(zip(names, streams))
+
+
+def build_bif(images):
+    """
+    Collect the frames for a .bif
+    @param images Directory of image files 00000001.jpg, or a list of JPEG frames from generate_images
+    @return BifBuilder ready to write
+    """
+    bif = BifBuilder(PLEX_BIF_FRAME_INTERVAL)
+    if isinstance(images, str):
+        image_files = [img for img in os.listdir(images) if os.path.splitext(img)[1] == '.jpg']
+        image_files.sort()
+        for image in image_files:
+            with open(os.path.join(images, image), "rb") as f:
+                bif.add_frame(f.read())
+    else:
+        for frame in images:
+            bif.add_frame(frame)
+    return bif
+
+
+_jpeg_optimizer = None
 
-def generate_bif(bif_filename, images_path):
+
+def get_jpeg_optimizer():
+    """None unless JPEG_OPTIMIZE is on"""
+    global _jpeg_optimizer
+    if _jpeg_optimizer is None and JPEG_OPTIMIZE:
+        _jpeg_optimizer = JpegOptimizer(frame_budget=int(JPEG_FRAME_BUDGET_KB * 1024), bif_budget=int(JPEG_BIF_BUDGET_KB * 1024),
+                                        min_quality=JPEG_MIN_QUALITY, progressive=JPEG_PROGRESSIVE, workers=JPEG_THREADS)
+    return _jpeg_optimizer
+
+
+def optimize_bif(bif, quality, name=''):
+    """
+    Shrink the frames of a BIF with the JPEG optimizer
+    @param quality the -q:v the frames were extracted at
+    @return a new BifBuilder with the re-encoded frames
+    """
+    frames, stats = get_jpeg_optimizer().optimize(bif.frames, quality)
+    optimized = BifBuilder(bif.frame_interval)
+    for frame in frames:
+        optimized.add_frame(frame)
+    saved = stats['bytes_in'] - stats['bytes_out']
+    get_metrics().inc('preview_jpeg_bytes_saved_total', saved)
+    get_metrics().inc('preview_jpeg_optimize_seconds_total', stats['seconds'])
+    logger.info('Optimised {} frames of {}: {:.0f}KB -> {:.0f}KB ({:.0%} smaller) in {:.2f}s'.format(
+        len(frames), name, stats['bytes_in'] / 1024, stats['bytes_out'] / 1024, saved / max(stats['bytes_in'], 1), stats['seconds']))
+    return optimized
+
+
+def generate_bif(bif_filename, images):
     """
     Build a .bif file
     @param bif_filename name of .bif file to create
-    @param images_path Directory of image files 00000001.jpg
-    """
-    magic = [0x89, 0x42, 0x49, 0x46, 0x0d, 0x0a, 0x1a, 0x0a]
-    version = 0
-
-    images = [img for img in os.listdir(images_path) if os.path.splitext(img)[1] == '.jpg']
-    images.sort()
-
-    f = open(bif_filename, "wb")
-    array.array('B', magic).tofile(f)
-    f.write(struct.pack("<I", version))
-    f.write(struct.pack("<I", len(images)))
-    f.write(struct.pack("<I", 1000 * PLEX_BIF_FRAME_INTERVAL))
-    array.array('B', [0x00 for x in range(20, 64)]).tofile(f)
-
-    bif_table_size = 8 + (8 * len(images))
-    image_index = 64 + bif_table_size
-    timestamp = 0
-
-    # Get the length of each image
-    for image in images:
-        statinfo = os.stat(os.path.join(images_path, image))
-        f.write(struct.pack("<I", timestamp))
-        f.write(struct.pack("<I", image_index))
-        timestamp += 1
-        image_index += statinfo.st_size
-
-    f.write(struct.pack("<I", 0xffffffff))
-    f.write(struct.pack("<I", image_index))
-
-    # Now copy the images
-    for image in images:
-        data = open(os.path.join(images_path, image), "rb").read()
-        f.write(data)
-
-    f.close()
-    ### Sean Additions ###
-    noTopDir = os.path.join(*(bif_filename.split("/")[1:]))
-    # print(f"bif = {bif_filename}")
-    shieldLocation = os.path.join("\\\\192.168.10.3\\internal\\Android\\data\\com.plexapp.mediaserver.smb\\Plex Media Server\\Media\\localhost\\",noTopDir)
-    os.makedirs(os.path.dirname(shieldLocation),exist_ok=True)
-    shutil.copy(bif_filename, shieldLocation)
+    @param images Directory of image files 00000001.jpg, or a list of JPEG frames from generate_images
+    """
+    bif = build_bif(images)
+    bif.write(bif_filename)
+    return bif.size
 
 
-def process_item(item_key):
-    sess = requests.Session()
-    sess.verify = False
-    plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
+_bif_store = None
+
+
+def get_bif_store():
+    """The store of generated BIFs, None if BIF_STORE_PATH is blank"""
+    global _bif_store
+    if _bif_store is None and BIF_STORE_PATH:
+        _bif_store = BifStore(BIF_STORE_PATH)
+    return _bif_store
+
+
+def media_fingerprint(media_file, file_size=None):
+    """Store key for a video, it includes the settings the BIF depends on"""
+    salt = '{}:{}'.format(PLEX_BIF_FRAME_INTERVAL, THUMBNAIL_QUALITY)
+    if BIF_VARIANTS != DEFAULT_VARIANTS:
+        salt += ':' + BIF_VARIANTS
+    if JPEG_OPTIMIZE:
+        salt += ':jpeg:{}:{}:{}:{}'.format(JPEG_FRAME_BUDGET_KB, JPEG_BIF_BUDGET_KB, JPEG_MIN_QUALITY, JPEG_PROGRESSIVE)
+    return fingerprint(media_file, int(file_size) if file_size else None, salt=salt)
+
+
+def variant_key(key, variant):
+    """Store key for one variant, the first is stored under the video's own key"""
+    return key if variant is PREVIEW_VARIANTS[0] else '{}-{}'.format(key, variant['name'])
+
+
+def variant_rel(index_rel, variant):
+    """'.../Contents/Indexes/index-sd.bif' -> the same folder's index-<variant>.bif"""
+    return '{}/index-{}.bif'.format(index_rel.rsplit('/', 1)[0], variant['name'])
+
+
+def record_publish(bundle_hash, output_size, frames=0):
+    """
+    Callback for the publisher, records the outcome once every target has been written. A job that
+    missed any target is FAILED even if its BIF is in the bundle, so the next run publishes it again
+    instead of taking it for an existing preview
+    """
+    def published(errors):
+        # Called on a publisher thread, so it gets that thread's ledger connection
+        if errors:
+            get_ledger().finish(bundle_hash, FAILED, error='; '.join(errors))
+            get_metrics().inc('preview_failures_total', stage='publish')
+        else:
+            get_ledger().finish(bundle_hash, DONE, output_size=output_size)
+            if get_inventory() is not None:
+                get_inventory().add(bundle_hash)
+            get_metrics().inc('preview_jobs_done_total')
+            get_metrics().inc('preview_bytes_written_total', output_size)
+            get_metrics().inc('preview_frames_total', frames)
+    return published
+
+
+_publisher = None
+
 
-    data = plex.query('{}/tree'.format(item_key))
+def get_publisher():
+    """Copies finished BIFs out to PLEX_LOCAL_MEDIA_PATH and PUBLISH_MIRRORS in the background"""
+    global _publisher
+    if _publisher is None:
+        _publisher = BifPublisher([PLEX_LOCAL_MEDIA_PATH] + as_list(PUBLISH_MIRRORS), os.path.join(TMP_FOLDER, 'publish'),
+                                  workers=PUBLISH_COPY_THREADS, retries=PUBLISH_RETRIES, retry_delay=PUBLISH_RETRY_SECONDS)
+    return _publisher
 
-    for media_part in data.findall('.//MediaPart'):
+
+_inventory = None
+
+
+def get_inventory(refresh=False):
+    """
+    Which bundles in PLEX_LOCAL_MEDIA_PATH have a preview, listed on first use, None if BUNDLE_INVENTORY is off
+    @param refresh list what changed on the share since the last call
+    """
+    global _inventory
+    if not BUNDLE_INVENTORY:
+        return None
+    if _inventory is None:
+        _inventory = BundleInventory(PLEX_LOCAL_MEDIA_PATH, workers=SCAN_THREADS,
+                                     index_name='index-{}.bif'.format(PREVIEW_VARIANTS[0]['name']))
+        refresh = True
+    if refresh:
+        stats = _inventory.refresh()
+        logger.info('Bundle inventory: {bundles} bundles, {previews} with previews. Listed {listed} prefix folders '
+                    'and checked {checked} bundles in {seconds}s'.format(**stats))
+    return _inventory
+
+
+_local = threading.local()
+
+
+def get_ledger():
+    """The job ledger for this thread, sqlite connections can't be shared between threads or pool workers"""
+    if not hasattr(_local, 'ledger'):
+        _local.ledger = JobLedger(LEDGER_PATH, max_attempts=LEDGER_MAX_ATTEMPTS)
+    return _local.ledger
+
+
+def get_probe():
+    """The media probe cache for this thread, kept in the ledger database"""
+    if not hasattr(_local, 'probe'):
+        _local.probe = MediaProbe(LEDGER_PATH, ffprobe=FFPROBE_PATH, timeout=PROBE_TIMEOUT)
+    return _local.probe
+
+
+def get_plex():
+    """The Plex connection for this thread"""
+    if not hasattr(_local, 'plex'):
+        sess = requests.Session()
+        sess.verify = False
+        _local.plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
+    return _local.plex
+
+
+_batch_tree = True
+
+
+def fetch_media_parts(keys):
+    """
+    Fetch the MediaParts for a batch of ratingKeys, asking Plex for all of their trees in one request
+    (comma separated ids) and falling back to one request per key for anything it leaves out
+    @return dict of key -> list of MediaPart elements
+    """
+    global _batch_tree
+    plex = get_plex()
+    parts = {}
+    ids = {str(key).rstrip('/').rsplit('/', 1)[-1]: key for key in keys}
+    if _batch_tree and len(ids) > 1:
+        try:
+            data = plex.query('/library/metadata/{}/tree'.format(','.join(ids)))
+        except Exception as e:
+            # Only this batch falls back, the next one asks for all its trees again
+            logger.debug('Batched tree request failed `{}:{}`, falling back to one request per item'.format(type(e).__name__, str(e)))
+        else:
+            for metadata_item in data.findall('MetadataItem'):
+                key = ids.get(metadata_item.attrib.get('id'))
+                if key is not None:
+                    parts[key] = metadata_item.findall('.//MediaPart')
+            if len(parts) <= 1:
+                # This server doesn't answer for more than one id at a time, stop asking
+                _batch_tree = False
+
+    for key in keys:
+        if key not in parts:
+            try:
+                parts[key] = plex.query('{}/tree'.format(key)).findall('.//MediaPart')
+            except NotFound:
+                logger.warning('Item {} no longer exists in Plex library, skipping...'.format(key))
+                parts[key] = []
+            except Exception as e:
+                logger.error('Error processing item {}. `{}:{}` error when fetching media parts'.format(key, type(e).__name__, str(e)))
+                get_metrics().inc('preview_failures_total', stage='resolve')
+    return parts
+
+
+def resolve_items(keys):
+    """
+    Resolve stage, turns a batch of ratingKeys into ready to run jobs (one per MediaPart still missing
+    a preview) so the decode workers never wait on the Plex API, path lookups or ffprobe
+    @return dict of key -> list of jobs
+    """
+    resolved = {}
+    for key, media_parts in fetch_media_parts(keys).items():
+        try:
+            resolved[key] = resolve_parts(key, media_parts)
+        except Exception as e:
+            logger.error('Error processing item {}. `{}:{}` error when resolving media parts'.format(key, type(e).__name__, str(e)))
+            get_metrics().inc('preview_failures_total', stage='resolve')
+    return resolved
+
+
+def resolve_item(item_key):
+    return resolve_items([item_key]).get(item_key, [])
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = StorageBackends.parse(STORAGE_BACKENDS, STORAGE_DEFAULT_LIMIT)
+    return _storage
+
+
+_path_resolver = None
+
+
+def get_path_resolver():
+    global _path_resolver
+    if _path_resolver is None:
+        _path_resolver = PathResolver(
+            [PLEX_VIDEOS_PATH_MAPPING] + as_list(globals().get('PLEX_VIDEOS_PATH_ARRAY', [])),
+            as_list(PLEX_LOCAL_VIDEOS_PATH_ARRAY) + [PLEX_LOCAL_VIDEOS_PATH_MAPPING],
+            ttl=PATH_CACHE_TTL, negative_ttl=PATH_MISS_TTL)
+    return _path_resolver
+
+
+def resolve_parts(item_key, media_parts):
+    ledger = get_ledger()
+    jobs = []
+    for media_part in media_parts:
         if 'hash' in media_part.attrib:
             # Filter Processing by HDD Path
             if len(sys.argv) > 1:
                 if sys.argv[1] not in media_part.attrib['file']:
-                    return
+                    return []
             bundle_hash = media_part.attrib['hash']
             media_file = media_part.attrib['file']
-            if 'PLEX_LOCAL_VIDEOS_PATH_ARRAY' in globals():
-                if len(PLEX_LOCAL_VIDEOS_PATH_ARRAY) > 0:
-                    for local_path in PLEX_LOCAL_VIDEOS_PATH_ARRAY:
-                        if os.path.isfile(media_file.replace(PLEX_VIDEOS_PATH_MAPPING, local_path)):
-                            global PLEX_LOCAL_VIDEOS_PATH_MAPPING
-                            PLEX_LOCAL_VIDEOS_PATH_MAPPING = local_path
-                            # logger.info('PLEX_LOCAL_VIDEOS_PATH_MAPPING = '+PLEX_LOCAL_VIDEOS_PATH_MAPPING)
-                            break
-                            
-            media_file = media_file.replace(PLEX_VIDEOS_PATH_MAPPING, PLEX_LOCAL_VIDEOS_PATH_MAPPING) ### This line was added by sean.
-            # logger.info('media file = '+media_file)
-            if not os.path.isfile(media_file):
+            # Size and updatedAt as Plex reports them, so finished work is skipped without touching either share
+            file_size = media_part.attrib.get('size')
+            file_mtime = media_part.attrib.get('updatedAt')
+            if ledger.should_skip(bundle_hash, file_size, file_mtime):
+                continue
+
+            local_file = get_path_resolver().resolve(media_file)
+            if local_file is None:
                 logger.error('Skipping as file not found {}'.format(media_file))
                 continue
+            media_file = local_file
 
             try:
                 bundle_file = '{}/{}{}'.format(bundle_hash[0], bundle_hash[1::1], '.bundle')
@@ -247,87 +564,536 @@ def process_item(item_key):
                 logger.error('Error generating bundle_file for {} due to {}:{}'.format(media_file, type(e).__name__, str(e)))
                 continue
 
-            bundle_path = os.path.join(PLEX_LOCAL_MEDIA_PATH, bundle_file)
-            indexes_path = os.path.join(bundle_path, 'Contents', 'Indexes')
-            index_bif = os.path.join(indexes_path, 'index-sd.bif')
-            tmp_path = os.path.join(TMP_FOLDER, bundle_hash)
-            if (not os.path.isfile(index_bif)) and (not os.path.isdir(tmp_path)):
-                if not os.path.isdir(indexes_path):
-                    try:
-                        os.makedirs(indexes_path)
-                    except OSError as e:
-                        logger.error('Error generating images for {}. `{}:{}` error when creating index path {}'.format(media_file, type(e).__name__, str(e), indexes_path))
-                        continue
+            # BIFs are renamed into place once complete, so one that exists is a whole one
+            index_rel = '/'.join((bundle_file, 'Contents', 'Indexes', 'index-{}.bif'.format(PREVIEW_VARIANTS[0]['name'])))
+            index_bif = os.path.join(PLEX_LOCAL_MEDIA_PATH, index_rel)
+            inventory = get_inventory()
+            has_preview = inventory.has_preview(bundle_hash) if inventory is not None else None
+            if has_preview is None:
+                # A bundle Plex made since the inventory was listed
+                has_preview = os.path.isfile(index_bif)
+            row = ledger.get(bundle_hash) if has_preview else None
+            if has_preview and not (row is not None and row[0] == FAILED):
+                ledger.record_existing(bundle_hash, item_key, media_file, file_size, file_mtime)
+                continue
+            if not ledger.claim(bundle_hash, item_key, media_file, file_size, file_mtime):
+                continue
 
-                try:
-                    os.makedirs(tmp_path)
-                except OSError as e:
-                    logger.error('Error generating images for {}. `{}:{}` error when creating tmp path {}'.format(media_file, type(e).__name__, str(e), tmp_path))
+            if has_preview:
+                # Our last publish got it into the bundle but not onto every mirror, copy it out again from there.
+                # Targets that already hold it are skipped
+                published = [os.path.join(PLEX_LOCAL_MEDIA_PATH, variant_rel(index_rel, variant)) for variant in PREVIEW_VARIANTS]
+                if all(os.path.isfile(path) for path in published):
+                    logger.info('Publishing the preview for {} to the targets missing it'.format(media_file))
+                    on_done = gather(len(published), record_publish(bundle_hash, sum(os.path.getsize(path) for path in published)))
+                    for variant, path in zip(PREVIEW_VARIANTS, published):
+                        get_publisher().publish(variant_rel(index_rel, variant), path, on_done=on_done)
                     continue
 
+            store_key = None
+            if get_bif_store() is not None:
+                # The same video under another bundle hash (library rebuilt, another server) was done already
                 try:
-                    generate_images(media_part.attrib['file'], tmp_path)
-                except Exception as e:
-                    logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
+                    store_key = media_fingerprint(media_file, file_size)
+                    stored = [get_bif_store().get(variant_key(store_key, variant)) for variant in PREVIEW_VARIANTS]
+                except OSError as e:
+                    logger.warning('Error fingerprinting {}. `{}:{}`'.format(media_file, type(e).__name__, str(e)))
+                    stored = [None]
+                if all(stored):
+                    logger.info('Reusing the stored preview for {}'.format(media_file))
+                    on_done = gather(len(stored), record_publish(bundle_hash, sum(os.path.getsize(path) for path in stored)))
+                    for variant, path in zip(PREVIEW_VARIANTS, stored):
+                        get_publisher().publish(variant_rel(index_rel, variant), path, on_done=on_done)
                     continue
 
-                try:
-                    generate_bif(index_bif, tmp_path)
-                except Exception as e:
-                    # Remove bif, as it prob failed to generate
-                    if os.path.exists(index_bif):
-                        os.remove(index_bif)
-                    logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(media_file, type(e).__name__, str(e)))
-                    continue
-                finally:
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
+            try:
+                probe = get_probe().probe(media_file, file_size, file_mtime, key=media_part.attrib['file'])
+            except Exception as e:
+                logger.error('Error generating images for {}. `{}: {}` error when reading media info'.format(media_file, type(e).__name__, str(e)))
+                ledger.finish(bundle_hash, FAILED, error=str(e))
+                continue
 
+            backend = get_storage().classify(media_part.attrib['file'])
+            duration = int(media_part.attrib.get('duration') or 0) / 1000 or probe['duration']
+            mode = choose_mode(EXTRACTION_MODE, backend, int(file_size or 0), duration, SPARSE_BACKENDS,
+                               min_size=SPARSE_MIN_SIZE_MB * 1024 * 1024, min_bitrate=SPARSE_MIN_BITRATE * 1000000)
+            if mode == SPARSE and not duration:
+                # Can't work out where to seek without knowing how long the video is
+                mode = FULL
+            if mode == SPARSE and len(PREVIEW_VARIANTS) > 1 and not MULTI_PIPE:
+                # Seeks stream every variant back, that takes a pipe per variant
+                mode = FULL
 
-def run():
-    # Ignore SSL Errors
-    sess = requests.Session()
-    sess.verify = False
-    if os.path.exists("G:/VPT-Processing/"):
-        shutil.rmtree("G:/VPT-Processing/")
-    plex = PlexServer(PLEX_URL, PLEX_TOKEN, session=sess)
-
-    if runType == "Currently Playing":
-        for ep in plex.library.onDeck():
-            if isinstance(ep, Episode):
-                unwatched = ep.season().unwatched()
-                media = [m.key for m in unwatched]
-                logger.info('Got {} media files for library {}'.format(len(media), ep.grandparentTitle))
-                with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
-                    with ProcessPoolExecutor(max_workers=CPU_THREADS + GPU_THREADS) as process_pool:
-                        futures = [process_pool.submit(process_item, key) for key in media]
-                        for future in progress.track(futures):
-                            future.result()
-        
-    else:
-        for section in plex.library.sections():
-            logger.info('Getting the media files from library \'{}\''.format(section.title))
-            
-            if section.METADATA_TYPE == 'episode':
-                media = []
-                allEps = section.search(libtype='episode')
-                for i in allEps:
-                    if i.hasPreviewThumbnails != True :
-                        media.append(i.key)
-                # media = [m.key for m in section.search(libtype='episode')] ###Previous before sean edits above
-            elif section.METADATA_TYPE == 'changedSoNoMovies':
-                media = [m.key for m in section.search()]
+            jobs.append({
+                'item_key': item_key,
+                'bundle_hash': bundle_hash,
+                'media_file': media_file,
+                'backend': backend,
+                'mode': mode,
+                'duration': duration,
+                'hdr': probe['hdr'],
+                'probe': probe,
+                'index_bif': index_bif,
+                'index_rel': index_rel,
+                'fingerprint': store_key,
+                'tmp_path': os.path.join(TMP_FOLDER, bundle_hash),
+            })
+            if mode == SPARSE:
+                # Every seek in flight is a read on the backend, the pipeline hands out as many as it has room for
+                jobs[-1]['reads'] = SPARSE_THREADS
+            if mode == FULL and SEGMENT_MIN_MINUTES and SEGMENT_COUNT > 1 and duration and duration >= SEGMENT_MIN_MINUTES * 60 and streams_frames(jobs[-1]):
+                # Long enough that one ffmpeg on one core would hold the run up, decode it in parts at once.
+                # The pipeline hands out as many decode slots and backend reads as are free, up to SEGMENT_COUNT.
+                jobs[-1]['slots'] = SEGMENT_COUNT
+    return jobs
+
+
+def streams_frames(job):
+    """
+    Sparse extraction always hands back the frames, there's no ffmpeg run writing a folder of images.
+    Streaming more than one variant needs a pipe for each, without them (Windows) they go to folders.
+    """
+    if job.get('mode', FULL) == SPARSE:
+        return True
+    return STREAM_FRAMES and (len(PREVIEW_VARIANTS) == 1 or MULTI_PIPE)
+
+
+_staging = None
+
+
+def get_staging():
+    global _staging
+    if _staging is None:
+        mb = 1024 * 1024
+        area = sum(variant['width'] * variant['height'] for variant in PREVIEW_VARIANTS)
+        _staging = StagingBudget([(TMP_FOLDER, STAGING_TMP_MB * mb), (STAGING_DISK_FOLDER, STAGING_DISK_MB * mb)],
+                                 memory_budget=STAGING_MEMORY_MB * mb, frame_bytes=int(STAGING_FRAME_KB * 1024 * area / (320 * 240)),
+                                 interval=PLEX_BIF_FRAME_INTERVAL, min_free=STAGING_MIN_FREE_MB * mb)
+    return _staging
+
+
+def reserve_job(job):
+    """Reserve room for a job's frames before it's dispatched, pointing its tmp_path at the folder it got"""
+    reservation = get_staging().reserve(job.get('duration'), streams_frames(job), key=job['bundle_hash'])
+    if reservation is not None and reservation['path'] is not None:
+        job['tmp_path'] = os.path.join(reservation['path'], job['bundle_hash'])
+    return reservation
+
+
+METRICS = [
+    ('preview_jobs_done_total', COUNTER, 'Previews published to every target'),
+    ('preview_failures_total', COUNTER, 'Jobs that failed, by stage'),
+    ('preview_frames_total', COUNTER, 'Frames in the BIFs published'),
+    ('preview_bytes_written_total', COUNTER, 'Bytes of BIF published (once per job, however many targets)'),
+    ('preview_queue_depth', GAUGE, 'Resolved jobs waiting for a decode slot'),
+    ('preview_backend_waiting', GAUGE, 'Jobs waiting for a decode slot, by storage backend'),
+    ('preview_backend_decoding', GAUGE, 'Jobs decoding, by storage backend'),
+    ('preview_device_jobs_total', COUNTER, 'Jobs dispatched, by device'),
+    ('preview_device_busy_slots', GAUGE, 'Decode slots in use, by device'),
+    ('preview_device_slots', GAUGE, 'Decode slots, by device'),
+    ('preview_staging_reserved_bytes', GAUGE, 'Staging space reserved by jobs in flight, by area'),
+    ('preview_jpeg_bytes_saved_total', COUNTER, 'Bytes the JPEG optimizer took off the frames'),
+    ('preview_jpeg_optimize_seconds_total', COUNTER, 'Seconds spent re-encoding frames'),
+    ('preview_worker_fps', GAUGE, 'Frames per second ffmpeg reports for the job a worker is running'),
+    ('preview_worker_speed', GAUGE, 'Speed (x realtime) ffmpeg reports for the job a worker is running'),
+    ('preview_worker_frames', GAUGE, 'Frames done so far by the job a worker is running'),
+    ('preview_worker_updated_seconds', GAUGE, 'When a worker last reported progress, unix time'),
+]
+
+_metrics = None
+_pipeline = None  # The pipeline running now, for the queue depths
+_progress_queue = None  # Where ffmpeg progress goes while the metrics endpoint is up, set in every decode worker
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+        for name, kind, help_text in METRICS:
+            _metrics.describe(name, kind, help_text)
+    return _metrics
+
+
+def pipeline_samples(scheduler):
+    """Gauges read off the scheduler, pipeline and staging budget when the metrics are scraped"""
+    stats = scheduler.stats()
+    yield 'preview_queue_depth', {}, stats['queue_depth']
+    for device, device_stats in stats['devices'].items():
+        labels = {'device': device, 'kind': 'cpu' if device == CPU else 'gpu'}
+        yield 'preview_device_jobs_total', labels, device_stats['jobs']
+        yield 'preview_device_busy_slots', labels, device_stats['busy']
+        yield 'preview_device_slots', labels, device_stats['slots']
+    for backend, (waiting, decoding) in (_pipeline.backlog if _pipeline else {}).items():
+        yield 'preview_backend_waiting', {'backend': backend}, waiting
+        yield 'preview_backend_decoding', {'backend': backend}, decoding
+    for area, (reserved, _, _) in get_staging().stats()['areas'].items():
+        yield 'preview_staging_reserved_bytes', {'area': area}, reserved
+
+
+def start_metrics(scheduler):
+    """
+    Serve /metrics on METRICS_PORT, with the decode workers reporting ffmpeg's progress back to it.
+    The progress is followed with AUTOSCALE on as well, it's what the autoscaler measures throughput by.
+    """
+    global _progress_queue
+    if not (METRICS_PORT or AUTOSCALE) or _progress_queue is not None:
+        return
+    metrics = get_metrics()
+    _progress_queue = multiprocessing.Queue()
+    follow_progress(_progress_queue, metrics)
+    if METRICS_PORT:
+        metrics.collector(lambda: pipeline_samples(scheduler))
+        serve_metrics(metrics, METRICS_PORT, METRICS_HOST)
+        logger.info('Serving metrics at http://{}:{}/metrics'.format(METRICS_HOST, METRICS_PORT))
+
+
+def decode_rate(stale=30):
+    """
+    Frames/s ffmpeg reports across every decode worker right now
+    @param stale seconds after which a worker that stopped reporting (its job died) counts as idle
+    """
+    metrics = get_metrics()
+    now = time.time()
+    return sum(fps for labels, fps in metrics.series('preview_worker_fps')
+               if now - metrics.get('preview_worker_updated_seconds', **labels) < stale)
+
+
+def init_worker(progress_queue):
+    """Decode worker initializer"""
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def progress_reporter(device):
+    """Callback sending ffmpeg's progress for a job back to the metrics, None if nobody is listening"""
+    if _progress_queue is None:
+        return None
+    worker = str(os.getpid())
+
+    def report(block):
+        _progress_queue.put(dict(block, worker=worker, device=device or CPU))
+    return report
+
+
+def decode_job(job, device):
+    """
+    Decode stage, runs in a pool worker on the device the scheduler picked
+    @return the frames (or the folder holding them when STREAM_FRAMES is off), None on failure
+    """
+    media_file = job['media_file']
+    tmp_path = job['tmp_path']
+    mode = job.get('mode', FULL)
+    stream = streams_frames(job)
+    if not stream:
+        try:
+            os.makedirs(tmp_path)
+        except OSError as e:
+            logger.error('Error generating images for {}. `{}:{}` error when creating tmp path {}'.format(media_file, type(e).__name__, str(e), tmp_path))
+            return None
+
+    try:
+        frames = generate_images(media_file, None if stream else tmp_path, hdr=job['hdr'], device=device,
+                                 mode=mode, duration=job.get('duration'), on_progress=progress_reporter(device),
+                                 segments=job.get('slots', 1), threads=job.get('reads', SPARSE_THREADS))
+    except Exception as e:
+        logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        return None
+    return frames if stream else tmp_path
+
+
+def publish_job(job, images):
+    """
+    Publish stage, builds the BIF for a decoded job and hands it to the publisher, the outcome is
+    recorded in the ledger once every target has it
+    @return Future done once the publisher's staging copies are gone, None if nothing was staged
+    """
+    bundle_hash = job['bundle_hash']
+    if images is None:
+        get_ledger().finish(bundle_hash, FAILED, error='Failed to generate images')
+        get_metrics().inc('preview_failures_total', stage='decode')
+        return
+
+    try:
+        bifs = []
+        for variant in PREVIEW_VARIANTS:
+            if isinstance(images, str):
+                bif = build_bif(os.path.join(images, variant['name']))
             else:
-                logger.info('Skipping library {} as \'{}\' is unsupported'.format(section.title, section.METADATA_TYPE))
+                bif = build_bif(images[variant['name']])
+            if get_jpeg_optimizer() is not None:
+                bif = optimize_bif(bif, variant['quality'], '{} ({})'.format(os.path.basename(job['media_file']), variant['name']))
+            if not len(bif):
+                raise ValueError('No frames for the {} preview'.format(variant['name']))
+            bifs.append(bif)
+        # The ledger entry is finished once every variant is on every target
+        published = record_publish(bundle_hash, sum(bif.size for bif in bifs), len(bifs[0]))
+        staged = Future()
+
+        def flushed(errors):
+            try:
+                published(errors)
+            finally:
+                staged.set_result(None)
+        on_done = gather(len(bifs), flushed)
+        from_store = job.get('fingerprint') and get_bif_store() is not None
+        for variant, bif in zip(PREVIEW_VARIANTS, bifs):
+            source = bif
+            if from_store:
+                # Publish straight from the store, it doubles as the staging copy
+                source = get_bif_store().put(variant_key(job['fingerprint'], variant), bif)
+            get_publisher().publish(variant_rel(job['index_rel'], variant), source, on_done=on_done)
+        # Staging copies in TMP_FOLDER take about the room the frames did, keep the job's reservation until they're gone
+        return None if from_store else staged
+    except Exception as e:
+        logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(job['media_file'], type(e).__name__, str(e)))
+        get_ledger().finish(bundle_hash, FAILED, error=str(e))
+        get_metrics().inc('preview_failures_total', stage='publish')
+    finally:
+        if os.path.exists(job['tmp_path']):
+            shutil.rmtree(job['tmp_path'])
+
+
+def process_item(item_key):
+    """Run every stage for a single item in this process"""
+    for job in resolve_item(item_key):
+        publish_job(job, decode_job(job, None))
+    get_publisher().drain()
+
+
+def process_sources(sources, scheduler):
+    """
+    Push the keys from every source through one resolve -> decode -> publish pipeline, so the worker pool
+    is started once and a slow file in one section never holds up the next section
+    @param sources iterable of (title, keys), consumed lazily. keys is a list or a SectionPager
+    Each source gets its own progress bar, a key turning up in more than one source is only done once.
+    """
+    pipeline = PreviewPipeline(resolve_items, decode_job, publish_job, scheduler,
+                               resolve_workers=RESOLVE_THREADS,
+                               publish_workers=PUBLISH_THREADS,
+                               queue_size=JOB_QUEUE_SIZE,
+                               batch_size=RESOLVE_BATCH_SIZE,
+                               storage=get_storage(),
+                               reserve=reserve_job,
+                               release=get_staging().release,
+                               initializer=init_worker,
+                               initargs=(_progress_queue,))
+    global _pipeline
+    _pipeline = pipeline
+    owner = {}  # key in flight -> progress task of the source it came from
+    seen = set()
+    with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
+        def keys():
+            for title, media in sources:
+                task = progress.add_task(title, total=len(media))
+                if isinstance(media, SectionPager):
+                    # Items the pager drops for already having previews still count towards the total
+                    media.on_skip = lambda key, task=task: progress.advance(task)
+                for key in media:
+                    if key in seen:
+                        progress.advance(task)
+                        continue
+                    seen.add(key)
+                    owner[key] = task
+                    yield key
+
+        pipeline.run(keys(), on_key_done=lambda key: progress.advance(owner.pop(key)))
+        # Let the copies still in flight land before calling the run finished
+        get_publisher().drain()
+    for device, stats in scheduler.stats()['devices'].items():
+        logger.info('{} {} slots, {} jobs, {:.0%} utilised'.format(device, stats['slots'], stats['jobs'], stats['utilisation']))
+    if get_staging().held:
+        logger.info('{} jobs were held back waiting for staging room'.format(get_staging().held))
+    optimizer = get_jpeg_optimizer()
+    if optimizer is not None and optimizer.bytes_in:
+        logger.info('JPEG optimisation took {:.1f}MB down to {:.1f}MB ({:.0%} smaller) in {:.1f}s of re-encoding'.format(
+            optimizer.bytes_in / 1048576, optimizer.bytes_out / 1048576, 1 - optimizer.bytes_out / optimizer.bytes_in, optimizer.seconds))
+
+
+def process_media(media, title, scheduler):
+    """Push ratingKeys through the resolve -> decode -> publish pipeline"""
+    process_sources([(title, media)], scheduler)
+
+
+def catch_up(watermarks):
+    """
+    What changed while nobody was listening, using the section watermarks. A section seen for the
+    first time only has its watermark set, the sweeps (or Plex's own thumbnailing) cover the backlog.
+    @return list of (section key, new watermark, item keys), commit each watermark only once its keys are
+    processed, so a restart before then asks for them again
+    """
+    caught = []
+    for section in get_plex().library.sections():
+        if section.METADATA_TYPE != 'episode':
+            continue
+        if str(section.key) not in watermarks.state:
+            now = int(time.time())
+            watermarks.commit(section.key, {'addedAt': now, 'updatedAt': now, 'full_sweep': time.time()})
+            continue
+        items, full, watermark = watermarks.changed_items(section)
+        logger.info('Caught up on {} media files changed in {}'.format(len(items), section.title))
+        caught.append((section.key, watermark, [item.key for item in items]))
+    return caught
+
+
+def daemon(scheduler, source=None, stop=None):
+    """
+    Generate previews as Plex finishes processing items, instead of sweeping the library
+    @param source where the notifications come from, the Plex websocket stream if None
+    @param stop threading.Event that ends the daemon once set
+    """
+    batches = queue.Queue()
+    debouncer = Debouncer(batches.put, delay=DEBOUNCE_SECONDS, max_delay=DEBOUNCE_MAX_SECONDS)
+    watermarks = SectionWatermarks(WATERMARK_PATH, full_sweep_interval=FULL_SWEEP_HOURS * 3600)
+    caught_up = []  # [section key, watermark, keys not processed yet] for every catch up still in flight
+    lock = threading.Lock()
+
+    def processed(media):
+        """Move a section's watermark on once everything caught up for it has been through the pipeline"""
+        with lock:
+            for entry in list(caught_up):
+                entry[2].difference_update(media)
+                if not entry[2]:
+                    watermarks.commit(entry[0], entry[1])
+                    caught_up.remove(entry)
+
+    def on_connect():
+        try:
+            caught = catch_up(watermarks)
+        except Exception as e:
+            logger.error('Error catching up on library changes. `{}:{}`'.format(type(e).__name__, str(e)))
+            return
+        # Registered before the keys are queued, so a batch can't be processed before its watermark is waiting on it
+        with lock:
+            caught_up.extend([section_key, watermark, set(keys)] for section_key, watermark, keys in caught)
+        processed([])
+        for _, _, keys in caught:
+            for key in keys:
+                debouncer.add(key)
+
+    def on_notification(data):
+        for key in ready_keys(data):
+            debouncer.add(key)
+
+    if source is None:
+        source = PlexNotificationSource(get_plex(), reconnect_delay=RECONNECT_SECONDS)
+    source.on_connect = on_connect
+    source.start(on_notification)
+    logger.info('Waiting for Plex library notifications...')
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                media = batches.get(timeout=1)
+            except queue.Empty:
                 continue
-            logger.info('Got {} media files for Series :  {}'.format(len(media), section.title))
-            with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
-                with ProcessPoolExecutor(max_workers=CPU_THREADS + GPU_THREADS) as process_pool:
-                    futures = [process_pool.submit(process_item, key) for key in media]
-                    for future in progress.track(futures):
-                        future.result()
+            logger.info('Got {} media files from Plex notifications'.format(len(media)))
+            get_inventory(refresh=True)
+            process_media(media, 'Notified', scheduler)
+            processed(media)
+    finally:
+        source.stop()
+        debouncer.stop(flush_pending=False)
+
+
+def repair(scheduler):
+    """
+    Check every BIF in the bundle store, move the broken ones aside (so they read as missing) and make
+    them again. Only BIFs the ledger has an item for can be made again, the others are left where they
+    are since Plex still lists their part as having previews and no sweep would replace them. Every
+    broken BIF is written to the repair list at REPAIR_LIST_PATH, the ones left in place without a rating_key.
+    """
+    report = BifScanner(PLEX_LOCAL_MEDIA_PATH, workers=SCAN_THREADS).scan()
+    logger.info('Checked {} BIFs in {} bundles in {}s, {} broken'.format(report['bifs'], report['bundles'], report['seconds'], len(report['broken'])))
+    ledger = get_ledger()
+    media = []
+    for entry in report['broken']:
+        logger.warning('Broken preview {}: {}'.format(entry['path'], entry['problem']))
+        entry['rating_key'] = ledger.mark_corrupt(entry['bundle_hash'], error=entry['problem'])
+        if not entry['rating_key']:
+            logger.warning('No item known for bundle {}, leaving {} in place'.format(entry['bundle_hash'], entry['path']))
+            continue
+        try:
+            os.replace(entry['path'], entry['path'] + '.corrupt')
+        except OSError as e:
+            logger.error('Error moving {} aside. `{}:{}`'.format(entry['path'], type(e).__name__, str(e)))
+            continue
+        if get_inventory() is not None:
+            get_inventory().discard(entry['bundle_hash'])
+        if entry['rating_key'] not in media:
+            media.append(entry['rating_key'])
+    write_repair_list(REPAIR_LIST_PATH, report['broken'])
+    logger.info('Regenerating {} media files, repair list written to {}'.format(len(media), REPAIR_LIST_PATH))
+    process_media(media, 'Repair', scheduler)
+
+
+def on_deck_sources(plex):
+    """(show, unwatched episode keys) for every episode on deck, fetched as the pipeline asks for them"""
+    for ep in plex.library.onDeck():
+        if isinstance(ep, Episode):
+            unwatched = ep.season().unwatched()
+            media = [m.key for m in unwatched]
+            logger.info('Got {} media files for library {}'.format(len(media), ep.grandparentTitle))
+            yield ep.grandparentTitle, media
+
+
+def section_sources(plex):
+    """(section title, keys) for every supported library section"""
+    for section in plex.library.sections():
+        logger.info('Getting the media files from library \'{}\''.format(section.title))
+
+        if section.METADATA_TYPE == 'episode':
+            # Streamed a page at a time, so the first jobs start while the rest of the section is still being listed
+            media = SectionPager(plex, section.key, page_size=SECTION_PAGE_SIZE, server_filter=SECTION_FILTER)
+            # media = [m.key for m in section.search(libtype='episode')] ###Previous before sean edits above
+        elif section.METADATA_TYPE == 'changedSoNoMovies':
+            media = [m.key for m in section.search()]
+        else:
+            logger.info('Skipping library {} as \'{}\' is unsupported'.format(section.title, section.METADATA_TYPE))
+            continue
+        logger.info('Got {} media files for Series :  {}'.format(len(media), section.title))
+        yield section.title, media
+
+
+def run():
+    interrupted = get_ledger().reset_running()
+    if interrupted:
+        logger.info('Resuming {} jobs that were interrupted last run'.format(interrupted))
+    plex = get_plex()
+    get_inventory()
+    scheduler = DecodeScheduler(make_backend(GPU_BACKEND), gpu_slots=GPU_THREADS, cpu_slots=CPU_THREADS)
+    start_metrics(scheduler)
+    autoscaler = None
+    if AUTOSCALE:
+        autoscaler = Autoscaler(scheduler, decode_rate,
+                                min_slots=AUTOSCALE_MIN_SLOTS,
+                                max_slots=AUTOSCALE_MAX_SLOTS or 2 * max(1, GPU_THREADS + CPU_THREADS),
+                                interval=AUTOSCALE_INTERVAL, max_load=AUTOSCALE_MAX_LOAD,
+                                max_iowait=AUTOSCALE_MAX_IOWAIT, min_gain=AUTOSCALE_MIN_GAIN,
+                                max_slot_drop=AUTOSCALE_MAX_SLOT_DROP)
+        autoscaler.start()
+
+    try:
+        if runType == "Currently Playing":
+            process_sources(on_deck_sources(plex), scheduler)
+
+        elif runType == "Daemon":
+            daemon(scheduler)
+
+        elif runType == "Repair":
+            repair(scheduler)
+
+        elif runType == "Selection":
+            # Shows picked from the list in generateGlobals, every backend bucket goes through the one pipeline
+            media = [ep.key for sublist in fetch_result_list() for ep in sublist]
+            logger.info('Got {} media files for the selected shows'.format(len(media)))
+            process_media(media, 'Selection', scheduler)
+
+        else:
+            process_sources(section_sources(plex), scheduler)
+    finally:
+        if autoscaler is not None:
+            autoscaler.stop()
 
 
 
@@ -347,10 +1113,12 @@ if __name__ == '__main__':
 
     try:
         # Clean TMP Folder
-        if os.path.isdir(TMP_FOLDER):
-            shutil.rmtree(TMP_FOLDER)
-        os.makedirs(TMP_FOLDER)
+        for folder in filter(None, (TMP_FOLDER, STAGING_DISK_FOLDER)):
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+            os.makedirs(folder)
         run()
     finally:
-        if os.path.isdir(TMP_FOLDER):
-            shutil.rmtree(TMP_FOLDER)
+        for folder in filter(None, (TMP_FOLDER, STAGING_DISK_FOLDER)):
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
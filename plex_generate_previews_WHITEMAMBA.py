@@ -10,10 +10,13 @@ import urllib3
 import array
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed  # Add as_completed to import
-from pathlib import Path
 from plexapi.video import Episode, Season, Show
 from plexapi.exceptions import NotFound  # Add this import
 from generateGlobals import *
+from job_ledger import JobLedger, DONE, FAILED
+from path_resolver import PathResolver, as_list
+from watermarks import SectionWatermarks
+from bundle_inventory import BundleInventory
 
 # Set the timeout envvar for https://github.com/pkkid/python-plexapi
 os.environ["PLEXAPI_PLEXAPI_TIMEOUT"] = str(PLEX_TIMEOUT)
@@ -80,14 +83,7 @@ logger.add(
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def generate_images(video_file_param, output_folder):
-    video_file = video_file_param.replace(PLEX_VIDEOS_PATH_MAPPING, PLEX_LOCAL_VIDEOS_PATH_MAPPING)
-    ogFile = Path(video_file_param.replace(PLEX_VIDEOS_PATH_MAPPING, ""))
-    
-    logfile=Path("G:/VPT-Processing/"+ogFile.stem+".txt")
-    logfile.parent.mkdir(exist_ok=True, parents=True)
-    with open(logfile, 'w') as file:
-        file.write("Processing")
+def generate_images(video_file, output_folder):
     media_info = MediaInfo.parse(video_file)
     vf_parameters = "fps=fps={}:round=up,scale=w=320:h=240:force_original_aspect_ratio=decrease".format(
         round(1 / PLEX_BIF_FRAME_INTERVAL, 6))
@@ -155,7 +151,6 @@ def generate_images(video_file_param, output_folder):
         os.rename(image, os.path.join(output_folder, '{:010d}.jpg'.format(frame_second)))
 
     # Return the data instead of logging
-    logfile.unlink()
     return {'video_file': video_file, 'hw': hw, 'seconds': seconds, 'speed': speed}
 
 def generate_bif(bif_filename, images_path):
@@ -200,7 +195,57 @@ def generate_bif(bif_filename, images_path):
     f.close()
 
 
+_ledger = None
+_ledger_pid = None
+
+
+def get_ledger():
+    """
+    The job ledger for this process, every pool worker opens its own connection. A worker forked after the
+    parent opened one must not use the copy it inherited, sqlite connections don't survive a fork.
+    """
+    global _ledger, _ledger_pid
+    if _ledger is None or _ledger_pid != os.getpid():
+        _ledger = JobLedger(LEDGER_PATH, max_attempts=LEDGER_MAX_ATTEMPTS)
+        _ledger_pid = os.getpid()
+    return _ledger
+
+
+_path_resolver = None
+
+
+def get_path_resolver():
+    """One resolver per worker process, so its cache carries over between the items that worker gets"""
+    global _path_resolver
+    if _path_resolver is None:
+        _path_resolver = PathResolver(
+            as_list(PLEX_VIDEOS_PATH_ARRAY) + [PLEX_VIDEOS_PATH_MAPPING],
+            as_list(PLEX_LOCAL_VIDEOS_PATH_ARRAY) + [PLEX_LOCAL_VIDEOS_PATH_MAPPING],
+            ttl=PATH_CACHE_TTL, negative_ttl=PATH_MISS_TTL)
+    return _path_resolver
+
+
+_inventory = None
+
+
+def set_inventory(inventory):
+    """Pool initializer, each worker gets the inventory as it stood when the pass started"""
+    global _inventory
+    _inventory = inventory
+
+
+def refresh_inventory():
+    """List the bundles in PLEX_LOCAL_MEDIA_PATH, only what changed since the last pass after the first"""
+    global _inventory
+    if _inventory is None:
+        _inventory = BundleInventory(PLEX_LOCAL_MEDIA_PATH, workers=SCAN_THREADS)
+    stats = _inventory.refresh()
+    logger.info('Bundle inventory: {bundles} bundles, {previews} with previews. Listed {listed} prefix folders '
+                'and checked {checked} bundles in {seconds}s'.format(**stats))
+
+
 def process_item(item_key):
+    ledger = get_ledger()
     sess = requests.Session()
     sess.verify = False
     plex = PlexServer(PLEX_URL, PLEX_TOKEN, timeout=PLEX_TIMEOUT, session=sess)
@@ -221,29 +266,17 @@ def process_item(item_key):
                     return
             bundle_hash = media_part.attrib['hash']
             media_file = media_part.attrib['file']
-            if 'PLEX_LOCAL_VIDEOS_PATH_ARRAY' in globals():
-                if len(PLEX_LOCAL_VIDEOS_PATH_ARRAY) > 0:
-                    found=False
-                    for local_path in PLEX_LOCAL_VIDEOS_PATH_ARRAY:
-                        for other_path in PLEX_VIDEOS_PATH_ARRAY:
-                            # logger.info('Checking if {} exists'.format(media_file.replace(other_path, local_path)))                           
-                            if os.path.isfile(media_file.replace(other_path, local_path)):
-                                # logger.info('Found matching path {} for {}'.format(local_path, media_file))
-                                global PLEX_LOCAL_VIDEOS_PATH_MAPPING
-                                global PLEX_VIDEOS_PATH_MAPPING
-                                PLEX_LOCAL_VIDEOS_PATH_MAPPING = local_path
-                                PLEX_VIDEOS_PATH_MAPPING = other_path
-                                # logger.info('PLEX_LOCAL_VIDEOS_PATH_MAPPING = '+PLEX_LOCAL_VIDEOS_PATH_MAPPING)
-                                found=True
-                                break
-                        if found:
-                            break
-                            
-            media_file = media_file.replace(PLEX_VIDEOS_PATH_MAPPING, PLEX_LOCAL_VIDEOS_PATH_MAPPING) ### This line was added by sean.
-            # logger.info('media file = '+media_file)
-            if not os.path.isfile(media_file):
+            # Size and updatedAt as Plex reports them, so finished work is skipped without touching either share
+            file_size = media_part.attrib.get('size')
+            file_mtime = media_part.attrib.get('updatedAt')
+            if ledger.should_skip(bundle_hash, file_size, file_mtime):
+                continue
+
+            local_file = get_path_resolver().resolve(media_file)
+            if local_file is None:
                 logger.error('Skipping as file not found {}'.format(media_file))
                 continue
+            media_file = local_file
 
             try:
                 bundle_file = '{}/{}{}'.format(bundle_hash[0], bundle_hash[1::1], '.bundle')
@@ -255,44 +288,56 @@ def process_item(item_key):
             indexes_path = os.path.join(bundle_path, 'Contents', 'Indexes')
             index_bif = os.path.join(indexes_path, 'index-sd.bif')
             tmp_path = os.path.join(TMP_FOLDER, bundle_hash)
-            if (not os.path.isfile(index_bif)) and (not os.path.isdir(tmp_path)):
-                if not os.path.isdir(indexes_path):
-                    try:
-                        os.makedirs(indexes_path)
-                    except OSError as e:
-                        logger.error('Error generating images for {}. `{}:{}` error when creating index path {}'.format(media_file, type(e).__name__, str(e), indexes_path))
-                        continue
+            has_preview = _inventory.has_preview(bundle_hash) if _inventory is not None else None
+            if has_preview is None:
+                # A bundle Plex made since the inventory was listed
+                has_preview = os.path.isfile(index_bif)
+            if has_preview:
+                ledger.record_existing(bundle_hash, item_key, media_file, file_size, file_mtime)
+                continue
+            if not ledger.claim(bundle_hash, item_key, media_file, file_size, file_mtime):
+                continue
 
+            if not (_inventory is not None and _inventory.has_indexes(bundle_hash)) and not os.path.isdir(indexes_path):
                 try:
-                    os.makedirs(tmp_path)
+                    os.makedirs(indexes_path)
                 except OSError as e:
-                    logger.error('Error generating images for {}. `{}:{}` error when creating tmp path {}'.format(media_file, type(e).__name__, str(e), tmp_path))
+                    logger.error('Error generating images for {}. `{}:{}` error when creating index path {}'.format(media_file, type(e).__name__, str(e), indexes_path))
+                    ledger.finish(bundle_hash, FAILED, error=str(e))
                     continue
 
-                try:
-                    result = generate_images(media_part.attrib['file'], tmp_path)
-                except Exception as e:
-                    logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
-                    continue
+            try:
+                os.makedirs(tmp_path)
+            except OSError as e:
+                logger.error('Error generating images for {}. `{}:{}` error when creating tmp path {}'.format(media_file, type(e).__name__, str(e), tmp_path))
+                ledger.finish(bundle_hash, FAILED, error=str(e))
+                continue
 
-                try:
-                    generate_bif(index_bif, tmp_path)
-                except Exception as e:
-                    # Remove bif, as it prob failed to generate
-                    if os.path.exists(index_bif):
-                        os.remove(index_bif)
-                    logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(media_file, type(e).__name__, str(e)))
-                    continue
-                finally:
-                    if os.path.exists(tmp_path):
-                        shutil.rmtree(tmp_path)
-                        
-                return result  # Return the result for logging
-            else:
-                # logger.info('Skipping as bif already exists or tmp path exists {}'.format(media_file))
+            try:
+                result = generate_images(media_file, tmp_path)
+            except Exception as e:
+                logger.error('Error generating images for {}. `{}: {}` error when generating images'.format(media_file, type(e).__name__, str(e)))
+                ledger.finish(bundle_hash, FAILED, error=str(e))
+                if os.path.exists(tmp_path):
+                    shutil.rmtree(tmp_path)
+                continue
+
+            try:
+                generate_bif(index_bif, tmp_path)
+            except Exception as e:
+                # Remove bif, as it prob failed to generate
+                if os.path.exists(index_bif):
+                    os.remove(index_bif)
+                logger.error('Error generating images for {}. `{}:{}` error when generating bif'.format(media_file, type(e).__name__, str(e)))
+                ledger.finish(bundle_hash, FAILED, error=str(e))
                 continue
+            else:
+                ledger.finish(bundle_hash, DONE, output_size=os.path.getsize(index_bif))
+            finally:
+                if os.path.exists(tmp_path):
+                    shutil.rmtree(tmp_path)
+
+            return result  # Return the result for logging
 
 def run():
     ###-- V2.0 with Parallel Sublist Processing --###
@@ -300,10 +345,14 @@ def run():
     sess = requests.Session()
     sess.verify = False
 
-    # Clean up old processing directory
-    shutil.rmtree("G:/VPT-Processing/") if os.path.exists("G:/VPT-Processing/") else None
+    # Anything still marked running was cut off last time round
+    interrupted = get_ledger().reset_running()
+    if interrupted:
+        logger.info('Resuming {} jobs that were interrupted last run'.format(interrupted))
 
     plex = PlexServer(PLEX_URL, PLEX_TOKEN, session=sess)
+    if BUNDLE_INVENTORY:
+        refresh_inventory()
 
     def process_media(media, sublist_index, sublist_name, workers=CPU_THREADS + GPU_THREADS):
         """Process media for a specific sublist"""
@@ -312,7 +361,7 @@ def run():
             
         logger.info(f'Processing {len(media)} media files from {sublist_name} (Sublist {sublist_index})')
             
-        with ProcessPoolExecutor(max_workers=workers) as pool:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_inventory, initargs=(_inventory,)) as pool:
             futures = [pool.submit(process_item, key) for key in media]
             for future in as_completed(futures):
                 result = future.result()
@@ -322,6 +371,50 @@ def run():
                 progress.advance(task)
                 progress.refresh()
 
+    def process_sources(sources, workers=CPU_THREADS + GPU_THREADS):
+        """
+        Every source through one pool that lives for the whole run, so a long file in one section
+        doesn't leave the cores idle before the next section can start
+        @param sources iterable of (title, keys, on_done). Each gets its own progress bar, on_done (or None)
+        is called once all of its items finished without an error. A key in more than one source runs once.
+        """
+        with Progress(SpinnerColumn(), *Progress.get_default_columns(), MofNCompleteColumn(), console=console) as progress:
+            with ProcessPoolExecutor(max_workers=workers, initializer=set_inventory, initargs=(_inventory,)) as pool:
+                futures = {}  # future -> (progress task, title)
+                left = {}  # progress task -> [items not finished, failed?, on_done]
+                seen = set()
+                for title, media, on_done in sources:
+                    task = progress.add_task(title, total=len(media))
+                    left[task] = [0, False, on_done]
+                    for key in media:
+                        if key in seen:
+                            progress.advance(task)
+                            continue
+                        seen.add(key)
+                        futures[pool.submit(process_item, key)] = (task, title)
+                        left[task][0] += 1
+
+                def source_done(task):
+                    _, failed, on_done = left.pop(task)
+                    if on_done and not failed:
+                        on_done()
+
+                for task in [task for task, (count, _, _) in left.items() if not count]:
+                    source_done(task)
+                for future in as_completed(futures):
+                    task, title = futures.pop(future)
+                    try:
+                        result = future.result()
+                        if result:
+                            logger.info('Generated Video Preview for {} on {} HW={} TIME={}seconds SPEED={}x'.format(
+                                result['video_file'], title, result['hw'], result['seconds'], result['speed']))
+                    except Exception as e:
+                        left[task][1] = True
+                        logger.error('Error processing item in {}. `{}:{}`'.format(title, type(e).__name__, str(e)))
+                    progress.advance(task)
+                    left[task][0] -= 1
+                    if not left[task][0]:
+                        source_done(task)
 
     if runType != "Currently Playing" and runType != "Full":
         from generateGlobals import fetch_result_list
@@ -355,22 +448,30 @@ def run():
                     progress.refresh()
                 
     elif runType == "Currently Playing":
-        for item in plex.library.onDeck():
-            if isinstance(item, Episode):
-                title = item.grandparentTitle
-                process_media([m.key for m in item.season().unwatched()], 0, 'Currently Playing')
+        def on_deck():
+            for item in plex.library.onDeck():
+                if isinstance(item, Episode):
+                    yield item.grandparentTitle, [m.key for m in item.season().unwatched()], None
+
+        process_sources(on_deck())
     else:
-        for section in plex.library.sections():
-            if section.METADATA_TYPE == 'episode':
-                title = section.title
-                media = [m.key for m in section.search(libtype='episode')]
-                process_media(media, 0, section.title)
-            elif section.METADATA_TYPE == 'changedSoNoMovies':
-                title = section.title
-                media = [m.key for m in section.search()]
-                process_media(media, 0, section.title)
-            else:
-                logger.info(f'Skipping {section.title}, unsupported type: {section.METADATA_TYPE}')
+        # Only ask Plex for what changed since the last pass, with a full sweep every FULL_SWEEP_HOURS
+        watermarks = SectionWatermarks(WATERMARK_PATH, full_sweep_interval=FULL_SWEEP_HOURS * 3600)
+
+        def sections():
+            for section in plex.library.sections():
+                if section.METADATA_TYPE == 'episode':
+                    items, full, watermark = watermarks.changed_items(section)
+                    media = [m.key for m in items]
+                    logger.info('{} {} media files from {}'.format('Full sweep,' if full else 'Changed since last pass,', len(media), section.title))
+                    # The watermark only moves on once everything the section handed out is done
+                    yield section.title, media, lambda key=section.key, watermark=watermark: watermarks.commit(key, watermark)
+                elif section.METADATA_TYPE == 'changedSoNoMovies':
+                    yield section.title, [m.key for m in section.search()], None
+                else:
+                    logger.info(f'Skipping {section.title}, unsupported type: {section.METADATA_TYPE}')
+
+        process_sources(sections())
 
 
 def main():
@@ -394,6 +495,7 @@ def main():
         os.makedirs(TMP_FOLDER)
         while True:
             run()
+            time.sleep(POLL_INTERVAL)
     except KeyboardInterrupt:
         logger.info('Shutting down...')
     finally:
@@ -0,0 +1,96 @@
+import shutil
+import threading
+
+MEMORY = 'memory'
+UNKNOWN_DURATION = 3 * 3600  # Assumed length of a video whose duration couldn't be found, in seconds
+
+
+class _Area:
+    def __init__(self, name, path, budget):
+        self.name = name
+        self.path = path
+        self.budget = budget
+        self.reserved = 0
+        self.jobs = 0
+
+
+class StagingBudget:
+    """
+    Keeps the frames of the jobs in flight inside a budget, so a lot of long videos decoding at once
+    can't fill a tmpfs TMP_FOLDER (ENOSPC) or RAM (OOM kill). Each job's footprint is estimated from
+    its duration and the frame interval, and reserved before the job is dispatched.
+    Jobs that write JPEGs to a folder go to the first area with room (eg: /dev/shm, then a disk path),
+    jobs that stream their frames are counted against the memory budget. When nothing has room the
+    job is held back until a running one releases its reservation. An area with nothing reserved
+    always takes the next job, so a job bigger than the whole budget still runs, just on its own.
+    """
+
+    def __init__(self, areas, memory_budget, frame_bytes, interval, min_free=0):
+        """
+        @param areas list of (path, budget in bytes) for JPEG folders, in order of preference. A budget of 0 = no cap
+        @param memory_budget bytes of streamed frames allowed in flight, 0 = no cap
+        @param frame_bytes estimated size of one preview JPEG
+        @param interval seconds between preview frames
+        @param min_free bytes the filesystem of a folder area must keep free on top of the job, whatever its budget
+        """
+        self.areas = [_Area(path, path, budget) for path, budget in areas if path]
+        self.memory = _Area(MEMORY, None, memory_budget)
+        self.frame_bytes = frame_bytes
+        self.interval = interval
+        self.min_free = min_free
+        self.lock = threading.Lock()
+        self.held = 0
+        self.holding = set()  # keys of the jobs held back right now, so each is counted once however often it's retried
+
+    def estimate(self, duration):
+        """Bytes of frames for a video of `duration` seconds"""
+        frames = int((duration or UNKNOWN_DURATION) / self.interval) + 1
+        return frames * self.frame_bytes
+
+    def _fits(self, area, size):
+        if not area.jobs:
+            return True
+        if area.budget and area.reserved + size > area.budget:
+            return False
+        if area.path is not None:
+            try:
+                free = shutil.disk_usage(area.path).free
+            except OSError:
+                return False
+            if free < size + self.min_free:
+                return False
+        return True
+
+    def reserve(self, duration, stream, key=None):
+        """
+        Reserve room for a job's frames
+        @param stream True if the frames are kept in memory rather than written to a folder
+        @param key identifies the job, a job held back is counted in `held` once however often it's retried
+        @return a token for release(), with the folder to write to in token['path'] (None when streaming),
+        or None if there's no room right now
+        """
+        size = self.estimate(duration)
+        with self.lock:
+            for area in ([self.memory] if stream else self.areas):
+                if self._fits(area, size):
+                    area.reserved += size
+                    area.jobs += 1
+                    self.holding.discard(key)
+                    return {'area': area, 'size': size, 'path': area.path}
+            if key is None or key not in self.holding:
+                self.held += 1
+                if key is not None:
+                    self.holding.add(key)
+        return None
+
+    def release(self, token):
+        with self.lock:
+            area = token['area']
+            area.reserved -= token['size']
+            area.jobs -= 1
+
+    def stats(self):
+        """area -> (bytes reserved, budget, jobs), plus how many jobs were held back for lack of room"""
+        with self.lock:
+            areas = {area.name: (area.reserved, area.budget, area.jobs) for area in self.areas + [self.memory]}
+            return {'areas': areas, 'held': self.held}
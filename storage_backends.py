@@ -0,0 +1,103 @@
+from collections import OrderedDict, deque
+
+DEFAULT_BACKEND = 'WM'
+
+
+class StorageBackends:
+    """
+    Maps media paths onto the storage they live on (an rclone remote, a zpool...) by longest prefix,
+    along with how many decodes each backend is allowed to have reading from it at once
+    """
+
+    def __init__(self, table, default_limit=0):
+        """
+        @param table list of (name, path prefix, in-flight limit), a limit of 0 means no cap
+        @param default_limit cap for paths that match none of the prefixes
+        """
+        self.prefixes = sorted(((prefix, name) for name, prefix, _ in table), key=lambda p: len(p[0]), reverse=True)
+        self.limits = {name: limit for name, _, limit in table}
+        self.limits.setdefault(DEFAULT_BACKEND, default_limit)
+
+    @classmethod
+    def parse(cls, config, default_limit=0):
+        """
+        Build the table from a config string
+        @param config eg: 'RCLONE=/rclone@4;ZPOOL1=/zfs/zpool1@2', `@limit` is optional
+        """
+        table = []
+        for entry in filter(None, (e.strip() for e in config.split(';'))):
+            name, _, prefix = entry.partition('=')
+            limit = 0
+            if '@' in prefix:
+                prefix, _, limit = prefix.rpartition('@')
+            table.append((name.strip(), prefix.strip(), int(limit)))
+        return cls(table, default_limit)
+
+    def classify(self, path):
+        for prefix, name in self.prefixes:
+            if path.startswith(prefix):
+                return name
+        return DEFAULT_BACKEND
+
+    def limit(self, name):
+        return self.limits.get(name, 0)
+
+
+class BackendQueues:
+    """
+    Jobs waiting for a decode slot, queued per storage backend. next_backend() hands them out round
+    robin across backends while keeping each backend under its in-flight limit, so every disk/remote
+    is kept busy instead of all the workers piling onto one of them.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or StorageBackends([])
+        self.queues = OrderedDict()
+        self.in_flight = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, backend, item):
+        if backend not in self.queues:
+            self.queues[backend] = deque()
+            self.in_flight.setdefault(backend, 0)
+        self.queues[backend].append(item)
+        self.size += 1
+
+    def next_backend(self):
+        """The next backend in turn that has work waiting and room for another read, or None"""
+        for backend, queue in self.queues.items():
+            limit = self.storage.limit(backend)
+            if queue and (not limit or self.in_flight[backend] < limit):
+                return backend
+        return None
+
+    def peek(self, backend):
+        """The job pop() would hand out next for a backend, left in the queue"""
+        return self.queues[backend][0]
+
+    def room(self, backend, wanted):
+        """How many of `wanted` extra reads a backend has room for, on top of the one the job being dispatched takes"""
+        limit = self.storage.limit(backend)
+        if not limit:
+            return wanted
+        return max(0, min(wanted, limit - self.in_flight.get(backend, 0) - 1))
+
+    def pop(self, backend, reads=1):
+        """Take the next job for a backend and count its reads as in flight until done() is called"""
+        item = self.queues[backend].popleft()
+        self.size -= 1
+        self.in_flight[backend] += reads
+        # Send this backend to the back of the line
+        self.queues.move_to_end(backend)
+        return item
+
+    def done(self, backend, reads=1):
+        self.in_flight[backend] -= reads
+
+    def depths(self):
+        """backend -> (jobs waiting, reads in flight)"""
+        return {backend: (len(self.queues.get(backend, ())), self.in_flight.get(backend, 0))
+                for backend in set(self.queues) | set(self.in_flight)}
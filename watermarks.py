@@ -0,0 +1,78 @@
+import json
+import os
+import time
+from urllib.parse import urlencode
+
+# Plex timestamps are whole seconds, re-ask for a little before the watermark so nothing added in the
+# same second as the last item seen is missed (the job ledger skips anything already done)
+OVERLAP = 60
+
+
+def _stamp(value):
+    """plexapi datetime (or None) -> epoch seconds"""
+    return int(value.timestamp()) if value is not None else 0
+
+
+class SectionWatermarks:
+    """
+    Remembers, per library section, the newest addedAt/updatedAt seen so a polling loop only asks Plex
+    for items that changed since. Every `full_sweep_interval` seconds a section is listed in full again
+    to pick up anything the incremental queries can't see (eg: a file replaced without Plex bumping
+    updatedAt). State is a small JSON file, written atomically.
+    """
+
+    def __init__(self, path, full_sweep_interval=86400):
+        self.path = path
+        self.full_sweep_interval = full_sweep_interval
+        self.state = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.state = json.load(f)
+            except ValueError:
+                # A corrupt state file just means the next pass is a full sweep
+                self.state = {}
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def needs_full_sweep(self, section_key):
+        mark = self.state.get(str(section_key))
+        return mark is None or time.time() - mark.get('full_sweep', 0) >= self.full_sweep_interval
+
+    def changed_items(self, section, libtype=4):
+        """
+        Items in the section that are new or updated since the last pass, or every item when a full sweep is due
+        @param libtype Plex type number to list, 4 = episode
+        @return (items, full sweep?, new watermark to commit() once they are processed)
+        """
+        key = str(section.key)
+        full = self.needs_full_sweep(key)
+        if full:
+            items = section.search(libtype={4: 'episode', 1: 'movie'}.get(libtype))
+        else:
+            mark = self.state[key]
+            items = {}
+            for field in ('addedAt', 'updatedAt'):
+                query = urlencode({'type': libtype, field + '>>': max(0, mark[field] - OVERLAP)})
+                for item in section.fetchItems('/library/sections/{}/all?{}'.format(key, query)):
+                    items[item.ratingKey] = item
+            items = list(items.values())
+
+        previous = self.state.get(key, {})
+        watermark = {
+            'addedAt': max([previous.get('addedAt', 0)] + [_stamp(item.addedAt) for item in items]),
+            'updatedAt': max([previous.get('updatedAt', 0)] + [_stamp(getattr(item, 'updatedAt', None)) for item in items]),
+            'full_sweep': time.time() if full else previous.get('full_sweep', 0),
+        }
+        return items, full, watermark
+
+    def commit(self, section_key, watermark):
+        """Move the section's watermark on, call once its changed items have been processed"""
+        self.state[str(section_key)] = watermark
+        self.save()